@@ -230,8 +230,6 @@ static int kafl_guest_create_memory_bar(kafl_mem_state *s, int region_num, uint6
 	}
 
 	switch(region_num){
-		case 1:	pt_setup_program((void*)ptr);
-				break;
 		case 2:	pt_setup_payload((void*)ptr);
 				break;
 	}
@@ -241,6 +239,33 @@ static int kafl_guest_create_memory_bar(kafl_mem_state *s, int region_num, uint6
 	return 0;
 }
 
+/* the program file is published once by the fuzzer and shared by all VMs, it is only read */
+static int kafl_guest_map_program(kafl_mem_state *s, const char* file, Error **errp){
+	void * ptr;
+	int fd;
+	struct stat st;
+
+	fd = open(file, O_RDONLY);
+	if (fd < 0) {
+		error_setg_errno(errp, errno, "Failed to open program file %s", file);
+		return -1;
+	}
+	fstat(fd, &st);
+	QEMU_PT_PRINTF(INTERFACE_PREFIX, "program shm file: (max size: %lx) %lx", (uint64_t)PROGRAM_SIZE, st.st_size);
+
+	assert(PROGRAM_SIZE == st.st_size);
+	ptr = mmap(0, PROGRAM_SIZE, PROT_READ, MAP_SHARED, fd, 0);
+	if (ptr == MAP_FAILED) {
+		error_setg_errno(errp, errno, "Failed to mmap program");
+		return -1;
+	}
+
+	pt_setup_program(ptr);
+	pt_setup_snd_handler(&send_char, s);
+
+	return 0;
+}
+
 static void kafl_guest_setup_bitmap(kafl_mem_state *s, uint32_t bitmap_size){
 	void * ptr;
 	int fd;
@@ -284,7 +309,7 @@ static void pci_kafl_guest_realize(DeviceState *dev, Error **errp){
 	kafl_bitmap_size = (uint32_t)s->bitmap_size;
 	
 	if (s->data_bar_fd_0 != NULL)
-		kafl_guest_create_memory_bar(s, 1, PROGRAM_SIZE, s->data_bar_fd_0, errp);
+		kafl_guest_map_program(s, s->data_bar_fd_0, errp);
 	if (s->data_bar_fd_1 != NULL)
 		kafl_guest_create_memory_bar(s, 2, PAYLOAD_SIZE, s->data_bar_fd_1, errp);
 	if (s->redqueen_workdir){
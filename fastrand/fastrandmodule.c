@@ -74,16 +74,64 @@ pcg32bounded(PyObject* self, PyObject* args) {
     return NULL;
 }
 
-static void
+static PyObject*
 pcg32inc(PyObject* self, PyObject* args) {
     long n = PyInt_AsLong(args);
+    if (n == -1 && PyErr_Occurred())
+      return NULL;
     pcg32_init_inc(n);
+    Py_RETURN_NONE;
 }
 
-static void
+static PyObject*
 pcg32state(PyObject* self, PyObject* args) {
     long n = PyInt_AsLong(args);
+    if (n == -1 && PyErr_Occurred())
+      return NULL;
     pcg32_init_state((uint32_t)n);
+    Py_RETURN_NONE;
+}
+
+/* full 64 bit seeding as in pcg32_srandom_r of the PCG reference code */
+static PyObject*
+pcg32srandom(PyObject* self, PyObject* args) {
+    unsigned long long initstate, initseq;
+    if (!PyArg_ParseTuple(args, "KK", &initstate, &initseq))
+      return NULL;
+    pcg32_global.state = 0U;
+    pcg32_global.inc = (initseq << 1u) | 1u;
+    pcg32_random();
+    pcg32_global.state += initstate;
+    pcg32_random();
+    Py_RETURN_NONE;
+}
+
+/* n random 32 bit integers (native byte order) in a single string */
+static PyObject*
+pcg32fill(PyObject* self, PyObject* args) {
+    long n = PyInt_AsLong(args);
+    PyObject* result;
+    uint32_t* buffer;
+    if (n == -1 && PyErr_Occurred())
+      return NULL;
+    if (n < 0) {
+      PyErr_SetString(PyExc_ValueError, "negative count");
+      return NULL;
+    }
+#if PY_MAJOR_VERSION >= 3
+    result = PyBytes_FromStringAndSize(NULL, n * sizeof(uint32_t));
+    if (!result)
+      return NULL;
+    buffer = (uint32_t*)PyBytes_AS_STRING(result);
+#else
+    result = PyString_FromStringAndSize(NULL, n * sizeof(uint32_t));
+    if (!result)
+      return NULL;
+    buffer = (uint32_t*)PyString_AS_STRING(result);
+#endif
+    for (long i = 0; i < n; i++)
+      buffer[i] = pcg32_random();
+    return result;
 }
 
 
@@ -123,16 +171,18 @@ static inline void xorshift128plus_init_state2(uint64_t state2) {
     xorshift128plus_s[1] = state2;
 }
 
-static void
+static PyObject*
 xorshift128plus_seed1(PyObject* self, PyObject* args) {
     uint64_t n = PyInt_AsUnsignedLongLongMask(args);
     xorshift128plus_init_state1(n);
+    Py_RETURN_NONE;
 }
 
-static void
+static PyObject*
 xorshift128plus_seed2(PyObject* self, PyObject* args) {
     uint64_t n = PyInt_AsUnsignedLongLongMask(args);
     xorshift128plus_init_state2(n);
+    Py_RETURN_NONE;
 }
 
 
@@ -147,6 +197,8 @@ static PyMethodDef FastRandMethods[] =
      {"pcg32bounded", pcg32bounded, METH_O, "generate random integer in the interval [0,range) using PCG."},
      {"pcg32inc", pcg32inc, METH_O, "change the increment parameter of the pcg32 generator (global, for experts)."},
      {"pcg32_seed", pcg32state, METH_O, "seed the pcg32 generator (global)."},
+     {"pcg32_srandom", pcg32srandom, METH_VARARGS, "seed the pcg32 generator with a 64 bit state and stream selector (global)."},
+     {"pcg32_fill", pcg32fill, METH_O, "generate n random integers (32 bits each) using PCG, returned as one string."},
      {"xorshift128plus_seed1", xorshift128plus_seed1, METH_O, "seed the xorshift128plus generator (global, first 64 bits)."},
      {"xorshift128plus_seed2", xorshift128plus_seed2, METH_O, "seed the xorshift128plus generator (global, second 64 bits)."},
      {NULL, NULL, 0, NULL}
@@ -60,6 +60,11 @@ sudo -Eu root apt-get build-dep qemu-system-x86 -y > /dev/null
 echo "[*] Installing python essentials ..."
 sudo -Eu root pip2.7 install mmh3 lz4 psutil > /dev/null 2> /dev/null
 
+echo "[*] Installing bundled fastrand module ..."
+cd fastrand
+sudo -Eu root python2.7 setup.py install > /dev/null 2> /dev/null
+cd ..
+
 echo
 echo "[*] Downloading QEMU $QEMU_VERSION ..."
 wget -O qemu.tar.gz $QEMU_URL 2> /dev/null
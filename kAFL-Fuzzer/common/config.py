@@ -40,9 +40,9 @@ default_config = {"UI_REFRESH_RATE": 0.25,
                       "TIMEOUT_TICK_FACTOR": 10.0,
                       "ARITHMETIC_MAX": 35,
                       "APPLE-SMC-OSK": "",
-                      "DEPTH-FIRST-SEARCH": False,
                       "AGENTS-FOLDER": "./../Target-Components/agents/",
-                      "MAX_MIN_BUCKETS": False
+                      "MAX_MIN_BUCKETS": False,
+                      "CORPUS_EXPORT": True
                     }
 
 class ArgsParser(argparse.ArgumentParser):
@@ -103,6 +103,13 @@ def parse_range_ip_filter(string):
     return list([start, end])
 
 
+def parse_seed(string):
+    try:
+        return int(string, 0) & 0xFFFFFFFFFFFFFFFF
+    except ValueError:
+        raise argparse.ArgumentTypeError("'" + string + "' is not a number.")
+
+
 class FullPath(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         setattr(namespace, self.dest, os.path.abspath(os.path.expanduser(values))  )
@@ -472,6 +479,7 @@ class FuzzerConfiguration:
 
             sparser.add_argument('-fix_hashes', required=False, help='enable checksum fix module', action='store_true', default=False)
             sparser.add_argument('-hammer_jmp_tables', required=False, help='enable jump table hammering', action='store_true', default=False)
+            sparser.add_argument('-seed', required=False, metavar='<Seed>', help='seed of the havoc RNG (reproducible havoc runs).', default=None, type=parse_seed)
 
 
 
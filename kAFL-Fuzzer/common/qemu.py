@@ -19,6 +19,8 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import traceback
+import ctypes
+import errno
 import mmap
 import os
 import sys
@@ -30,7 +32,6 @@ import subprocess
 import time
 from socket import error as socket_error
 import psutil
-import mmh3
 import shutil
 import common.qemu_protocol as qemu_protocol
 
@@ -40,8 +41,10 @@ from common.debug import log_qemu, log_redq
 from common.util import atomic_write
 
 from common.util import Singleton
+from common.shared_set import SharedHashSet, BitmapHashIndex
 from multiprocessing import Process, Manager, Value
 from fuzzer.technique.redqueen.workdir import RedqueenWorkdir
+from fuzzer.technique.helper import hash64, get_nativ
 
 from common.safe_syscall import safe_select, safe_socket
 
@@ -53,30 +56,44 @@ def to_string_32(value):
            chr((value >> 8) & 0xff) + \
            chr(value & 0xff)
 
+""" size of the program region of a VM (PROGRAM_SIZE in QEMU-PT/pt/interface.h) """
+BINARY_MAX_SIZE = 128 << 20
+
+
+def publish_binary(binaryfile, filename):
+    """
+    Writes the target binary into the shm file filename and returns it.
+    QEMU maps the file read-only as the program region of a VM, so one
+    file serves every VM. It has the size of that region but is sparse,
+    only the binary itself takes up memory.
+    """
+    if os.path.getsize(binaryfile) > BINARY_MAX_SIZE:
+        raise ValueError("%s exceeds %d bytes" % (binaryfile, BINARY_MAX_SIZE))
+    tmp_file = filename + ".tmp"
+    with open(binaryfile, "rb") as src, open(tmp_file, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+        dst.truncate(BINARY_MAX_SIZE)
+    os.rename(tmp_file, filename)
+    return filename
+
+
 class QemuLookupSet:
     __metaclass__ = Singleton
 
     def __init__(self):
-        manager = Manager()
-        self.non_finding = manager.dict()
-        self.non_finding_preliminary = manager.dict()
-        self.config = manager.dict()
-        self.preliminary = Value('b', False)
+        self.non_finding = SharedHashSet("non_finding", capacity=1 << 21)
+        self.non_finding_preliminary = SharedHashSet("non_finding_preliminary", capacity=1 << 18)
+        self.preliminary = Value('b', False, lock=False)
 
-        self.crash = manager.dict()
-        self.timeout = manager.dict()
-        self.kasan = manager.dict()
-
-        self.backup_non_finding = {}
-        self.backup_crash = {}
-        self.backup_timeout = {}
-        self.backup_kasan = {}
+        """ payloads that trash the PT buffer on every retry """
+        self.pt_quarantine = SharedHashSet("pt_quarantine", capacity=1 << 16)
+        self.pt_quarantined = Value('b', False, lock=False)
 
     def set_value(self, key):
         if not self.preliminary.value:
-            self.non_finding[key] = None
+            self.non_finding.add(key)
         else:
-            self.non_finding_preliminary[key] = None
+            self.non_finding_preliminary.add(key)
 
     def check_value(self, key):
         if not self.preliminary.value:
@@ -92,10 +109,15 @@ class QemuLookupSet:
         self.preliminary.value = False      
 
 class qemu:
-    SC_CLK_TCK = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
-
     CMDS = qemu_protocol.CMDS
 
+    """ seconds to wait for the control socket of a new VM and the longest pause between two attempts """
+    CONNECT_TIMEOUT = 120.0
+    CONNECT_BACKOFF = 0.1
+
+    """ executions of a payload after the PT buffer was trashed """
+    PT_RETRIES = 3
+
     def __debug_hprintf(self):
         try:
             if self.debug_counter < 512:
@@ -124,22 +146,28 @@ class qemu:
         self.__debug_send(qemu_protocol.DISABLE_RQI_MODE)
         self.__debug_recv_expect(qemu_protocol.DISABLE_RQI_MODE)
 
+    def __set_patches(self, enabled):
+        """ returns the command that switches the patch mode or None if it is already set """
+        if self.patches_enabled == enabled:
+            return None
+        assert(not self.needs_execution_for_patches)
+        self.needs_execution_for_patches = True
+        self.patches_enabled = enabled
+        if enabled:
+            return qemu_protocol.ENABLE_PATCHES
+        return qemu_protocol.DISABLE_PATCHES
+
     def send_enable_patches(self):
-        if not self.patches_enabled:
-            assert(not self.needs_execution_for_patches)
-            self.needs_execution_for_patches = True
-            self.patches_enabled = True
-            self.__debug_send(qemu_protocol.ENABLE_PATCHES)
-            self.__debug_recv_expect(qemu_protocol.ENABLE_PATCHES)
+        cmd = self.__set_patches(True)
+        if cmd:
+            self.__debug_send(cmd)
+            self.__debug_recv_expect(cmd)
 
     def send_disable_patches(self):
-        if self.patches_enabled:
-            assert(not self.needs_execution_for_patches)
-            self.needs_execution_for_patches = True
-            self.patches_enabled = False
-            self.__debug_send(qemu_protocol.DISABLE_PATCHES)
-            self.__debug_recv_expect(qemu_protocol.DISABLE_PATCHES)
-        pass
+        cmd = self.__set_patches(False)
+        if cmd:
+            self.__debug_send(cmd)
+            self.__debug_recv_expect(cmd)
 
     def send_enable_trace(self):
         self.__debug_send(qemu_protocol.ENABLE_TRACE_MODE)
@@ -165,25 +193,43 @@ class qemu:
         self.__debug_send(qemu_protocol.REDQUEEN_SET_BLACKLIST)
         self.__debug_recv_expect(qemu_protocol.REDQUEEN_SET_BLACKLIST)
 
-    def __debug_send(self, cmd):
+    def __debug_send(self, *cmds):
+        """ pipelines all cmds with a single syscall, the replies arrive in the same order """
         if self.debug_mode:
-            try:
-                info = ""
-                if self.handshake_stage_1 and cmd == qemu_protocol.RELEASE:
-                    info = " (Loader Handshake)"
-                    self.handshake_stage_1 = False
-                elif self.handshake_stage_2 and cmd == qemu_protocol.RELEASE:
-                    info = " (Initial Handshake Iteration)"
-                    self.handshake_stage_2 = False
-                print("[SEND]  \t" + '\033[94m' + self.CMDS[cmd] + info + '\033[0m')
-            except:
-                print("[SEND]  \t" + "unknown cmd '" + res + "'")
-        self.control.send(cmd)
+            for cmd in cmds:
+                try:
+                    info = ""
+                    if self.handshake_stage_1 and cmd == qemu_protocol.RELEASE:
+                        info = " (Loader Handshake)"
+                        self.handshake_stage_1 = False
+                    elif self.handshake_stage_2 and cmd == qemu_protocol.RELEASE:
+                        info = " (Initial Handshake Iteration)"
+                        self.handshake_stage_2 = False
+                    print("[SEND]  \t" + '\033[94m' + self.CMDS[cmd] + info + '\033[0m')
+                except:
+                    print("[SEND]  \t" + "unknown cmd '" + cmd + "'")
+        self.control.sendall("".join(cmds))
 
+    def __debug_read(self):
+        """ next byte of the control socket, every recv drains all bytes that are available """
+        if self.control_buffer_pos >= len(self.control_buffer):
+            while True:
+                try:
+                    self.control_buffer = self.control.recv(4096)
+                    break
+                except socket_error as e:
+                    if e.errno != errno.EINTR:
+                        raise
+            self.control_buffer_pos = 0
+            if not self.control_buffer:
+                return ""
+        res = self.control_buffer[self.control_buffer_pos]
+        self.control_buffer_pos += 1
+        return res
 
     def __debug_recv(self):
         while True:
-            res = self.control.recv(1)
+            res = self.__debug_read()
             if(len(res) == 0):
                 log_qemu("__debug_recv error?", self.qemu_id)
                 break
@@ -244,11 +290,14 @@ class qemu:
         return True
 
 
-    def __init__(self, qid, config, debug_mode=False, notifiers=True):
+    def __init__(self, qid, config, debug_mode=False, notifiers=True, binary_filename=None):
 
         self.bb_count = 0
         self.hprintf_print_mode = True
         self.internal_buffer_overflow_counter = 0
+        self.pt_retry_counter = 0
+        self.pt_quarantine_counter = 0
+        self.trashed = False
 
         self.handshake_stage_1 = True
         self.handshake_stage_2 = True
@@ -260,18 +309,27 @@ class qemu:
         self.global_bitmap = None
 
         self.lookup = QemuLookupSet()
+        self.bitmap_hashes = BitmapHashIndex()
 
         self.bitmap_size = config.config_values['BITMAP_SHM_SIZE']
         self.config = config
         self.qemu_id = str(qid)
 
+        self.down = False
         self.process = None
         self.intervm_tty_write = None
         self.control = None
         self.control_fileno = None
+        self.control_buffer = ""
+        self.control_buffer_pos = 0
 
         self.payload_filename   = "/dev/shm/kafl_qemu_payload_" + self.qemu_id
-        self.binary_filename    = "/dev/shm/kafl_qemu_binary_"  + self.qemu_id
+        """ slaves share the binary published by the core, standalone VMs publish their own """
+        self.owns_binary = binary_filename is None
+        if self.owns_binary:
+            binary_filename = publish_binary(self.config.argument_values['executable'],
+                                             "/dev/shm/kafl_qemu_binary_%s_%x" % (self.qemu_id, id(self)))
+        self.binary_filename    = binary_filename
         self.argv_filename      = "/dev/shm/kafl_argv_"         + self.qemu_id
         self.bitmap_filename    = "/dev/shm/kafl_bitmap_"       + self.qemu_id
 
@@ -283,8 +341,9 @@ class qemu:
         self.redqueen_workdir = RedqueenWorkdir(self.qemu_id)
         self.redqueen_workdir.init_dir()
 
-        self.start_ticks = 0
-        self.end_ticks = 0
+        """ monotonic clock in ns and the latency of the last execution """
+        self.clock = get_nativ().monotonic_ns
+        self.exec_ns = 0
         self.tick_timeout_treshold = self.config.config_values["TIMEOUT_TICK_FACTOR"]
 
         self.cmd =  self.config.config_values['QEMU_KAFL_LOCATION'] + " " 
@@ -359,16 +418,12 @@ class qemu:
         self.shm_problem = False
         self.initial_mem_usage = 0
 
-        self.stat_fd = None
-
         if qid == 0 or qid == 1337:
             log_qemu("Launching Virtual Maschine...CMD:\n" + self.cmd.replace("BOOTPARAM", "nokaslr oops=panic nopti"), self.qemu_id)
         else:
             log_qemu("Launching Virtual Maschine...", self.qemu_id)
         self.virgin_bitmap = ''.join(chr(0xff) for x in range(self.bitmap_size))
 
-        self.__set_binary(self.binary_filename, self.config.argument_values['executable'], (128 << 20))
-
         self.cmd = self.cmd.split(" ")
         c = 0
         for i in self.cmd:
@@ -378,9 +433,22 @@ class qemu:
             c+=1
 
     def __del__(self):
+        self.shutdown()
 
+    def shutdown(self):
+        """ kills the VM and releases its resources, later calls do nothing """
+        if self.down:
+            return
+        self.down = True
 
-        os.system("kill -9 " + str(self.process.pid))
+        if self.owns_binary:
+            try:
+                os.remove(self.binary_filename)
+            except OSError:
+                pass
+
+        if self.process:
+            os.system("kill -9 " + str(self.process.pid))
 
         try:
             if self.process:
@@ -418,12 +486,6 @@ class qemu:
         except:
             pass
 
-        try:
-            if self.stat_fd:
-                self.stat_fd.close()
-        except:
-            pass
-
         try:
             self.global_bitmap.close()
         except:
@@ -434,36 +496,8 @@ class qemu:
         except:
             pass
 
-    def __get_pid_guest_ticks(self):
-        if self.stat_fd:
-            self.stat_fd.seek(0)
-            self.stat_fd.flush()
-            return int(self.stat_fd.readline().split(" ")[42])
-        return 0
-
-    def __set_binary(self, filename, binaryfile, max_size):
-        shm_fd = os.open(filename, os.O_RDWR | os.O_SYNC | os.O_CREAT)
-        os.ftruncate(shm_fd, max_size)
-        shm = mmap.mmap(shm_fd, max_size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
-        shm.seek(0x0)
-        shm.write('\x00' * max_size)
-        shm.seek(0x0)
-
-        f = open(binaryfile, "rb")
-        bytes = f.read(1024)
-        if bytes:
-            shm.write(bytes)
-        while bytes != "":
-            bytes = f.read(1024)
-            if bytes:
-                shm.write(bytes)
-
-        shm.flush()
-        f.close()
-        shm.close()
-        os.close(shm_fd)
-
     def set_tick_timeout_treshold(self, treshold):
+        """ treshold: execution latency in ns """
         self.tick_timeout_treshold = treshold
 
     def start(self, verbose=False, payload=None):
@@ -478,11 +512,11 @@ class qemu:
                                             stdout=subprocess.PIPE,
                                             stderr=None)
 
-        self.stat_fd = open("/proc/" + str(self.process.pid) + "/stat")
-        self.init()
         try:
+            self.init()
             self.set_init_state(payload=payload)
         except:
+            log_qemu("VM start failed: %s" % traceback.format_exc(), self.qemu_id)
             return False
         self.initial_mem_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
         self.kafl_shm.seek(0x0)
@@ -495,10 +529,7 @@ class qemu:
         self.kasan = False
         self.handshake_stage_1 = True
         self.handshake_stage_2 = True
-        self.start_ticks = 0
-        self.end_ticks = 0
-        
-        self.__set_binary(self.binary_filename, self.config.argument_values['executable'], (128 << 20))
+        self.exec_ns = 0
 
         self.__debug_recv_expect(qemu_protocol.RELEASE+qemu_protocol.PT_TRASHED)
         log_qemu("Initial stage 1 handshake done...", self.qemu_id)
@@ -514,14 +545,24 @@ class qemu:
 
     def init(self):
         self.control = safe_socket(socket.AF_UNIX)
+        self.control_buffer = ""
+        self.control_buffer_pos = 0
         self.control.settimeout(None)
         self.control.setblocking(1)
+        """ the socket appears once QEMU is up, back off instead of spinning """
+        deadline = time.time() + self.CONNECT_TIMEOUT
+        delay = 0.001
         while True:
             try:
                 self.control.connect(self.control_filename)
                 break
             except socket_error:
-                pass
+                if self.process and self.process.poll() is not None:
+                    raise Exception("QEMU exited with %d before accepting connections" % self.process.returncode)
+                if time.time() >= deadline:
+                    raise Exception("QEMU control socket not available after %ds" % self.CONNECT_TIMEOUT)
+                time.sleep(delay)
+                delay = min(delay * 2, self.CONNECT_BACKOFF)
 
         self.kafl_shm_f     = os.open(self.bitmap_filename, os.O_RDWR | os.O_SYNC | os.O_CREAT)
         self.fs_shm_f       = os.open(self.payload_filename, os.O_RDWR | os.O_SYNC | os.O_CREAT)
@@ -529,7 +570,9 @@ class qemu:
         os.ftruncate(self.fs_shm_f, (128 << 10))
 
         self.kafl_shm       = mmap.mmap(self.kafl_shm_f, self.bitmap_size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        self.kafl_shm_address = ctypes.addressof(ctypes.c_uint8.from_buffer(self.kafl_shm))
         self.fs_shm         = mmap.mmap(self.fs_shm_f, (128 << 10),  mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        self.fs_shm_address = ctypes.addressof(ctypes.c_uint8.from_buffer(self.fs_shm))
 
         return True
 
@@ -574,54 +617,82 @@ class qemu:
         return delta
 
 
-    def send_payload(self, apply_patches=True, timeout_detection=True, max_iterations=10):
+    def send_payload(self, apply_patches=True, timeout_detection=True, max_iterations=PT_RETRIES, view=False):
+        """
+        Executes the current payload and returns the bitmap, None if the
+        bitmap shm is unusable (self.shm_problem). With view=True the bitmap
+        is a buffer over the bitmap shm instead of a copy, it is only valid
+        until the next execution.
+        Runs with a trashed PT buffer are repeated right away, up to
+        max_iterations times, afterwards self.trashed is set and the bitmap
+        must not be trusted.
+        """
+        self.trashed = False
+        retry = 0
+        while True:
+            start_ns = self.clock()
+            patch_cmd = self.__set_patches(apply_patches)
+            if patch_cmd:
+                self.__debug_send(patch_cmd, qemu_protocol.RELEASE)
+                self.__debug_recv_expect(patch_cmd)
+            else:
+                self.__debug_send(qemu_protocol.RELEASE)
 
-        if apply_patches:
-            self.send_enable_patches()
-        else:
-            self.send_disable_patches()
-        self.__debug_send(qemu_protocol.RELEASE)
+            self.crashed = False
+            self.timeout = False
+            self.kasan = False
 
-        self.crashed = False
-        self.timeout = False
-        self.kasan = False
+            value = self.check_recv(timeout_detection=timeout_detection)
+            if value == 1:
+                self.crashed = True
+                self.__debug_recv_expect(qemu_protocol.ACQUIRE)
+            elif value == 2:
+                self.timeout = True
+                self.__debug_print_timeout()
 
-        repeat = False
-        value = self.check_recv(timeout_detection=timeout_detection)
-        if value == 1:
-            self.crashed = True
-            self.__debug_recv_expect(qemu_protocol.ACQUIRE)
-        elif value == 2:
-            self.timeout = True
-            self.__debug_print_timeout()
-
-            cmd = self.__debug_recv()
-            self.__debug_recv_expect(qemu_protocol.ACQUIRE)
-
-        elif value == 3:
-            self.kasan = True
-            self.__debug_recv_expect(qemu_protocol.ACQUIRE)
-        elif value == 7:
-            self.timeout= True
-
-        elif value == 4:
-            repeat = True
-        elif value == 5:
-            repeat = True
-            self.soft_reload()
-        elif value == 6:
-            repeat = True
-            self.soft_reload()
+                cmd = self.__debug_recv()
+                self.__debug_recv_expect(qemu_protocol.ACQUIRE)
 
-        self.needs_execution_for_patches = False
+            elif value == 3:
+                self.kasan = True
+                self.__debug_recv_expect(qemu_protocol.ACQUIRE)
+            elif value == 7:
+                self.timeout= True
+
+            self.exec_ns = self.clock() - start_ns
+            self.needs_execution_for_patches = False
 
-        if repeat:
-            if max_iterations != 0:
-                self.send_payload(apply_patches=apply_patches, timeout_detection=timeout_detection, max_iterations=0)
-                return self.send_payload(apply_patches=apply_patches, timeout_detection=timeout_detection, max_iterations=max_iterations-1)
+            if value not in (4, 5, 6):
+                break
+            if retry >= max_iterations:
+                log_qemu("PT buffer trashed by %d runs in a row" % (retry + 1), self.qemu_id)
+                self.trashed = True
+                break
+            retry += 1
+            self.pt_retry_counter += 1
+
+        self.shm_problem = not self.__bitmap_shm_ok()
+        if self.shm_problem:
+            log_qemu("Bitmap shm is not mapped", self.qemu_id)
+            return None
+        if view:
+            return buffer(self.kafl_shm, 0, self.bitmap_size)
         self.kafl_shm.seek(0x0)
         return self.kafl_shm.read(self.bitmap_size)
 
+    def __bitmap_shm_ok(self):
+        try:
+            return self.kafl_shm is not None and len(self.kafl_shm) >= self.bitmap_size
+        except ValueError:
+            """ closed mmap """
+            return False
+
+    def get_bitmap_hash(self, bitmap):
+        """ mmh3.hash64 of a bitmap, views of send_payload() are hashed in the shm """
+        if isinstance(bitmap, buffer):
+            return hash64(self.kafl_shm_address, self.bitmap_size)
+        return hash64(bitmap, len(bitmap))
+
     def enable_sampling_mode(self):
         self.__debug_send(qemu_protocol.ENABLE_SAMPLING)
 
@@ -690,13 +761,22 @@ class qemu:
         self.fs_shm.write_byte(input_len[1])
         self.fs_shm.write_byte(input_len[0])
 
-    def copy_master_payload(self, shm, num, size):
-        self.fs_shm.seek(0)
-        shm.seek(size * num)
-        payload = shm.read(size)
-        self.fs_shm.write(payload)
-        self.fs_shm.write(''.join(chr(0x00) for x in range((64 << 10)-size)))
-        return payload, size
+    def copy_job_payload(self, job_ring, num):
+        return job_ring.copy_slot(num, self.fs_shm_address)
+
+    def __get_payload_hash(self, payload_size):
+        return hash64(self.fs_shm_address + 4, payload_size)
+
+    def quarantine_payload(self, payload_size):
+        """ keeps the current payload (of a trashed run) from being executed again """
+        self.lookup.pt_quarantine.add(self.__get_payload_hash(payload_size))
+        self.lookup.pt_quarantined.value = True
+        self.pt_quarantine_counter += 1
+
+    def is_quarantined(self, job_ring, num):
+        if not self.lookup.pt_quarantined.value:
+            return False
+        return self.__get_payload_hash(self.copy_job_payload(job_ring, num)) in self.lookup.pt_quarantine
 
     def copy_mapserver_payload(self, shm, num, size):
         self.fs_shm.seek(0)
@@ -769,13 +849,14 @@ class qemu:
         return False
 
     
-    def copy_bitmap(self, shm, num, size, bitmap, payload, payload_size, effector_mode_hash=None, apply_patches=True):
+    def copy_bitmap(self, shm, num, size, bitmap, payload, payload_size, effector_mode_hash=None, apply_patches=True, bitmap_hash=None):
+        """ copies bitmap to the slot num of shm unless its hash is known, bitmap may be a view of send_payload() """
         if self.crashed or self.kasan or self.timeout:
             shm.seek(size * num)
             shm.write(bitmap)
             return True
 
-        new_hash = mmh3.hash64(bitmap)
+        new_hash = bitmap_hash or self.get_bitmap_hash(bitmap)
 
         if effector_mode_hash and effector_mode_hash != new_hash:
             shm.seek(size * num)
@@ -786,6 +867,12 @@ class qemu:
             shm.seek((size * num) + len(bitmap))
             return False
 
+        """ the mapserver has already seen it (the lookup set above starts over once it is full) """
+        if not self.lookup.preliminary.value and new_hash in self.bitmap_hashes:
+            self.lookup.set_value(new_hash)
+            shm.seek((size * num) + len(bitmap))
+            return False
+
         if not (self.timeout) and not self.check_for_unseen_bits(bitmap):
             self.lookup.set_value(new_hash)
             return False
@@ -0,0 +1,260 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de> 
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de> 
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>. 
+"""
+
+import ctypes
+import inspect
+import mmap
+import os
+import struct
+from ctypes import c_uint64, c_uint8, c_bool, c_void_p
+
+import mmh3
+
+from common.util import Singleton
+
+__author__ = 'Cornelius Aschermann'
+
+
+def load_native():
+    lib = ctypes.CDLL(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/../fuzzer/native/bitmap.so')
+    lib.shm_set_size.argtypes = [c_uint64]
+    lib.shm_set_size.restype = c_uint64
+    lib.shm_set_init.argtypes = [c_void_p, c_uint64]
+    lib.shm_set_init.restype = None
+    lib.shm_set_clear.argtypes = [c_void_p]
+    lib.shm_set_clear.restype = None
+    lib.shm_set_contains.argtypes = [c_void_p, c_uint64]
+    lib.shm_set_contains.restype = c_bool
+    lib.shm_set_insert.argtypes = [c_void_p, c_uint64]
+    lib.shm_set_insert.restype = c_bool
+    lib.digest_set_size.argtypes = [c_uint64]
+    lib.digest_set_size.restype = c_uint64
+    lib.digest_set_init.argtypes = [c_void_p, c_uint64]
+    lib.digest_set_init.restype = None
+    lib.digest_set_contains.argtypes = [c_void_p, c_uint64, c_uint64]
+    lib.digest_set_contains.restype = c_bool
+    lib.digest_set_insert.argtypes = [c_void_p, c_uint64, c_uint64]
+    lib.digest_set_insert.restype = c_uint8
+    lib.digest_set_export.argtypes = [c_void_p, c_void_p]
+    lib.digest_set_export.restype = c_uint64
+    lib.bloom_size.argtypes = [c_uint64]
+    lib.bloom_size.restype = c_uint64
+    lib.bloom_init.argtypes = [c_void_p, c_uint64]
+    lib.bloom_init.restype = None
+    lib.bloom_insert.argtypes = [c_void_p, c_uint64, c_uint64]
+    lib.bloom_insert.restype = None
+    lib.bloom_contains.argtypes = [c_void_p, c_uint64, c_uint64]
+    lib.bloom_contains.restype = c_bool
+    return lib
+
+
+def hash_key(value):
+    """ folds a mmh3.hash64 tuple (or any integer) into an unsigned 64-bit key """
+    if isinstance(value, tuple):
+        value = value[0]
+    return value & 0xFFFFFFFFFFFFFFFF
+
+
+class SharedHashSet:
+    """
+    Fixed-capacity set of 64-bit keys in /dev/shm. Inserts and lookups are
+    lock-free (compare-and-swap in the native library) and clear() is O(1).
+    The set behaves like a cache: once it fills up, it starts over.
+    Create it in the parent process, forked children share the mapping.
+    """
+
+    native = None
+
+    def __init__(self, name, capacity=1 << 20):
+        if not SharedHashSet.native:
+            SharedHashSet.native = load_native()
+        assert capacity & (capacity - 1) == 0, "capacity has to be a power of two"
+
+        self.filename = "/dev/shm/kafl_set_" + name
+        self.size = SharedHashSet.native.shm_set_size(capacity)
+
+        fd = os.open(self.filename, os.O_RDWR | os.O_SYNC | os.O_CREAT)
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.size)
+        self.shm = mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        os.close(fd)
+
+        self.buffer = (ctypes.c_uint8 * self.size).from_buffer(self.shm)
+        self.address = ctypes.addressof(self.buffer)
+        SharedHashSet.native.shm_set_init(self.address, capacity)
+
+    def add(self, key):
+        return SharedHashSet.native.shm_set_insert(self.address, hash_key(key))
+
+    def clear(self):
+        SharedHashSet.native.shm_set_clear(self.address)
+
+    def __contains__(self, key):
+        return SharedHashSet.native.shm_set_contains(self.address, hash_key(key))
+
+
+def digest_key(digest):
+    """ (high, low) unsigned words of a 128-bit mmh3.hash64 tuple """
+    return digest[0] & 0xFFFFFFFFFFFFFFFF, digest[1] & 0xFFFFFFFFFFFFFFFF
+
+
+def payload_digest(payload):
+    return mmh3.hash64(payload)
+
+
+class SharedDigestSet:
+    """
+    Exact set of 128-bit digests in /dev/shm. Only one process may add
+    digests, any number of processes may look them up at the same time.
+    add() returns None once the set is three quarters full, callers have to
+    keep track of further digests themselves.
+    Create it in the parent process, forked children share the mapping.
+    """
+
+    native = None
+
+    def __init__(self, name, capacity=1 << 20):
+        if not SharedDigestSet.native:
+            SharedDigestSet.native = load_native()
+        assert capacity & (capacity - 1) == 0, "capacity has to be a power of two"
+
+        self.filename = "/dev/shm/kafl_digests_" + name
+        self.size = SharedDigestSet.native.digest_set_size(capacity)
+
+        fd = os.open(self.filename, os.O_RDWR | os.O_SYNC | os.O_CREAT)
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.size)
+        self.shm = mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        os.close(fd)
+
+        self.buffer = (ctypes.c_uint8 * self.size).from_buffer(self.shm)
+        self.address = ctypes.addressof(self.buffer)
+        SharedDigestSet.native.digest_set_init(self.address, capacity)
+
+    def add(self, digest):
+        """ True if digest is new, False if it is known and None if the set is full """
+        result = SharedDigestSet.native.digest_set_insert(self.address, *digest_key(digest))
+        if result == 2:
+            return None
+        return result == 1
+
+    def __contains__(self, digest):
+        return SharedDigestSet.native.digest_set_contains(self.address, *digest_key(digest))
+
+    def __len__(self):
+        return struct.unpack_from("<Q", self.shm, 0)[0]
+
+    def export(self):
+        """ all digests as packed (high, low) int64 pairs """
+        digests = (c_uint64 * (2 * len(self)))()
+        count = SharedDigestSet.native.digest_set_export(self.address, digests)
+        return buffer(digests)[:count * 16]
+
+
+class SharedDigestFilter(SharedDigestSet):
+    """
+    SharedDigestSet behind a blocked bloom filter: lookups of unknown digests
+    touch a single cache line instead of probing the set.
+    """
+
+    """ 512 bit bloom filter block per 32 slots of the set """
+    SLOTS_PER_BLOCK = 32
+
+    def __init__(self, name, capacity=1 << 20):
+        SharedDigestSet.__init__(self, name, capacity)
+        blocks = max(1, capacity / self.SLOTS_PER_BLOCK)
+
+        self.bloom_filename = "/dev/shm/kafl_bloom_" + name
+        self.bloom_size = SharedDigestSet.native.bloom_size(blocks)
+
+        fd = os.open(self.bloom_filename, os.O_RDWR | os.O_SYNC | os.O_CREAT)
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.bloom_size)
+        self.bloom_shm = mmap.mmap(fd, self.bloom_size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        os.close(fd)
+
+        self.bloom_buffer = (ctypes.c_uint8 * self.bloom_size).from_buffer(self.bloom_shm)
+        self.bloom_address = ctypes.addressof(self.bloom_buffer)
+        SharedDigestSet.native.bloom_init(self.bloom_address, blocks)
+
+    def add(self, digest):
+        key = digest_key(digest)
+        result = SharedDigestSet.add(self, digest)
+        if result:
+            """ set the filter bits last, readers check them first """
+            SharedDigestSet.native.bloom_insert(self.bloom_address, *key)
+        return result
+
+    def __contains__(self, digest):
+        key = digest_key(digest)
+        if not SharedDigestSet.native.bloom_contains(self.bloom_address, *key):
+            return False
+        return SharedDigestSet.native.digest_set_contains(self.address, *key)
+
+
+class PayloadIndex:
+    """
+    Digests of every payload in the corpus. The mapserver adds them, the
+    master uses them to skip known payloads before they are executed.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.digests = SharedDigestSet("payloads", capacity=1 << 21)
+
+    def add(self, digest):
+        return self.digests.add(digest)
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+
+class BitmapHashIndex:
+    """
+    Hashes of every bitmap the mapserver has evaluated outside of the
+    preliminary mode, whether it became a node or not. Slaves look them up
+    to drop results the mapserver would discard anyway. Only the mapserver
+    adds hashes, the ones that do not fit into the shared set stay local.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self.hashes = SharedDigestFilter("bitmaps", capacity=1 << 21)
+        self.overflow = set()
+
+    def add(self, bitmap_hash):
+        if self.hashes.add(bitmap_hash) is None:
+            self.overflow.add(bitmap_hash)
+
+    def __contains__(self, bitmap_hash):
+        return bitmap_hash in self.hashes or bitmap_hash in self.overflow
+
+    def __len__(self):
+        return len(self.hashes) + len(self.overflow)
+
+    def save_data(self):
+        """ packed (high, low) int64 pairs """
+        values = [value for pair in self.overflow for value in pair]
+        return self.hashes.export() + struct.pack("<%dq" % len(values), *values)
+
+    def load_data(self, data):
+        values = struct.unpack("<%dq" % (len(data) / 8), data)
+        for bitmap_hash in zip(values[0::2], values[1::2]):
+            self.add(bitmap_hash)
@@ -514,10 +514,20 @@ class FuzzerUI():
         return " " + self.VRLINE + (25 * self.HLINE) + self.HR + (23 * self.HLINE) + self.HR + (16 * self.HLINE) + self.VLLINE + "\n"
 
     def __get_ui_line14(self):
-        return " " + self.VLINE + " Target: " + self.target_name + " " + self.VLINE + "\n"
+        quarantined = self.state.sum_slaves("pt_quarantined")
+        if quarantined != 0:
+            trashed = self.__get_printable_integer(self.state.sum_slaves("pt_trashed")) + " " + \
+                      self.__get_printable_integer(quarantined, brackets=True, color=(self.WARNING + self.BOLD))
+        else:
+            trashed = self.__get_printable_integer(self.state.sum_slaves("pt_trashed")) + " " + \
+                      self.__get_printable_integer(0, brackets=True)
+        return " " + self.VLINE + " Target: " + self.target_name + " " + self.VLINE + " PT Trash: " + trashed + \
+               " " + self.VLINE + " Retries:  " + self.__get_printable_integer(self.state.sum_slaves("pt_retries")) + \
+               " " + self.VLINE + "\n"
 
     def __get_ui_line15(self):
-        return " " + self.LBEDGE + (25 * self.HLINE) + self.RBEDGE + "\n" \
+        return " " + self.LBEDGE + (25 * self.HLINE) + self.HULINE + (23 * self.HLINE) + self.HULINE + \
+               (16 * self.HLINE) + self.RBEDGE + "\n" \
                + "\n" + (47 * ' ') + "\n"  + "\n"  + self.__hexdump(self.state["payload"][0:0x60], max_length=0x60) + "\n"
 
 
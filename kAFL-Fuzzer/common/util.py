@@ -107,16 +107,8 @@ def check_if_old_state_exits(working_directory):
         logger("[MISC]\t\tError 3 (config.json does not exist)...")
         return False
 
-    if not os.path.exists(working_directory + "/tree.json"):
-        logger("[MISC]\t\tError 4 (tree.json does not exist)...")
-        return False
-
-    if not os.path.exists(working_directory + "/master.json"):
-        logger("[MISC]\t\tError 5 (master.json does not exist)...")
-        return False
-
-    if not os.path.exists(working_directory + "/mapserver.json"):
-        logger("[MISC]\t\tError 6 (mapserver.json does not exist)...")
+    if not os.path.exists(working_directory + "/snapshot.bin"):
+        logger("[MISC]\t\tError 4 (snapshot.bin does not exist)...")
         return False
 
     return True
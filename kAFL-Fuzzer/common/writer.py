@@ -0,0 +1,148 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import atexit
+import os
+import Queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from common.debug import logger
+from common.util import Singleton
+
+
+class AsyncWriter:
+    """
+    Background writer for corpus and evaluation files of the current process.
+    Requests are queued in order (the queue is bounded, so a stalled disk
+    eventually throttles the producer) and committed in groups: every file
+    of a group is written first and synced once at the end of the group
+    (only the last version of a file that is replaced several times),
+    append-only logs stay open and are synced once per group as well.
+    Files become visible through an atomic rename, readers in other
+    processes must wait for flush() before they rely on a file.
+    """
+    __metaclass__ = Singleton
+
+    QUEUE_SIZE = 4096
+    GROUP_SIZE = 256
+    GROUP_TIMEOUT = 0.05
+
+    WRITE, APPEND, REMOVE, FLUSH = range(4)
+
+    def __init__(self):
+        self.queue = Queue.Queue(self.QUEUE_SIZE)
+        self.logs = {}
+        self.thread = threading.Thread(target=self.__run, name="AsyncWriter")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, filename, data):
+        """ replaces filename with data """
+        self.queue.put((self.WRITE, filename, data))
+
+    def append(self, filename, data):
+        self.queue.put((self.APPEND, filename, data))
+
+    def remove(self, filename):
+        self.queue.put((self.REMOVE, filename, None))
+
+    def flush(self):
+        """ blocks until every request queued so far is on disk """
+        done = threading.Event()
+        self.queue.put((self.FLUSH, None, done))
+        while not done.wait(1.0):
+            if not self.thread.is_alive():
+                return
+
+    def close(self):
+        if self.thread.is_alive():
+            self.flush()
+        for f in self.logs.values():
+            f.close()
+        self.logs = {}
+
+    def __collect(self):
+        group = [self.queue.get()]
+        deadline = time.time() + self.GROUP_TIMEOUT
+        while len(group) < self.GROUP_SIZE and group[-1][0] != self.FLUSH:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                group.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return group
+
+    def __run(self):
+        while True:
+            group = self.__collect()
+            try:
+                self.__commit(group)
+            except:
+                logger("[WRITER]\tCommit failed: " + traceback.format_exc())
+            for kind, _, data in group:
+                if kind == self.FLUSH:
+                    data.set()
+
+    def __commit(self, group):
+        pending = OrderedDict()
+        dirty_logs = set()
+        for kind, filename, data in group:
+            if kind == self.WRITE:
+                pending.pop(filename, None)
+                pending[filename] = data
+            elif kind == self.APPEND:
+                f = self.logs.get(filename)
+                if not f:
+                    f = open(filename, 'ab')
+                    self.logs[filename] = f
+                f.write(data)
+                dirty_logs.add(f)
+            elif kind == self.REMOVE:
+                """ the file may still be part of this group """
+                self.__sync(pending, dirty_logs)
+                pending = OrderedDict()
+                dirty_logs = set()
+                try:
+                    os.remove(filename)
+                except OSError:
+                    logger("[WRITER]\tCannot remove " + filename)
+        self.__sync(pending, dirty_logs)
+
+    def __sync(self, pending, dirty_logs):
+        for f in dirty_logs:
+            f.flush()
+            os.fsync(f.fileno())
+        files = []
+        for filename, data in pending.items():
+            tmp_file = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename) + ".tmp")
+            f = open(tmp_file, 'wb')
+            f.write(data)
+            files.append((f, tmp_file, filename))
+        for f, tmp_file, filename in files:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp_file, filename)
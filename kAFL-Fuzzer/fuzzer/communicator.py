@@ -18,23 +18,254 @@ You should have received a copy of the GNU Affero General Public License
 along with Redqueen.  If not, see <http://www.gnu.org/licenses/>. 
 """
 
+import cPickle
+import collections
+import ctypes
+import errno
+import fcntl
 import multiprocessing
 import os
 import mmap
+import select
+import struct
 import Queue
 from common.debug import logger
+from fuzzer.protocol import pack_data, unpack_data
+
+F_SETPIPE_SZ = 1031
+
+
+class Channel:
+    """
+    Message pipe with a fixed binary header (length, tag, encoding, source).
+    Hot tags are struct-packed by fuzzer.protocol, everything else is
+    pickled. It provides the put/get/empty subset of multiprocessing.Queue
+    used by send_msg/recv_msg. Writers may live in several processes and
+    serialize on a lock, there is exactly one reading process.
+    """
+
+    HEADER = struct.Struct("<IBBh")
+    ENCODING_BINARY = 0
+    ENCODING_PICKLE = 1
+
+    def __init__(self, pipe_size=(1 << 20)):
+        self.read_fd, self.write_fd = os.pipe()
+        self.write_lock = multiprocessing.Lock()
+        try:
+            fcntl.fcntl(self.write_fd, F_SETPIPE_SZ, pipe_size)
+        except IOError:
+            pass
+
+    def __write(self, data):
+        view = buffer(data)
+        while view:
+            try:
+                written = os.write(self.write_fd, view)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            view = buffer(view, written)
+
+    def __read(self, size):
+        chunks = []
+        while size:
+            try:
+                chunk = os.read(self.read_fd, size)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                raise EOFError("channel closed")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def __wait(self, timeout):
+        while True:
+            try:
+                return bool(select.select([self.read_fd], [], [], timeout)[0])
+            except select.error as e:
+                if e[0] != errno.EINTR:
+                    raise
+
+    def empty(self):
+        return not self.__wait(0)
+
+    def put(self, msg):
+        body = pack_data(msg.tag, msg.data)
+        if body is None:
+            encoding = Channel.ENCODING_PICKLE
+            body = cPickle.dumps(msg.data, cPickle.HIGHEST_PROTOCOL)
+        else:
+            encoding = Channel.ENCODING_BINARY
+        source = -1 if msg.source is None else msg.source
+        header = Channel.HEADER.pack(len(body), msg.tag, encoding, source)
+        with self.write_lock:
+            self.__write(header + body)
+
+    def get(self, timeout=None):
+        if timeout is not None and not self.__wait(timeout):
+            raise Queue.Empty
+        length, tag, encoding, source = Channel.HEADER.unpack(self.__read(Channel.HEADER.size))
+        body = self.__read(length)
+        if encoding == Channel.ENCODING_BINARY:
+            data = unpack_data(tag, body)
+        else:
+            data = cPickle.loads(body)
+        return Message(tag, data, source=(None if source == -1 else source))
+
+
+
+class JobRing:
+    """
+    Single-producer/single-consumer ring of job slots in shared memory.
+    The master pushes payloads at the tail, the slave copies slots relative
+    to the head straight into the QEMU payload region and consumes them.
+    Every slot uses the same layout as the QEMU payload region: a 32-bit
+    little-endian length followed by the payload itself.
+    """
+
+    HEADER = struct.Struct("<QQII")
+    HEADER_SIZE = 64
+    SLOT_LENGTH = struct.Struct("<I")
+
+    def __init__(self, filename, capacity, slot_size):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.size = JobRing.HEADER_SIZE + (capacity * slot_size)
+
+        shm_fd = os.open(filename, os.O_RDWR | os.O_SYNC)
+        self.shm = mmap.mmap(shm_fd, self.size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        os.close(shm_fd)
+        self.address = ctypes.addressof(ctypes.c_uint8.from_buffer(self.shm))
+
+    @staticmethod
+    def create(filename, capacity, slot_size):
+        shm_fd = os.open(filename, os.O_CREAT | os.O_RDWR | os.O_SYNC)
+        os.ftruncate(shm_fd, 0)
+        os.ftruncate(shm_fd, JobRing.HEADER_SIZE + (capacity * slot_size))
+        os.write(shm_fd, JobRing.HEADER.pack(0, 0, capacity, slot_size))
+        os.close(shm_fd)
+
+    def __get_indices(self):
+        return JobRing.HEADER.unpack_from(self.shm, 0)[:2]
+
+    def __slot_offset(self, index):
+        return JobRing.HEADER_SIZE + ((index % self.capacity) * self.slot_size)
+
+    def pending(self):
+        head, tail = self.__get_indices()
+        return tail - head
+
+    def push(self, payload):
+        head, tail = self.__get_indices()
+        assert tail - head < self.capacity, "job ring overflow"
+        payload = payload[:self.slot_size - JobRing.SLOT_LENGTH.size]
+        offset = self.__slot_offset(tail)
+        JobRing.SLOT_LENGTH.pack_into(self.shm, offset, len(payload))
+        offset += JobRing.SLOT_LENGTH.size
+        self.shm[offset:offset + len(payload)] = payload
+        struct.pack_into("<Q", self.shm, 8, tail + 1)
+
+    def push_batch(self, batch):
+        head, tail = self.__get_indices()
+        assert tail - head + len(batch) <= self.capacity, "job ring overflow"
+        for i in xrange(len(batch)):
+            ctypes.memmove(self.address + self.__slot_offset(tail + i), batch.slot_address(i), batch.slot_length(i))
+        struct.pack_into("<Q", self.shm, 8, tail + len(batch))
+
+    def copy_slot(self, num, address):
+        """ copies the num-th pending slot (length + payload) to address; returns the payload length """
+        head, tail = self.__get_indices()
+        assert num < tail - head, "job ring underflow"
+        offset = self.__slot_offset(head + num)
+        length = JobRing.SLOT_LENGTH.unpack_from(self.shm, offset)[0]
+        ctypes.memmove(address, self.address + offset, JobRing.SLOT_LENGTH.size + length)
+        return length
+
+    def read_slot(self, num):
+        head, tail = self.__get_indices()
+        assert num < tail - head, "job ring underflow"
+        offset = self.__slot_offset(head + num)
+        length = JobRing.SLOT_LENGTH.unpack_from(self.shm, offset)[0]
+        offset += JobRing.SLOT_LENGTH.size
+        return self.shm[offset:offset + length]
+
+    def consume(self, num):
+        head, tail = self.__get_indices()
+        assert num <= tail - head, "job ring underflow"
+        struct.pack_into("<Q", self.shm, 0, head + num)
+
+
+class JobBatch:
+    """
+    Master-side staging area for one batch of jobs, using the slot layout of
+    JobRing. Payloads are appended one by one or written in place by native
+    stage generators (see write_address/commit).
+    """
+
+    def __init__(self, capacity, slot_size):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.buffer = bytearray(capacity * slot_size)
+        self.address = ctypes.addressof(ctypes.c_uint8.from_buffer(self.buffer))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def free(self):
+        return self.capacity - self.count
+
+    def append(self, payload):
+        assert self.count < self.capacity, "job batch overflow"
+        payload = payload[:self.slot_size - JobRing.SLOT_LENGTH.size]
+        offset = self.count * self.slot_size
+        JobRing.SLOT_LENGTH.pack_into(self.buffer, offset, len(payload))
+        offset += JobRing.SLOT_LENGTH.size
+        self.buffer[offset:offset + len(payload)] = payload
+        self.count += 1
+
+    def append_from(self, address, length):
+        """ copies length bytes at address into the next slot """
+        assert self.count < self.capacity, "job batch overflow"
+        length = min(length, self.slot_size - JobRing.SLOT_LENGTH.size)
+        offset = self.count * self.slot_size
+        JobRing.SLOT_LENGTH.pack_into(self.buffer, offset, length)
+        ctypes.memmove(self.address + offset + JobRing.SLOT_LENGTH.size, address, length)
+        self.count += 1
+
+    def write_address(self):
+        """ address of the first free slot """
+        return self.address + (self.count * self.slot_size)
+
+    def commit(self, num):
+        assert self.count + num <= self.capacity, "job batch overflow"
+        self.count += num
+
+    def slot_address(self, num):
+        return self.address + (num * self.slot_size)
+
+    def slot_length(self, num):
+        return JobRing.SLOT_LENGTH.size + JobRing.SLOT_LENGTH.unpack_from(self.buffer, num * self.slot_size)[0]
+
+    def clear(self):
+        self.count = 0
+
 
 class Communicator:
     def __init__(self, num_processes=1, tasks_per_requests=1, bitmap_size=(64 << 10)):
         self.to_update_queue = multiprocessing.Queue()
-        self.to_master_queue = multiprocessing.Queue()
+        self.to_master_queue = Channel()
         self.to_master_from_mapserver_queue = multiprocessing.Queue()
         self.to_master_from_slave_queue = multiprocessing.Queue()
-        self.to_mapserver_queue = multiprocessing.Queue()
+        self.to_mapserver_queue = Channel()
 
         self.to_slave_queues = []
         for i in range(num_processes):
-            self.to_slave_queues.append(multiprocessing.Queue())
+            self.to_slave_queues.append(Channel())
 
         self.slave_locks_A = []
         self.slave_locks_B = []
@@ -54,13 +285,18 @@ class Communicator:
         self.effector_mode_hash_a = multiprocessing.Value('l', 0)
         self.effector_mode_hash_b = multiprocessing.Value('l', 0)
 
+        """ shm file of the target binary, shared by the VMs of all slaves """
+        self.binary_filename = None
+
 
         self.files = ["/dev/shm/kafl_fuzzer_master_", "/dev/shm/kafl_fuzzer_mapserver_", "/dev/shm/kafl_fuzzer_bitmap_"]
         self.sizes = [(65 << 10), (65 << 10), bitmap_size]
         self.tmp_shm = [{}, {}, {}]
 
-    def get_master_payload_shm(self, slave_id):
-        return self.__get_shm(0, slave_id)
+    def get_job_ring(self, slave_id):
+        if slave_id not in self.tmp_shm[0]:
+            self.tmp_shm[0][slave_id] = JobRing(self.files[0] + str(slave_id), self.tasks_per_requests, self.sizes[0])
+        return self.tmp_shm[0][slave_id]
 
     def get_mapserver_payload_shm(self, slave_id):
         return self.__get_shm(1, slave_id)
@@ -68,7 +304,7 @@ class Communicator:
     def get_bitmap_shm(self, slave_id):
         return self.__get_shm(2, slave_id)
 
-    def get_master_payload_shm_size(self):
+    def get_job_slot_size(self):
         return self.sizes[0]
 
     def get_mapserver_payload_shm_size(self):
@@ -78,7 +314,9 @@ class Communicator:
         return self.sizes[2]
 
     def create_shm(self):
-        for j in range(len(self.files)):
+        for i in range(self.num_processes):
+            JobRing.create(self.files[0] + str(i), self.tasks_per_requests, self.sizes[0])
+        for j in range(1, len(self.files)):
             for i in range(self.num_processes):
                 shm_f = os.open(self.files[j]+str(i), os.O_CREAT | os.O_RDWR | os.O_SYNC)
                 os.ftruncate(shm_f, self.sizes[j]*self.tasks_per_requests)
@@ -100,14 +338,59 @@ class Message():
         self.data = data
         self.source = source
 
+class Mailbox:
+    """
+    Receive-side demultiplexer of a queue. Messages that arrive while a
+    specific tag is awaited are parked in per-tag deques (with their arrival
+    number) instead of being put back into the queue, so a tagged wait
+    blocks in get() and untagged receivers still see the original order.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.parked = {}
+        self.arrivals = 0
+
+    def pending(self):
+        return any(self.parked.itervalues())
+
+    def park(self, msg):
+        self.parked.setdefault(msg.tag, collections.deque()).append((self.arrivals, msg))
+        self.arrivals += 1
+
+    def pop_oldest(self):
+        oldest = None
+        for parked in self.parked.itervalues():
+            if parked and (oldest is None or parked[0][0] < oldest[0][0]):
+                oldest = parked
+        return oldest.popleft()[1]
+
+    def pop_tagged(self, tag):
+        parked = self.parked.get(tag)
+        if parked:
+            return parked.popleft()[1]
+        return None
+
+
+_mailboxes = {}
+
+def get_mailbox(queue):
+    mailbox = _mailboxes.get(id(queue))
+    if not mailbox or mailbox.queue is not queue:
+        mailbox = _mailboxes[id(queue)] = Mailbox(queue)
+    return mailbox
+
 def msg_pending(queue):
-    return queue.empty()
+    return queue.empty() and not get_mailbox(queue).pending()
 
 def send_msg(tag, data, queue, source=None):
     msg = Message(tag, data, source=source)
     queue.put(msg)
 
 def recv_msg(queue, timeout=None):
+    mailbox = get_mailbox(queue)
+    if mailbox.pending():
+        return mailbox.pop_oldest()
     if timeout:
         try:
             return queue.get(timeout=timeout)
@@ -116,13 +399,13 @@ def recv_msg(queue, timeout=None):
     return queue.get()
 
 def recv_tagged_msg(queue, tag):
-    tmp_list = []
-    tmp_obj = None
+    mailbox = get_mailbox(queue)
+    msg = mailbox.pop_tagged(tag)
+    if msg:
+        return msg
 
     while True:
-        tmp_obj = recv_msg(queue)
-        if tmp_obj.tag == tag:
-            return tmp_obj
-        else:
-            queue.put(tmp_obj)
-       
\ No newline at end of file
+        msg = queue.get()
+        if msg.tag == tag:
+            return msg
+        mailbox.park(msg)
@@ -28,12 +28,13 @@ from process.master import MasterProcess
 from process.slave import slave_loader
 from process.update import update_loader
 from common.debug import log_core, enable_logging
-from common.qemu import qemu
+from common.qemu import qemu, publish_binary
 from common.util import prepare_working_dir, copy_seed_files, print_fail, \
     check_if_old_state_exits, print_exit_msg, check_state_exists, print_pre_exit_msg, ask_for_permission, print_warning
 from common.config import FuzzerConfiguration
 from common.self_check import post_self_check
 from common.qemu import QemuLookupSet
+from common.shared_set import PayloadIndex, BitmapHashIndex
 
 
 __author__ = 'Sergej Schumilo'
@@ -74,8 +75,12 @@ def start():
 
     comm = Communicator(num_processes=num_processes, tasks_per_requests=config.argument_values['t'], bitmap_size=config.config_values["BITMAP_SHM_SIZE"])
     comm.create_shm()
+    comm.binary_filename = publish_binary(config.argument_values['executable'],
+                                          "/dev/shm/kafl_qemu_binary_%d" % os.getpid())
 
     qlookup = QemuLookupSet()
+    payload_index = PayloadIndex()
+    bitmap_hashes = BitmapHashIndex()
 
     master = MasterProcess(comm)
 
@@ -107,5 +112,6 @@ def start():
             slave.join(timeout=0.25)
             if not slave.is_alive():
                 break
+    os.remove(comm.binary_filename)
     print_exit_msg()
     return 0
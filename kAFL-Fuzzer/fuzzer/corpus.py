@@ -0,0 +1,187 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import mmap
+import os
+import struct
+
+from common.config import FuzzerConfiguration
+from common.util import Singleton
+
+
+class CorpusStore:
+    """
+    Append-only payload store of the working directory. Payloads are packed
+    into segment files and an index file maps (node type, node id) as well
+    as the payload hash to the location of the latest payload. Both are
+    mmap'd, lookups return buffer objects into the segment without copying.
+    Only the mapserver appends; the other processes pick up new index
+    records whenever a lookup misses.
+    """
+    __metaclass__ = Singleton
+
+    MAGIC = 0x4c41464b
+    VERSION = 1
+    SEGMENT_SIZE = 64 << 20
+    INDEX_GROWTH = 1 << 16
+
+    """ magic, version, number of records """
+    HEADER = struct.Struct("<IIQ")
+    """ node type, node id, payload hash, segment, offset, length """
+    RECORD = struct.Struct("<BxxxIiIII")
+    REMOVED = 0xFFFFFFFF
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = FuzzerConfiguration().argument_values['work_dir'] + "/store"
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+        self.index_fd = os.open(directory + "/index", os.O_RDWR | os.O_CREAT)
+        if os.fstat(self.index_fd).st_size == 0:
+            os.ftruncate(self.index_fd, self.HEADER.size + self.INDEX_GROWTH * self.RECORD.size)
+            os.write(self.index_fd, self.HEADER.pack(self.MAGIC, self.VERSION, 0))
+        self.index = None
+        self.__map_index()
+
+        magic, version, _ = self.HEADER.unpack_from(self.index, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("%s/index is not a corpus store index (version %d)" % (directory, self.VERSION))
+
+        self.count = 0
+        self.locations = {}
+        self.hashes = {}
+        self.segments = {}
+
+        self.refresh()
+
+        self.segment = max([location[0] for location in self.locations.values()] or [0])
+        self.segment_fd = None
+        self.segment_offset = 0
+
+    def __map_index(self):
+        if self.index is not None:
+            self.index.close()
+        size = os.fstat(self.index_fd).st_size
+        self.index = mmap.mmap(self.index_fd, size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+
+    def __segment_file(self, segment):
+        return self.directory + "/segment_%04d" % segment
+
+    def __map_segment(self, segment, end):
+        segment_map = self.segments.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self.__segment_file(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+            self.segments[segment] = segment_map
+        return segment_map
+
+    def __num_records(self):
+        return self.HEADER.unpack_from(self.index, 0)[2]
+
+    def refresh(self):
+        """ reads the index records appended since the last refresh """
+        count = self.__num_records()
+        if self.HEADER.size + count * self.RECORD.size > len(self.index):
+            self.__map_index()
+        for i in xrange(self.count, count):
+            self.__apply(*self.RECORD.unpack_from(self.index, self.HEADER.size + i * self.RECORD.size))
+        self.count = count
+
+    def __apply(self, node_type, node_id, payload_hash, segment, offset, length):
+        key = (node_type, node_id)
+        if segment == self.REMOVED:
+            self.locations.pop(key, None)
+        else:
+            self.locations[key] = (segment, offset, length)
+            self.hashes[payload_hash] = key
+
+    def __append_record(self, *record):
+        end = self.HEADER.size + (self.count + 1) * self.RECORD.size
+        if end > len(self.index):
+            os.ftruncate(self.index_fd, len(self.index) + self.INDEX_GROWTH * self.RECORD.size)
+            self.__map_index()
+        self.RECORD.pack_into(self.index, end - self.RECORD.size, *record)
+        """ publish the record only after it is complete """
+        self.count += 1
+        self.HEADER.pack_into(self.index, 0, self.MAGIC, self.VERSION, self.count)
+        self.__apply(*record)
+
+    def append(self, node_type, node_id, payload_hash, payload):
+        self.refresh()
+        if self.segment_fd is None or (self.segment_offset and self.segment_offset + len(payload) > self.SEGMENT_SIZE):
+            if self.segment_fd is not None:
+                os.close(self.segment_fd)
+                self.segment += 1
+            self.segment_fd = os.open(self.__segment_file(self.segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            self.segment_offset = os.fstat(self.segment_fd).st_size
+
+        offset = self.segment_offset
+        written = 0
+        while written < len(payload):
+            written += os.write(self.segment_fd, payload[written:])
+        self.segment_offset += len(payload)
+        self.__append_record(node_type, node_id, payload_hash, self.segment, offset, len(payload))
+
+    def remove(self, node_type, node_id):
+        self.refresh()
+        if (node_type, node_id) in self.locations:
+            self.__append_record(node_type, node_id, 0, self.REMOVED, 0, 0)
+
+    def get(self, node_type, node_id):
+        """ buffer object of the payload or None if there is no such node """
+        location = self.locations.get((node_type, node_id))
+        if location is None:
+            self.refresh()
+            location = self.locations.get((node_type, node_id))
+            if location is None:
+                return None
+        segment, offset, length = location
+        if length == 0:
+            return buffer("")
+        return buffer(self.__map_segment(segment, offset + length), offset, length)
+
+    def get_by_hash(self, payload_hash):
+        self.refresh()
+        key = self.hashes.get(payload_hash)
+        if key is None or key not in self.locations:
+            return None
+        return self.get(*key)
+
+    def keys(self, node_types=None):
+        """ (node type, node id) of all stored payloads """
+        self.refresh()
+        if node_types is None:
+            return self.locations.keys()
+        return [key for key in self.locations if key[0] in node_types]
+
+    def sync(self):
+        if self.segment_fd is not None:
+            os.fsync(self.segment_fd)
+        self.index.flush()
+
+    def export(self, node_types, filename):
+        """ writes every stored payload of node_types as a loose file, filename % node_id """
+        for node_type, node_id in sorted(self.keys(node_types)):
+            with open(filename % node_id, 'wb') as f:
+                f.write(self.get(node_type, node_id))
@@ -20,7 +20,7 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
 from collections import namedtuple
-from common.util import atomic_write
+from common.writer import AsyncWriter
 
 METHODE_UNKOWN =			0
 METHODE_REDQUEEN =			1
@@ -79,7 +79,7 @@ class fuzz_yield:
 		for i in range(METHODS_NUM):
 			if(self.methods[i] > 0):
 				output += methods[i] + ":\t" + str(self.methods[i]) + "\n" 
-		atomic_write(file, output)
+		AsyncWriter().write(file, output)
 
 class fuzz_methode:
 	def __init__(self, methode_type=METHODE_UNKOWN, redqueen_cmp=None, input_byte=None, bb_delta=0):
@@ -90,11 +90,10 @@ class fuzz_methode:
 
 	def save_to_file(self, workdir_path, preliminary_id, preliminary=False):
 		if preliminary:
-			f = open((workdir_path + "/yield/preliminary/" + "/yield-" + str(preliminary_id)), "w")
+			path = workdir_path + "/yield/preliminary/" + "/yield-" + str(preliminary_id)
 		else:
-			f = open((workdir_path + "/yield/corpus/" + "/yield-" + str(preliminary_id)), "w")
-		f.write(json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4))
-		f.close()
+			path = workdir_path + "/yield/corpus/" + "/yield-" + str(preliminary_id)
+		AsyncWriter().write(path, json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4))
 
 	def read_from_file(self, workdir_path, preliminary_id, preliminary=False):
 		try:
@@ -22,6 +22,8 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 #include <stdbool.h>
 #include <stdint.h>
 #include <assert.h>
+#include <string.h>
+#include <time.h>
 
 /* Code ripped off from AFL */
 
@@ -315,3 +317,751 @@ uint8_t could_be_interest(uint32_t old_val, uint32_t new_val, uint8_t blen, uint
   return 0;
 
 }
+
+/*
+ * Lock-free set of 64-bit keys living in a shared memory segment.
+ *
+ * Open addressing with linear probing. Every slot carries a tag which is
+ * either 0 (never used), (generation << 1) while an inserter owns the slot
+ * or (generation << 1) | 1 once the key is published. Bumping the
+ * generation of the header therefore invalidates all slots at once.
+ * Lookups may report false negatives while a concurrent insert is in
+ * flight, which is fine for a cache of already processed bitmap hashes.
+ */
+
+#define SHM_SET_MAX_PROBE 128
+
+typedef struct shm_set_header_s {
+  volatile uint64_t generation;
+  volatile uint64_t count;
+  uint64_t capacity;
+  uint64_t padding[5];
+} shm_set_header_t;
+
+typedef struct shm_set_slot_s {
+  volatile uint64_t tag;
+  volatile uint64_t key;
+} shm_set_slot_t;
+
+#define SHM_SET_BUSY(_g)  ((_g) << 1)
+#define SHM_SET_VALID(_g) (((_g) << 1) | 1)
+
+static inline shm_set_slot_t* shm_set_slots(shm_set_header_t* set){
+  return (shm_set_slot_t*)(set + 1);
+}
+
+static inline uint64_t shm_set_mix(uint64_t key){
+  key ^= key >> 33;
+  key *= 0xff51afd7ed558ccdULL;
+  key ^= key >> 33;
+  return key;
+}
+
+uint64_t shm_set_size(uint64_t capacity){
+  return sizeof(shm_set_header_t) + (capacity * sizeof(shm_set_slot_t));
+}
+
+void shm_set_init(shm_set_header_t* set, uint64_t capacity){
+  /* capacity has to be a power of two */
+  assert(capacity && !(capacity & (capacity-1)));
+  set->capacity = capacity;
+  set->count = 0;
+  __sync_synchronize();
+  set->generation = 1;
+}
+
+void shm_set_clear(shm_set_header_t* set){
+  __sync_fetch_and_add(&set->generation, 1);
+  set->count = 0;
+}
+
+bool shm_set_contains(shm_set_header_t* set, uint64_t key){
+  shm_set_slot_t* slots = shm_set_slots(set);
+  uint64_t mask = set->capacity-1;
+  uint64_t generation = set->generation;
+  uint64_t index = shm_set_mix(key) & mask;
+
+  for (uint32_t i = 0; i < SHM_SET_MAX_PROBE; i++, index = (index+1) & mask){
+    uint64_t tag = slots[index].tag;
+    if (tag == SHM_SET_VALID(generation)){
+      if (slots[index].key == key){
+        return true;
+      }
+    }
+    else if (tag & 1 || !tag){
+      /* unused or stale slot terminates the probe sequence */
+      return false;
+    }
+  }
+  return false;
+}
+
+bool shm_set_insert(shm_set_header_t* set, uint64_t key){
+  shm_set_slot_t* slots = shm_set_slots(set);
+  uint64_t mask = set->capacity-1;
+  uint64_t generation = set->generation;
+  uint64_t index = shm_set_mix(key) & mask;
+
+  /* the set is a cache -> start over once it is three quarters full */
+  if (set->count >= ((set->capacity >> 2) * 3)){
+    if (__sync_bool_compare_and_swap(&set->generation, generation, generation+1)){
+      set->count = 0;
+    }
+    generation = set->generation;
+  }
+
+  for (uint32_t i = 0; i < SHM_SET_MAX_PROBE; i++, index = (index+1) & mask){
+    uint64_t tag = slots[index].tag;
+    if (tag == SHM_SET_VALID(generation)){
+      if (slots[index].key == key){
+        return true;
+      }
+      continue;
+    }
+    if (tag && !(tag & 1)){
+      /* another process currently owns this slot */
+      continue;
+    }
+    if (__sync_bool_compare_and_swap(&slots[index].tag, tag, SHM_SET_BUSY(generation))){
+      slots[index].key = key;
+      __sync_synchronize();
+      slots[index].tag = SHM_SET_VALID(generation);
+      __sync_fetch_and_add(&set->count, 1);
+      return true;
+    }
+    /* lost the race for this slot -> re-examine it */
+    index = (index-1) & mask;
+  }
+  return false;
+}
+
+/*
+ * Deterministic bit/byte flip stages, written in batches.
+ *
+ * Every mutation is written as <uint32 length><payload> into consecutive
+ * slots of slot_size bytes (the layout of the job ring). positions receives
+ * the stage position of every written mutation, cursor keeps the position
+ * of the next mutation between calls. Returns the number of written slots,
+ * 0 once the stage is exhausted.
+ */
+
+static inline uint8_t* batch_slot(uint8_t* slots, uint32_t slot_size, uint32_t num, const uint8_t* data, uint32_t len){
+  uint8_t* slot = slots + ((uint64_t)num * slot_size);
+  memcpy(slot, &len, sizeof(uint32_t));
+  memcpy(slot + sizeof(uint32_t), data, len);
+  return slot + sizeof(uint32_t);
+}
+
+static inline void flip_bits(uint8_t* data, uint64_t bit, uint8_t num){
+  for (uint8_t j = 0; j < num; j++){
+    data[(bit+j)/8] ^= (0x80 >> ((bit+j) % 8));
+  }
+}
+
+uint32_t bitflip_batch(uint8_t* slots, uint32_t slot_size, uint32_t max_slots,
+                       const uint8_t* data, uint32_t len, uint8_t stage, uint64_t* cursor,
+                       const uint8_t* effector_map, bool skip_null, uint32_t* positions){
+  uint64_t start, end;
+  uint64_t i = *cursor;
+  uint32_t num = 0;
+
+  if (len + sizeof(uint32_t) > slot_size){
+    return 0;
+  }
+
+  switch(stage){
+    case 1:   start = 0; end = (uint64_t)len * 8; break;
+    case 2:   start = 0; end = len ? ((uint64_t)len * 8) - 1 : 0; break;
+    case 4:   start = 0; end = len ? ((uint64_t)len * 8) - 3 : 0; break;
+    case 8:   start = 0; end = len; break;
+    case 16:  start = 1; end = len; break;
+    case 32:  start = 3; end = len; break;
+    default:  return 0;
+  }
+
+  if (i < start){
+    i = start;
+  }
+
+  for (; i < end && num < max_slots; i++){
+    uint8_t* slot;
+    switch(stage){
+      case 1:
+      case 2:
+      case 4:
+        if (effector_map && !(effector_map[i/8] || effector_map[(i+stage-1)/8])){
+          continue;
+        }
+        if (skip_null && !data[i/8] && !data[(i+stage-1)/8]){
+          continue;
+        }
+        slot = batch_slot(slots, slot_size, num, data, len);
+        flip_bits(slot, i, stage);
+        break;
+      case 8:
+        if (effector_map && !effector_map[i]){
+          continue;
+        }
+        if (skip_null && !data[i]){
+          continue;
+        }
+        slot = batch_slot(slots, slot_size, num, data, len);
+        slot[i] ^= 0xff;
+        break;
+      default:
+        if (effector_map){
+          bool selected = false;
+          for (uint8_t j = 0; j < stage/8; j++){
+            selected |= effector_map[i-j];
+          }
+          if (!selected){
+            continue;
+          }
+        }
+        slot = batch_slot(slots, slot_size, num, data, len);
+        for (uint8_t j = 0; j < stage/8; j++){
+          slot[i-j] ^= 0xff;
+        }
+        break;
+    }
+    positions[num++] = (uint32_t)i;
+  }
+
+  *cursor = i;
+  return num;
+}
+
+/*
+ * Deterministic arithmetic and interesting value stages.
+ *
+ * Instead of testing every candidate value through a Python -> ctypes round
+ * trip, the candidates of a stage are computed here and returned as records
+ * (offset, width, endianness, value). value is stored in the byte order it
+ * is written to the payload (little endian), big_endian only tells which
+ * variant produced it. Candidates which are reachable by an earlier stage
+ * are filtered with the could_be_* checks above, identical values at the
+ * same offset are only emitted once. cursor keeps the next offset between
+ * calls; a call stops before an offset whose candidates might not fit into
+ * the remaining records. Returns the number of written records, 0 once the
+ * stage is exhausted.
+ */
+
+typedef struct det_candidate_s {
+  uint32_t offset;
+  uint8_t width;
+  uint8_t big_endian;
+  uint16_t padding;
+  uint32_t value;
+} det_candidate_t;
+
+static inline uint32_t load_le(const uint8_t* data, uint8_t width){
+  uint32_t value = 0;
+  for (uint8_t j = 0; j < width; j++){
+    value |= ((uint32_t)data[j]) << (8*j);
+  }
+  return value;
+}
+
+static inline bool effector_window(const uint8_t* effector_map, uint32_t offset, uint8_t width){
+  if (!effector_map){
+    return true;
+  }
+  for (uint8_t j = 0; j < width; j++){
+    if (effector_map[offset+j]){
+      return true;
+    }
+  }
+  return false;
+}
+
+static inline uint32_t emit_candidate(det_candidate_t* out, uint32_t num, uint32_t first, uint32_t offset, uint8_t width, bool big_endian, uint32_t value){
+  for (uint32_t j = first; j < num; j++){
+    if (out[j].value == value){
+      return num;
+    }
+  }
+  out[num].offset = offset;
+  out[num].width = width;
+  out[num].big_endian = big_endian;
+  out[num].padding = 0;
+  out[num].value = value;
+  return num+1;
+}
+
+uint32_t arith_candidates(const uint8_t* data, uint32_t len, uint8_t width, const uint8_t* effector_map, bool skip_null,
+                          uint8_t arith_max, uint64_t* cursor, det_candidate_t* out, uint32_t max_out){
+  uint64_t i = *cursor;
+  uint32_t num = 0;
+  uint32_t per_offset = (width == 1 ? 2 : 4) * arith_max;
+
+  for (; i + width <= len && num + per_offset <= max_out; i++){
+    uint32_t first = num;
+    uint32_t value = load_le(data + i, width);
+
+    if (!effector_window(effector_map, i, width)){
+      continue;
+    }
+    if (skip_null && !value){
+      continue;
+    }
+
+    for (uint32_t j = 1; j <= arith_max; j++){
+      uint32_t nv;
+      switch(width){
+        case 1:
+          nv = (uint8_t)(value + j);
+          if (!could_be_bitflip(value ^ nv)) num = emit_candidate(out, num, first, i, 1, false, nv);
+          nv = (uint8_t)(value - j);
+          if (!could_be_bitflip(value ^ nv)) num = emit_candidate(out, num, first, i, 1, false, nv);
+          break;
+        case 2:
+          /* little endian increment / decrement */
+          nv = (uint16_t)(value + j);
+          if (!could_be_bitflip(value ^ nv) && (value & 0xff) + j > 0xff) num = emit_candidate(out, num, first, i, 2, false, nv);
+          nv = (uint16_t)(value - j);
+          if (!could_be_bitflip(value ^ nv) && (value & 0xff) < j) num = emit_candidate(out, num, first, i, 2, false, nv);
+          /* big endian increment / decrement */
+          nv = SWAP16((uint16_t)(SWAP16(value) + j));
+          if (!could_be_bitflip(value ^ nv) && (value >> 8) + j > 0xff) num = emit_candidate(out, num, first, i, 2, true, nv);
+          nv = SWAP16((uint16_t)(SWAP16(value) - j));
+          if (!could_be_bitflip(value ^ nv) && (value >> 8) < j) num = emit_candidate(out, num, first, i, 2, true, nv);
+          break;
+        default:
+          nv = value + j;
+          if (!could_be_bitflip(value ^ nv) && (value & 0xffff) + j > 0xffff) num = emit_candidate(out, num, first, i, 4, false, nv);
+          nv = value - j;
+          if (!could_be_bitflip(value ^ nv) && (value & 0xffff) < j) num = emit_candidate(out, num, first, i, 4, false, nv);
+          nv = SWAP32(SWAP32(value) + j);
+          if (!could_be_bitflip(value ^ nv) && (SWAP32(value) & 0xffff) + j > 0xffff) num = emit_candidate(out, num, first, i, 4, true, nv);
+          nv = SWAP32(SWAP32(value) - j);
+          if (!could_be_bitflip(value ^ nv) && (SWAP32(value) & 0xffff) < j) num = emit_candidate(out, num, first, i, 4, true, nv);
+          break;
+      }
+    }
+  }
+
+  *cursor = i;
+  return num;
+}
+
+uint32_t interesting_candidates(const uint8_t* data, uint32_t len, uint8_t width, const uint8_t* effector_map, bool skip_null,
+                                uint8_t arith_max, uint64_t* cursor, det_candidate_t* out, uint32_t max_out){
+  uint64_t i = *cursor;
+  uint32_t num = 0;
+  uint32_t values;
+
+  switch(width){
+    case 1:   values = sizeof(interesting_8); break;
+    case 2:   values = sizeof(interesting_16) / 2; break;
+    default:  values = sizeof(interesting_32) / 4; break;
+  }
+
+  for (; i + width <= len && num + (2 * values) <= max_out; i++){
+    uint32_t first = num;
+    uint32_t value = load_le(data + i, width);
+
+    if (!effector_window(effector_map, i, width)){
+      continue;
+    }
+    if (skip_null && !value){
+      continue;
+    }
+
+    for (uint32_t j = 0; j < values; j++){
+      uint32_t nv, swapped;
+      switch(width){
+        case 1:
+          nv = (uint8_t)interesting_8[j];
+          if (!could_be_bitflip(value ^ nv) && !could_be_arith(value, nv, 1, arith_max)) num = emit_candidate(out, num, first, i, 1, false, nv);
+          break;
+        case 2:
+          nv = (uint16_t)interesting_16[j];
+          swapped = SWAP16(nv);
+          if (!could_be_bitflip(value ^ nv) && !could_be_arith(value, nv, 2, arith_max) && !could_be_interest(value, nv, 2, 0))
+            num = emit_candidate(out, num, first, i, 2, false, nv);
+          if (nv != swapped && !could_be_bitflip(value ^ swapped) && !could_be_arith(value, swapped, 2, arith_max) && !could_be_interest(value, swapped, 2, 1))
+            num = emit_candidate(out, num, first, i, 2, true, swapped);
+          break;
+        default:
+          nv = (uint32_t)interesting_32[j];
+          swapped = SWAP32(nv);
+          if (!could_be_bitflip(value ^ nv) && !could_be_arith(value, nv, 4, arith_max) && !could_be_interest(value, nv, 4, 0))
+            num = emit_candidate(out, num, first, i, 4, false, nv);
+          if (nv != swapped && !could_be_bitflip(value ^ swapped) && !could_be_arith(value, swapped, 4, arith_max) && !could_be_interest(value, swapped, 4, 1))
+            num = emit_candidate(out, num, first, i, 4, true, swapped);
+          break;
+      }
+    }
+  }
+
+  *cursor = i;
+  return num;
+}
+
+/*
+ * Writes one job slot per candidate (payload with the candidate value
+ * stored at its offset). Returns the number of written slots.
+ */
+uint32_t candidate_batch(uint8_t* slots, uint32_t slot_size, uint32_t max_slots,
+                         const uint8_t* data, uint32_t len, const det_candidate_t* candidates, uint32_t count){
+  uint32_t num = 0;
+
+  if (len + sizeof(uint32_t) > slot_size){
+    return 0;
+  }
+
+  for (; num < count && num < max_slots; num++){
+    uint8_t* slot = batch_slot(slots, slot_size, num, data, len);
+    for (uint8_t j = 0; j < candidates[num].width; j++){
+      slot[candidates[num].offset + j] = (uint8_t)(candidates[num].value >> (8*j));
+    }
+  }
+  return num;
+}
+
+/*
+ * Writes the indices of all bitmap bytes which are not 0xff (= edges hit
+ * by the run) in ascending order to edges and returns their number. Runs
+ * of untouched bytes are skipped a 64 bit word at a time.
+ */
+uint32_t bitmap_edges(const uint8_t* bitmap, uint32_t bitmap_size, uint32_t* edges){
+  uint32_t num = 0;
+  uint32_t i = 0;
+
+  for (; i + sizeof(uint64_t) <= bitmap_size; i += sizeof(uint64_t)){
+    uint64_t word;
+    memcpy(&word, bitmap + i, sizeof(uint64_t));
+    if (word == 0xffffffffffffffffULL){
+      continue;
+    }
+    for (uint32_t j = i; j < i + sizeof(uint64_t); j++){
+      if (bitmap[j] != 0xff){
+        edges[num++] = j;
+      }
+    }
+  }
+  for (; i < bitmap_size; i++){
+    if (bitmap[i] != 0xff){
+      edges[num++] = i;
+    }
+  }
+  return num;
+}
+
+/* number of buckets b with value >= b+1, the per byte weight of ratio_bits */
+static inline uint32_t bucket_weight(uint8_t value){
+  static const uint8_t buckets[] = {0x0, 0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80};
+  uint32_t weight = 0;
+  for (uint32_t b = 0; b < sizeof(buckets); b++){
+    if (value >= buckets[b] + 1){
+      weight++;
+    }
+  }
+  return weight;
+}
+
+/**
+ * @brief Recomputes the coverage totals of a bucket bitmap.
+ * @param totals [0]: number of covered bytes, [1]: sum of their bucket weights.
+ */
+void bitmap_totals(const uint8_t* bitmap, uint64_t bitmap_size, uint64_t* totals){
+  totals[0] = 0;
+  totals[1] = 0;
+  for (uint64_t i = 0; i < bitmap_size; i++){
+    if (bitmap[i]){
+      totals[0]++;
+      totals[1] += bucket_weight(bitmap[i]);
+    }
+  }
+}
+
+/**
+ * @brief Merges a run bitmap into the bucket bitmap without modifying it.
+ * Same semantics as are_new_bits_present(), but words of the run bitmap
+ * that were not hit at all (0xff) are skipped 64 bits at a time.
+ * @param new_edges Receives the index of every byte that gained a bucket
+ * (bit_count entries, ascending). Must hold bitmap_size entries or be NULL.
+ * @param totals Running totals as maintained by bitmap_totals().
+ * @return (byte_count << 32) + bit_count
+ */
+uint64_t bitmap_merge(uint8_t* bitmap, const uint8_t* new_bitmap, uint64_t bitmap_size, uint32_t* new_edges, uint64_t* totals){
+  uint64_t bit_count = 0;
+  uint64_t byte_count = 0;
+  uint64_t i = 0;
+
+  while (i < bitmap_size){
+    if (i + sizeof(uint64_t) <= bitmap_size){
+      uint64_t word;
+      memcpy(&word, new_bitmap + i, sizeof(uint64_t));
+      if (word == 0xffffffffffffffffULL){
+        i += sizeof(uint64_t);
+        continue;
+      }
+    }
+
+    uint64_t end = (i + sizeof(uint64_t) <= bitmap_size) ? i + sizeof(uint64_t) : bitmap_size;
+    for (; i < end; i++){
+      if (new_bitmap[i] != 0xff && bitmap[i] != 0xff){
+        uint8_t bucket = bucket_lut[(uint8_t)(new_bitmap[i] + 1)];
+        if ((bucket & bitmap[i]) == 0){
+          if (!bitmap[i]){
+            byte_count++;
+            totals[0]++;
+          }
+          totals[1] += bucket_weight(bitmap[i] + bucket) - bucket_weight(bitmap[i]);
+          if (new_edges){
+            new_edges[bit_count] = i;
+          }
+          bit_count++;
+          bitmap[i] += bucket;
+        }
+      }
+    }
+  }
+  return (uint64_t)((byte_count << 32) + (bit_count));
+}
+
+/**
+ * @brief Merges several run bitmaps in order, see bitmap_merge().
+ * @param results Receives (byte_count << 32) + bit_count of every run.
+ */
+void bitmap_merge_batch(uint8_t* bitmap, const uint8_t** new_bitmaps, uint32_t count, uint64_t bitmap_size, uint64_t* results, uint64_t* totals){
+  for (uint32_t i = 0; i < count; i++){
+    results[i] = bitmap_merge(bitmap, new_bitmaps[i], bitmap_size, NULL, totals);
+  }
+}
+
+/*
+ * Exact set of 128-bit digests in shared memory. There is a single writer
+ * (the mapserver), readers in other processes may run concurrently: the low
+ * word of a key is stored before the high word, so a half written slot never
+ * matches a lookup. The all-zero key marks an empty slot.
+ */
+typedef struct digest_set_header_s {
+  volatile uint64_t count;
+  uint64_t capacity;
+  uint64_t padding[6];
+} digest_set_header_t;
+
+typedef struct digest_set_slot_s {
+  volatile uint64_t lo;
+  volatile uint64_t hi;
+} digest_set_slot_t;
+
+static inline digest_set_slot_t* digest_set_slots(digest_set_header_t* set){
+  return (digest_set_slot_t*)(set + 1);
+}
+
+uint64_t digest_set_size(uint64_t capacity){
+  return sizeof(digest_set_header_t) + (capacity * sizeof(digest_set_slot_t));
+}
+
+void digest_set_init(digest_set_header_t* set, uint64_t capacity){
+  /* capacity has to be a power of two */
+  assert(capacity && !(capacity & (capacity-1)));
+  memset(digest_set_slots(set), 0, capacity * sizeof(digest_set_slot_t));
+  set->capacity = capacity;
+  __sync_synchronize();
+  set->count = 0;
+}
+
+bool digest_set_contains(digest_set_header_t* set, uint64_t hi, uint64_t lo){
+  digest_set_slot_t* slots = digest_set_slots(set);
+  uint64_t mask = set->capacity-1;
+  uint64_t index;
+
+  if (!(hi | lo)){
+    lo = 1;
+  }
+  index = shm_set_mix(hi ^ lo) & mask;
+  for (uint64_t i = 0; i < set->capacity; i++, index = (index+1) & mask){
+    uint64_t slot_lo = slots[index].lo;
+    uint64_t slot_hi = slots[index].hi;
+    if (!(slot_lo | slot_hi)){
+      return false;
+    }
+    if (slot_lo == lo && slot_hi == hi){
+      return true;
+    }
+  }
+  return false;
+}
+
+/**
+ * @return 1 if the digest was added, 0 if it is already present and
+ * 2 if the set is full (it is kept below three quarters of its capacity).
+ */
+uint8_t digest_set_insert(digest_set_header_t* set, uint64_t hi, uint64_t lo){
+  digest_set_slot_t* slots = digest_set_slots(set);
+  uint64_t mask = set->capacity-1;
+  uint64_t index;
+
+  if (!(hi | lo)){
+    lo = 1;
+  }
+  index = shm_set_mix(hi ^ lo) & mask;
+  for (;; index = (index+1) & mask){
+    if (!(slots[index].lo | slots[index].hi)){
+      break;
+    }
+    if (slots[index].lo == lo && slots[index].hi == hi){
+      return 0;
+    }
+  }
+  if (set->count >= ((set->capacity >> 2) * 3)){
+    return 2;
+  }
+  slots[index].lo = lo;
+  __sync_synchronize();
+  slots[index].hi = hi;
+  __sync_synchronize();
+  set->count++;
+  return 1;
+}
+
+/* copies every digest of the set to out (hi, lo pairs), returns the number of digests */
+uint64_t digest_set_export(digest_set_header_t* set, uint64_t* out){
+  digest_set_slot_t* slots = digest_set_slots(set);
+  uint64_t count = 0;
+
+  for (uint64_t i = 0; i < set->capacity; i++){
+    if (slots[i].lo | slots[i].hi){
+      out[count*2] = slots[i].hi;
+      out[count*2+1] = slots[i].lo;
+      count++;
+    }
+  }
+  return count;
+}
+
+/*
+ * Blocked bloom filter over 128-bit digests: the high word selects one
+ * cache line sized block, the low word the BLOOM_HASHES bits inside of it.
+ * A lookup touches a single cache line, inserts only set bits, so
+ * lookups and inserts may run at the same time.
+ */
+
+#define BLOOM_BLOCK_WORDS 8
+#define BLOOM_HASHES 7
+
+typedef struct bloom_header_s {
+  uint64_t blocks;
+  uint64_t padding[7];
+} bloom_header_t;
+
+static inline volatile uint64_t* bloom_block(bloom_header_t* bloom, uint64_t hi){
+  return (volatile uint64_t*)(bloom + 1) + ((shm_set_mix(hi) & (bloom->blocks-1)) * BLOOM_BLOCK_WORDS);
+}
+
+uint64_t bloom_size(uint64_t blocks){
+  return sizeof(bloom_header_t) + (blocks * BLOOM_BLOCK_WORDS * sizeof(uint64_t));
+}
+
+void bloom_init(bloom_header_t* bloom, uint64_t blocks){
+  /* blocks has to be a power of two */
+  assert(blocks && !(blocks & (blocks-1)));
+  memset(bloom + 1, 0, blocks * BLOOM_BLOCK_WORDS * sizeof(uint64_t));
+  __sync_synchronize();
+  bloom->blocks = blocks;
+}
+
+void bloom_insert(bloom_header_t* bloom, uint64_t hi, uint64_t lo){
+  volatile uint64_t* block = bloom_block(bloom, hi);
+
+  /* 9 bits of the low word per hash address one of the 512 bits of the block */
+  for (uint8_t i = 0; i < BLOOM_HASHES; i++, lo >>= 9){
+    __sync_fetch_and_or(&block[(lo >> 6) & (BLOOM_BLOCK_WORDS-1)], 1ULL << (lo & 63));
+  }
+}
+
+bool bloom_contains(bloom_header_t* bloom, uint64_t hi, uint64_t lo){
+  volatile uint64_t* block = bloom_block(bloom, hi);
+
+  for (uint8_t i = 0; i < BLOOM_HASHES; i++, lo >>= 9){
+    if (!(block[(lo >> 6) & (BLOOM_BLOCK_WORDS-1)] & (1ULL << (lo & 63)))){
+      return false;
+    }
+  }
+  return true;
+}
+
+/*
+ * MurmurHash3_x64_128 (public domain, Austin Appleby), same result as
+ * mmh3.hash64(data) for seed 0. Hashes the bitmap shm in place.
+ */
+
+static inline uint64_t rotl64(uint64_t x, int8_t r){
+  return (x << r) | (x >> (64 - r));
+}
+
+static inline uint64_t fmix64(uint64_t k){
+  k ^= k >> 33;
+  k *= 0xff51afd7ed558ccdULL;
+  k ^= k >> 33;
+  k *= 0xc4ceb9fe1a85ec53ULL;
+  k ^= k >> 33;
+  return k;
+}
+
+void murmur3_x64_128(const uint8_t* data, uint64_t len, uint32_t seed, uint64_t* out){
+  const uint64_t c1 = 0x87c37b91114253d5ULL;
+  const uint64_t c2 = 0x4cf5ad432745937fULL;
+  uint64_t nblocks = len / 16;
+  uint64_t h1 = seed;
+  uint64_t h2 = seed;
+  uint64_t k1, k2;
+
+  for (uint64_t i = 0; i < nblocks; i++){
+    memcpy(&k1, data + (i * 16), sizeof(uint64_t));
+    memcpy(&k2, data + (i * 16) + 8, sizeof(uint64_t));
+
+    k1 *= c1; k1 = rotl64(k1, 31); k1 *= c2; h1 ^= k1;
+    h1 = rotl64(h1, 27); h1 += h2; h1 = h1 * 5 + 0x52dce729;
+
+    k2 *= c2; k2 = rotl64(k2, 33); k2 *= c1; h2 ^= k2;
+    h2 = rotl64(h2, 31); h2 += h1; h2 = h2 * 5 + 0x38495ab5;
+  }
+
+  const uint8_t* tail = data + (nblocks * 16);
+  k1 = 0;
+  k2 = 0;
+  switch (len & 15){
+    case 15: k2 ^= ((uint64_t)tail[14]) << 48;
+    case 14: k2 ^= ((uint64_t)tail[13]) << 40;
+    case 13: k2 ^= ((uint64_t)tail[12]) << 32;
+    case 12: k2 ^= ((uint64_t)tail[11]) << 24;
+    case 11: k2 ^= ((uint64_t)tail[10]) << 16;
+    case 10: k2 ^= ((uint64_t)tail[ 9]) << 8;
+    case  9: k2 ^= ((uint64_t)tail[ 8]) << 0;
+             k2 *= c2; k2 = rotl64(k2, 33); k2 *= c1; h2 ^= k2;
+
+    case  8: k1 ^= ((uint64_t)tail[ 7]) << 56;
+    case  7: k1 ^= ((uint64_t)tail[ 6]) << 48;
+    case  6: k1 ^= ((uint64_t)tail[ 5]) << 40;
+    case  5: k1 ^= ((uint64_t)tail[ 4]) << 32;
+    case  4: k1 ^= ((uint64_t)tail[ 3]) << 24;
+    case  3: k1 ^= ((uint64_t)tail[ 2]) << 16;
+    case  2: k1 ^= ((uint64_t)tail[ 1]) << 8;
+    case  1: k1 ^= ((uint64_t)tail[ 0]) << 0;
+             k1 *= c1; k1 = rotl64(k1, 31); k1 *= c2; h1 ^= k1;
+  }
+
+  h1 ^= len;
+  h2 ^= len;
+  h1 += h2;
+  h2 += h1;
+  h1 = fmix64(h1);
+  h2 = fmix64(h2);
+  h1 += h2;
+  h2 += h1;
+
+  out[0] = h1;
+  out[1] = h2;
+}
+
+/* vDSO clock, no syscall per execution */
+uint64_t monotonic_ns(void){
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return ((uint64_t)now.tv_sec * 1000000000ULL) + (uint64_t)now.tv_nsec;
+}
@@ -20,6 +20,7 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import time
+import struct
 
 import mmh3, base64, lz4
 import collections
@@ -30,19 +31,20 @@ from fuzzer.communicator import send_msg, recv_msg, Communicator
 from fuzzer.protocol import *
 from fuzzer.state import GlobalState
 from fuzzer.tree import *
+from fuzzer.technique.helper import seed_random
 from common.config import FuzzerConfiguration
 from common.debug import log_mapserver
 from common.qemu import qemu
+from common.writer import AsyncWriter
+from common.shared_set import BitmapHashIndex
+from fuzzer.corpus import CorpusStore
+from fuzzer.snapshot import Snapshot
 from fuzzer.fuzz_methods import METHODE_IMPORT
 
 __author__ = 'Sergej Schumilo'
 
-class SetEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
-
+PAYLOAD_LENGTH = struct.Struct("<I")
+SNAPSHOT_INTERVAL = 300
 
 def mapserver_loader(comm):
     log_mapserver("PID: " + str(os.getpid()))
@@ -52,8 +54,11 @@ def mapserver_loader(comm):
         mapserver_process.loop()
     except KeyboardInterrupt:
         mapserver_process.comm.slave_termination.value = True
-        mapserver_process.treemap.save_data()
+        if mapserver_process.preliminary_mode:
+            """ snapshots never contain preliminary findings, restore the state from before preliminary mode """
+            mapserver_process.treemap.toggle_preliminary_mode(False)
         mapserver_process.save_data()
+        AsyncWriter().close()
         log_mapserver("Date saved!")
 
 
@@ -63,15 +68,16 @@ class MapserverProcess:
         self.comm = comm
         #self.state = MapserverState()
         self.state = GlobalState()
+        seed_random(FuzzerConfiguration().argument_values['seed'], stream=1)
 
 
         self.hash_set = set()
         self.preliminary_set = set()
 
 
-        self.hash_list = set()
+        """ hashes of accepted and rejected bitmaps, shared with the slaves """
+        self.bitmap_hashes = BitmapHashIndex()
         self.crash_list = []
-        self.shadow_map = set()
 
         self.last_hash = ""
         self.post_sync_master_tag = None
@@ -107,9 +113,11 @@ class MapserverProcess:
         for e in range(self.config.argument_values['p']):
             self.ring_buffers.append(collections.deque(maxlen=30))
 
+        self.last_snapshot = time.time()
         if self.config.load_old_state:
-            self.load_data()
-            self.treemap = KaflTree.load_data(enable_graphviz=self.enable_graphviz)
+            sections = Snapshot().read()
+            self.load_data(sections)
+            self.treemap = KaflTree.load_data(sections, enable_graphviz=self.enable_graphviz)
         else:
             msg = recv_msg(self.comm.to_mapserver_queue)
             self.state["pending"] = len(msg.data)
@@ -120,23 +128,18 @@ class MapserverProcess:
             data = []
             for payload in self.ring_buffers[slave_id]:
                 data.append(base64.b64encode(payload))
-            with open(target, 'w') as outfile:
-                outfile.write(lz4.block.compress(json.dumps(data)))
+            AsyncWriter().write(target, lz4.block.compress(json.dumps(data)))
             
 
-    def __check_hash(self, new_hash, bitmap, payload, crash, timeout, kasan, slave_id, reloaded, performance, qid, pos, methode):
-        self.ring_buffers[slave_id].append(str(payload))
-        
+    def __is_hash_new(self, new_hash, last_hash, batch_hashes):
         if self.preliminary_mode:
-            hash_was_new = True
+            return True
+        if new_hash == last_hash or new_hash in batch_hashes:
+            return False
+        return new_hash not in self.bitmap_hashes
 
-        else:
-            hash_was_new = False
-            if new_hash != self.last_hash:
-                if len(self.hash_list) == 0:
-                    hash_was_new = True
-                if new_hash not in self.hash_list and new_hash not in self.shadow_map:
-                    hash_was_new = True
+    def __check_hash(self, new_hash, bitmap, payload, crash, timeout, kasan, slave_id, reloaded, performance, methode, hash_was_new, coverage):
+        self.ring_buffers[slave_id].append(str(payload))
 
 
         if crash or kasan or timeout:
@@ -164,25 +167,23 @@ class MapserverProcess:
                 if not self.preliminary_mode:
                     self.state[state_str] += 1
                     path = FuzzerConfiguration().argument_values['work_dir'] + "/findings/non_uniq/"+ state_str+ "_non_uniq_" + str(self.state[state_str])
-                    with open(path , "w") as f:
-                        f.write(payload)
-                    with open(FuzzerConfiguration().argument_values['work_dir']+"/evaluation/findings.csv",'ab') as f:
-                        f.write("%s\n"%json.dumps([time.time()-GlobalState().values["inittime"], path] ))
+                    AsyncWriter().write(path, payload)
+                    AsyncWriter().append(FuzzerConfiguration().argument_values['work_dir']+"/evaluation/findings.csv",
+                                         "%s\n"%json.dumps([time.time()-GlobalState()["inittime"], path] ))
 
         elif hash_was_new:
-            if self.treemap.append(payload, bitmap, methode, performance=performance):
+            if self.treemap.append(payload, bitmap, methode, performance=performance, coverage=coverage):
                 if not self.preliminary_mode:
                     if methode.get_type() == METHODE_IMPORT:
                          self.state["imports"] += 1
-                    self.hash_list.add(new_hash)
+                    self.bitmap_hashes.add(new_hash)
                     self.new_findings += 1
                     self.state["last_hash_time"] = time.time()
-                    self.__update_state()
                 else:
                     self.state["preliminary"] += 1
             else:
                 if not self.preliminary_mode:
-                    self.shadow_map.add(new_hash)
+                    self.bitmap_hashes.add(new_hash)
 
         if reloaded:
             self.ring_buffers[slave_id].clear()
@@ -200,6 +201,7 @@ class MapserverProcess:
 
     def __post_sync_handler(self):
         if self.round_counter_master_post == self.round_counter:
+            AsyncWriter().flush()
             self.treemap.resort_favs()
             if self.post_sync_master_tag == KAFL_TAG_NXT_UNFIN:
                 data = self.treemap.get_next(self.performance, finished=False)
@@ -212,6 +214,9 @@ class MapserverProcess:
                 self.state["max_level"] = self.state["level"]
             state = data.node_state
 
+            if not self.preliminary_mode and time.time() - self.last_snapshot >= SNAPSHOT_INTERVAL:
+                self.save_data()
+
 
             if state == KaflNodeState.in_progress or state == KaflNodeState.finished:
                 send_msg(KAFL_TAG_NXT_UNFIN, data, self.comm.to_master_from_mapserver_queue)
@@ -245,6 +250,7 @@ class MapserverProcess:
     def __verification_sync_handler(self):
         log_mapserver("__verificatiom_sync_handler: " + str(self.round_counter_verification_sync ) + " / " + str(self.round_counter))
         if (self.round_counter_verification_sync == self.round_counter):
+            AsyncWriter().flush()
             send_msg(KAFL_TAG_REQ_VERIFY_SYNC, 0, self.comm.to_master_from_mapserver_queue)
             return True
         return False
@@ -252,45 +258,61 @@ class MapserverProcess:
     def __result_tag_handler(self, request):
         self.comm.slave_locks_B[request.source].acquire()
 
-        results = request.data
-        payloads = []
-        bitmaps = []
         payload_shm = self.comm.get_mapserver_payload_shm(request.source)
         bitmap_shm = self.comm.get_bitmap_shm(request.source)
-        bitmap_hashes = []
-
-        for result in results:
-            if result.new_bits and result.bitmap_hash and result.bitmap_hash:
-
-                bitmap_shm.seek(result.pos * self.comm.get_bitmap_shm_size())
-                payload_shm.seek(result.pos * self.comm.get_mapserver_payload_shm_size())
-                length = payload_shm.read(4)
-                data_len = (ord(length[3]) << 24) + (ord(length[2]) << 16) + (ord(length[1]) << 8) + (ord(length[0]))
-                payloads.append(payload_shm.read(data_len))
-                bitmaps.append(bitmap_shm.read(self.comm.get_bitmap_shm_size()))
-                bitmap_hashes.append(result.bitmap_hash)
+        payload_shm_size = self.comm.get_mapserver_payload_shm_size()
+        bitmap_shm_size = self.comm.get_bitmap_shm_size()
 
+        """
+        Copy out everything the batch needs in one pass while the slave waits.
+        Bitmaps are only read for findings and for hashes that are new to
+        both the mapserver and the rest of this batch.
+        """
+        batch = []
+        batch_hashes = set()
+        last_hash = self.last_hash
+        for result in request.data:
+            if result.new_bits and result.bitmap_hash:
+                offset = result.pos * payload_shm_size
+                data_len = PAYLOAD_LENGTH.unpack_from(payload_shm, offset)[0]
+                payload = payload_shm[offset + PAYLOAD_LENGTH.size:offset + PAYLOAD_LENGTH.size + data_len]
+
+                finding = result.crash or result.timeout or result.kasan
+                hash_was_new = not finding and self.__is_hash_new(result.bitmap_hash, last_hash, batch_hashes)
+                if finding or hash_was_new:
+                    offset = result.pos * bitmap_shm_size
+                    bitmap = bitmap_shm[offset:offset + bitmap_shm_size]
+                else:
+                    bitmap = None
+                if hash_was_new:
+                    batch_hashes.add(result.bitmap_hash)
+                last_hash = result.bitmap_hash
+                batch.append((result, payload, bitmap, hash_was_new))
             else:
-                payloads.append(None)
-                bitmaps.append(None)
-                bitmap_hashes.append(None)
+                batch.append((result, None, None, False))
         self.comm.slave_locks_A[request.source].release()
-        for i in range(len(results)):
 
-            if bitmap_hashes[i] is not None and results[i].new_bits:
+        coverage = iter(self.treemap.merge_coverage([bitmap for result, payload, bitmap, hash_was_new in batch if hash_was_new]))
 
-                self.__check_hash(bitmap_hashes[i], bitmaps[i], payloads[i], results[i].crash, results[i].timeout, results[i].kasan, results[i].slave_id, results[i].reloaded, results[i].performance, results[i].qid, results[i].pos, results[i].methode)
-                self.last_hash = bitmap_hashes[i]
+        new_findings = self.new_findings
+        for result, payload, bitmap, hash_was_new in batch:
+            if payload is not None:
+                self.__check_hash(result.bitmap_hash, bitmap, payload, result.crash, result.timeout, result.kasan, result.slave_id, result.reloaded, result.performance, result.methode,
+                                  hash_was_new, next(coverage) if hash_was_new else None)
+                self.last_hash = result.bitmap_hash
                 self.round_counter += 1
                 if self.effector_initial_bitmap:
-                    if self.effector_initial_bitmap != bitmap_hashes[i]:
-                        for j in results[i].affected_bytes:
+                    if self.effector_initial_bitmap != result.bitmap_hash:
+                        for j in result.affected_bytes:
                             log_mapserver("affected_bytes: " + str(j))
                             if not self.effector_map[j]:
                                 self.effector_map[j] = True
             else:
                 self.round_counter += 1
 
+        if self.new_findings != new_findings:
+            self.__update_state()
+
 
     def __next_tag_handler(self, request):
         self.post_sync_master_tag = request.tag
@@ -339,7 +361,9 @@ class MapserverProcess:
             self.last_hash = ""
             log_mapserver("Preliminary Mode: " + str(self.preliminary_mode))
 
-        send_msg(KAFL_TAG_REQ_PRELIMINARY, self.treemap.toggle_preliminary_mode(request.data), self.comm.to_master_from_mapserver_queue)
+        result = self.treemap.toggle_preliminary_mode(request.data)
+        AsyncWriter().flush()
+        send_msg(KAFL_TAG_REQ_PRELIMINARY, result, self.comm.to_master_from_mapserver_queue)
 
     def __sync_handler(self):
         if self.redqueen_sync:
@@ -361,7 +385,7 @@ class MapserverProcess:
             if self.__pre_sync_handler():
                 self.pre_sync = False
                 self.round_counter_master_pre = 0
-                log_mapserver("ShadowMap Size: " + str(len(self.shadow_map)))
+                log_mapserver("Bitmap hashes: " + str(len(self.bitmap_hashes)))
 
         if self.post_sync:
             if self.__post_sync_handler():
@@ -393,43 +417,19 @@ class MapserverProcess:
 
 
     def save_data(self):
-        return
         """
-        Method to store an entire master state to JSON file...
+        Method to store the tree and the mapserver state as snapshot (see fuzzer/snapshot.py)...
         """
-
-        dump = {}
-
-        for key, value in self.__dict__.iteritems():
-            if key == "state":
-                dump[key] = self.state.save_data()
-            elif key == "enable_graphviz" or key == "last_hash":
-                dump[key] = self.enable_graphviz
-            elif key == "hash_list" or key == "shadow_map":
-                tmp = []
-                for e in value:
-                    tmp.append(e)
-                dump[key] = tmp
-
-
-        with open(self.config.argument_values['work_dir'] + "/mapserver.json", 'w') as outfile:
-            json.dump(dump, outfile, default=json_dumper, cls=SetEncoder, indent=4)
-
-    def load_data(self):
+        sections = self.treemap.save_data()
+        sections.append(("HASH", self.bitmap_hashes.save_data()))
+        sections.append(("MSTA", self.state.save_data("mapserver")))
+        CorpusStore().sync()
+        Snapshot().write(sections)
+        self.last_snapshot = time.time()
+
+    def load_data(self, sections):
         """
-        Method to load an entire master state from JSON file...
+        Method to load the mapserver state from a snapshot...
         """
-        with open(FuzzerConfiguration().argument_values['work_dir'] + "/mapserver.json", 'r') as infile:
-            dump = json.load(infile)
-            for key, value in dump.iteritems():
-                if key == "hash_list" or key == "shadow_map":
-                    tmp = set()
-                    for e in value:
-                        tmp.add(tuple(e))
-                    setattr(self, key, tmp)
-                elif key == "state":
-                    tmp = MapserverState()
-                    tmp.load_data(value)
-                    setattr(self, key, tmp)
-                else:
-                    setattr(self, key, value)
+        self.bitmap_hashes.load_data(sections["HASH"])
+        self.state.load_data("mapserver", sections["MSTA"])
@@ -34,7 +34,9 @@ from fuzzer.technique.radamsa import *
 from fuzzer.technique.redqueen.mod import *
 from fuzzer.technique.redqueen.colorize import ColorizerStrategy
 from fuzzer.technique.redqueen.workdir import RedqueenWorkdir
-from fuzzer.tree import KaflNodeType
+from fuzzer.tree import KaflTree, KaflNodeType, KaflNodeState
+from fuzzer.snapshot import Snapshot
+from common.shared_set import PayloadIndex, payload_digest
 from common.util import get_seed_files, check_state_exists, json_dumper
 from common.config import FuzzerConfiguration
 from common.debug import log_master, log_redq
@@ -72,7 +74,7 @@ class MasterProcess:
         self.start = time.time()
         self.benchmark_time = time.time()
         self.counter_offset = 0
-        self.payload_buffer = []
+        self.job_batch = JobBatch(self.comm.tasks_per_requests, self.comm.get_job_slot_size())
         self.methode_buffer = []
         self.byte_map = []
         self.stage_abortion = False
@@ -85,6 +87,7 @@ class MasterProcess:
         self.refresh_rate = self.config.config_values['UI_REFRESH_RATE']
         self.use_effector_map = self.config.argument_values['d']
         self.arith_max = FuzzerConfiguration().config_values["ARITHMETIC_MAX"]
+        seed_random(self.config.argument_values['seed'], stream=0)
 
 
         self.seen_addr_to_value = {}
@@ -105,10 +108,12 @@ class MasterProcess:
         log_master("Use effector maps: " + str(self.use_effector_map))
 
     def __start_processes(self):
+        start_time = time.time()
         for i in range(self.comm.num_processes):
-            start_time = time.time()
-            recv_tagged_msg(self.comm.to_master_queue, KAFL_TAG_START)
+            msg = recv_tagged_msg(self.comm.to_master_queue, KAFL_TAG_START)
             self.kafl_state["slaves_ready"] += 1
+            log_master("Slave %s ready after %.1fs" % (msg.data, time.time() - start_time))
+        log_master("All %d slaves ready after %.1fs" % (self.comm.num_processes, time.time() - start_time))
 
         self.kafl_state["loading"] = False
         self.kafl_state["inittime"] = time.time()
@@ -120,29 +125,10 @@ class MasterProcess:
         self.kafl_state["total"] += 1
         self.__buffered_handler(payload, affected_bytes=affected_bytes, methode=fuzz_methode(methode_type=METHODE_REDQUEEN, redqueen_cmp = addr, input_byte = offset))
 
-    def __bitflip_handler(self, payload, no_data=False, affected_bytes=None):
-        if not no_data:
-            self.kafl_state["progress_bitflip"] += 1
-            self.kafl_state["total"] += 1
-            self.__buffered_handler(payload, affected_bytes=affected_bytes, methode=fuzz_methode(methode_type=METHODE_BITFLIP_8))
-
-    def __arithmetic_handler(self, payload, no_data=False):
-        if not no_data:
-            self.kafl_state["progress_arithmetic"] += 1
-            self.kafl_state["total"] += 1
-            self.__buffered_handler(payload, methode=fuzz_methode(methode_type=METHODE_ARITHMETIC_32))
-
-    def __interesting_handler(self, payload, no_data=False):
-        if not no_data:
-            self.kafl_state["progress_interesting"] += 1
-            self.kafl_state["total"] += 1
-            self.__buffered_handler(payload, methode=fuzz_methode(methode_type=METHODE_INTERESTING_32))
-
-    def __havoc_handler(self, payload, no_data=False):
-        if not no_data:
-            self.kafl_state["progress_havoc"] += 1
-            self.kafl_state["total"] += 1
-            self.__buffered_handler(payload, methode=fuzz_methode(methode_type=METHODE_HAVOC))
+    def __havoc_handler(self, havoc_buffer):
+        self.kafl_state["progress_havoc"] += 1
+        self.kafl_state["total"] += 1
+        self.__havoc_buffer_handler(havoc_buffer, fuzz_methode(methode_type=METHODE_HAVOC))
 
     def __dict_bf_handler(self, payload, no_data=False):
         if not no_data:
@@ -150,11 +136,10 @@ class MasterProcess:
             self.kafl_state["total"] += 1
             self.__buffered_handler(payload, methode=fuzz_methode(methode_type=METHODE_DICT_BF))
 
-    def __splicing_handler(self, payload, no_data=False):
-        if not no_data:
-            self.kafl_state["progress_havoc"] += 1
-            self.kafl_state["total"] += 1
-            self.__buffered_handler(payload, methode=fuzz_methode(methode_type=METHODE_SPLICING))
+    def __splicing_handler(self, havoc_buffer):
+        self.kafl_state["progress_havoc"] += 1
+        self.kafl_state["total"] += 1
+        self.__havoc_buffer_handler(havoc_buffer, fuzz_methode(methode_type=METHODE_SPLICING))
 
     def __radamsa_handler(self, payload, no_data=False):
         if not no_data:
@@ -162,22 +147,49 @@ class MasterProcess:
             self.kafl_state["total"] += 1
             self.__buffered_handler(payload, methode=fuzz_methode(methode_type=METHODE_RADAMSA))
 
+    def __bitflip_batch_handler(self, stage_batch):
+        self.__stage_batch_handler(stage_batch, "progress_bitflip", fuzz_methode(methode_type=METHODE_BITFLIP_8))
+
+    def __arithmetic_batch_handler(self, stage_batch):
+        self.__stage_batch_handler(stage_batch, "progress_arithmetic", fuzz_methode(methode_type=METHODE_ARITHMETIC_32))
+
+    def __interesting_batch_handler(self, stage_batch):
+        self.__stage_batch_handler(stage_batch, "progress_interesting", fuzz_methode(methode_type=METHODE_INTERESTING_32))
+
+    def __stage_batch_handler(self, stage_batch, progress, methode):
+        while not self.stage_abortion:
+            num = stage_batch.fill(self.job_batch)
+            if num == 0:
+                break
+            self.kafl_state[progress] += num
+            self.kafl_state["total"] += num
+            self.__batch_handler(num, methode, affected_bytes=stage_batch.affected_bytes(num))
+
+    def __batch_handler(self, num, methode, affected_bytes=None):
+        """ accounts for num jobs that have been written into self.job_batch """
+        self.methode_buffer.extend([methode] * num)
+        if affected_bytes:
+            self.byte_map.extend(affected_bytes)
+        if self.job_batch.free() == 0:
+            self.__master_handler(self.methode_buffer)
+            self.job_batch.clear()
+            self.methode_buffer = []
+            self.byte_map = []
+
+    def __havoc_buffer_handler(self, havoc_buffer, methode):
+        if not self.stage_abortion:
+            self.job_batch.append_from(havoc_buffer.address, min(len(havoc_buffer), (64<<10)))
+            self.__batch_handler(1, methode)
+
     def __buffered_handler(self, payload, affected_bytes=None, last_payload=False, methode=fuzz_methode(methode_type=METHODE_UNKOWN)):
         if not self.stage_abortion:
             if not last_payload:
-                self.payload_buffer.append(payload[:(64<<10)])
-                self.methode_buffer.append(methode)
-                if affected_bytes:
-                    self.byte_map.append(affected_bytes)
-                if len(self.payload_buffer) == self.comm.tasks_per_requests:
-                    self.__master_handler(self.methode_buffer)
-                    self.payload_buffer = []
-                    self.methode_buffer = []
-                    self.byte_map = []
+                self.job_batch.append(payload[:(64<<10)])
+                self.__batch_handler(1, methode, affected_bytes=([affected_bytes] if affected_bytes else None))
             else:
-                if len(self.payload_buffer) != 0:
+                if len(self.job_batch) != 0:
                     self.__master_handler(self.methode_buffer)
-                    self.payload_buffer = []
+                    self.job_batch.clear()
                     self.byte_map = []
                     self.methode_buffer = []
 
@@ -192,15 +204,16 @@ class MasterProcess:
         while True:
             msg = recv_msg(self.comm.to_master_queue)
             if msg.tag == KAFL_TAG_REQ:
-                self.__task_send(self.payload_buffer, [None]*len(self.payload_buffer), msg.data, self.comm.to_slave_queues[int(msg.data)], methods)
-                self.abortion_counter += len(self.payload_buffer)
-                self.counter += len(self.payload_buffer)
-                self.round_counter += len(self.payload_buffer)
+                self.__task_send(self.job_batch, [None]*len(self.job_batch), msg.data, self.comm.to_slave_queues[int(msg.data)], methods)
+                self.abortion_counter += len(self.job_batch)
+                self.counter += len(self.job_batch)
+                self.round_counter += len(self.job_batch)
                 break
             elif msg.tag == KAFL_TAG_ABORT_REQ:
                 log_master("Abortion request received...")
                 self.stage_abortion = True
-                self.payload_buffer = []
+                self.job_batch.clear()
+                self.methode_buffer = []
                 self.byte_map = []
                 return
             else:
@@ -228,13 +241,12 @@ class MasterProcess:
             return payload, True
 
     def __task_send(self, tasks, data, qid, dest, methods, tag=KAFL_TAG_JOB):
-        fs_shm = self.comm.get_master_payload_shm(int(qid))
-        size = self.comm.get_master_payload_shm_size()
-        for i in range(len(tasks)):
-            fs_shm.seek(size * i)
-            input_len = to_string_32(len(tasks[i]))
-            fs_shm.write(input_len)
-            fs_shm.write(tasks[i])
+        job_ring = self.comm.get_job_ring(int(qid))
+        if isinstance(tasks, JobBatch):
+            job_ring.push_batch(tasks)
+        else:
+            for task in tasks:
+                job_ring.push(task)
         if self.byte_map:
             data = self.byte_map
         assert(len(tasks)==len(data))
@@ -339,11 +351,11 @@ class MasterProcess:
         return int((((self.round_counter-self.counter_offset) * 1.0) / (end - self.benchmark_time)))
 
     def __init_fuzzing_loop(self):
-        self.kafl_state["cycles"] = 0
         self.__start_processes()
 
         if self.config.load_old_state:
             log_master("State exists!")
+            return self.load_data()
         else:
             log_master("State does not exist!")
             payloads = get_seed_files(self.config.argument_values['work_dir'] + "/corpus")
@@ -353,6 +365,7 @@ class MasterProcess:
                 data.append((payload, bitmap))
             send_msg(KAFL_INIT_BITMAP, data, self.comm.to_mapserver_queue)
             self.payload = payloads[0]
+            return False
 
     def __calc_stage_iterations(self):
         self.kafl_state["progress_redqueen"] = 0
@@ -362,17 +375,16 @@ class MasterProcess:
         self.kafl_state["progress_havoc"] = 0
         self.kafl_state["progress_specific"] = 0
         self.kafl_state["payload_size"] = len(self.payload)
-        self.kafl_state["payload"] = self.payload
+        self.kafl_state["payload"] = self.payload[:GlobalState.STRING_SIZE]
 
-        limiter_map = []
-        for i in range(len(self.payload)):
-            limiter_map.append(True)
+        limiter_map = bytearray('\x01') * len(self.payload)
         if self.config.argument_values['i']:
             for ignores in self.config.argument_values['i']:
                 log_master("Ignore-range 0: " + str(ignores[0]) + " " + str(min(ignores[0], len(self.payload))))
                 log_master("Ignore-range 1: " + str(ignores[1]) + " " + str(min(ignores[1], len(self.payload))))
-                for i in range(min(ignores[0], len(self.payload)), min(ignores[1], len(self.payload))):
-                    limiter_map[i] = False
+                start, end = min(ignores[0], len(self.payload)), min(ignores[1], len(self.payload))
+                if start < end:
+                    limiter_map[start:end] = bytearray(end - start)
 
         if self.config.argument_values['D']:
             self.kafl_state["progress_bitflip_amount"] = bitflip_range(self.payload, skip_null=self.skip_zero, effector_map=limiter_map)
@@ -517,15 +529,17 @@ class MasterProcess:
                 self.kafl_state.update_performance(int(((self.counter * 1.0) / (end - self.start))))
                 self.start = time.time()
                 self.counter = 0
+            payload = read_binary_file(path)[:(64<<10)]
+            if payload_digest(payload) in PayloadIndex():
+                i += 1
+                continue
             while True:
                 msg = recv_msg(self.comm.to_master_queue)
                 if msg.tag == KAFL_TAG_REQ:
-                    payload = read_binary_file(path)
-
                     methode = fuzz_methode()
                     methode.read_from_file(self.config.argument_values['work_dir'], i+1, preliminary=True)
                     
-                    self.__task_send([payload[:(64<<10)]],[self.redqueen_state.get_candidate_hash_addrs()], msg.data, self.comm.to_slave_queues[int(msg.data)], [methode], tag=KAFL_TAG_REQ_VERIFY)
+                    self.__task_send([payload],[self.redqueen_state.get_candidate_hash_addrs()], msg.data, self.comm.to_slave_queues[int(msg.data)], [methode], tag=KAFL_TAG_REQ_VERIFY)
                     i += 1
                     self.counter += 1
                     self.round_counter += 1
@@ -557,12 +571,14 @@ class MasterProcess:
                 self.kafl_state.update_performance(int(((self.counter * 1.0) / (end - self.start))))
                 self.start = time.time()
                 self.counter = 0
+            payload = read_binary_file(path)[:(64<<10)]
+            if payload_digest(payload) in PayloadIndex():
+                os.remove(path)
+                continue
             while True:
                 msg = recv_msg(self.comm.to_master_queue)
                 if msg.tag == KAFL_TAG_REQ:
-                    payload = read_binary_file(path)
-                    
-                    self.__task_send([payload[:(64<<10)]],[self.redqueen_state.get_candidate_hash_addrs()], msg.data, self.comm.to_slave_queues[int(msg.data)], [fuzz_methode(METHODE_IMPORT)], tag=KAFL_TAG_REQ_VERIFY)
+                    self.__task_send([payload],[self.redqueen_state.get_candidate_hash_addrs()], msg.data, self.comm.to_slave_queues[int(msg.data)], [fuzz_methode(METHODE_IMPORT)], tag=KAFL_TAG_REQ_VERIFY)
                     os.remove(path)
                     i += 1
                     self.counter += 1
@@ -581,9 +597,9 @@ class MasterProcess:
 
             log_master("Bit Flip...")
             
-            mutate_seq_walking_bits_array(payload_array,          self.__bitflip_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
-            mutate_seq_two_walking_bits_array(payload_array,      self.__bitflip_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
-            mutate_seq_four_walking_bits_array(payload_array,     self.__bitflip_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
+            mutate_seq_bitflip_batch(payload_array, 1,            self.__bitflip_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
+            mutate_seq_bitflip_batch(payload_array, 2,            self.__bitflip_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
+            mutate_seq_bitflip_batch(payload_array, 4,            self.__bitflip_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
 
             if self.use_effector_map and len(payload_array) > 128:
                 self.comm.effector_mode.value = True
@@ -596,7 +612,7 @@ class MasterProcess:
                 self.__commission_effector_map(bitmap)
 
 
-                mutate_seq_walking_byte_array(payload_array,          self.__bitflip_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
+                mutate_seq_bitflip_batch(payload_array, 8,        self.__bitflip_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=limiter_map)
 
             if self.comm.sampling_failed_notifier.value:
                 self.stage_abortion = True
@@ -605,7 +621,7 @@ class MasterProcess:
 
             if self.use_effector_map and len(payload_array) > 128:
                 self.__buffered_handler(None, last_payload=True)
-                effector_map = self.__get_effector_map(self.kafl_state["progress_bitflip"])
+                effector_map = to_byte_map(self.__get_effector_map(self.kafl_state["progress_bitflip"]), len(payload_array))
 
                 effector_map[0] = True;
                 effector_map[len(payload_array)-1] = True;
@@ -625,16 +641,10 @@ class MasterProcess:
                 self.kafl_state["progress_arithmetic_amount"] = arithmetic_range(self.payload, skip_null=self.skip_zero, effector_map=effector_map)
                 self.kafl_state["progress_interesting_amount"] = interesting_range(self.payload, skip_null=self.skip_zero, effector_map=effector_map)
                 self.kafl_state["technique"] = "EFF-SYNC"
-                log_master("Effectormap size is " + str(sum(x is True for x in effector_map)))
-                log_master("Effector arihmetic size is " + str(arithmetic_range(self.payload, skip_null=self.skip_zero, effector_map=effector_map)))
-                log_master("Effector intersting size is " + str(interesting_range(self.payload, skip_null=self.skip_zero, effector_map=effector_map)))
-                new_effector_map = []
-                for i in range(len(effector_map)):
-                    if any(effector_map[i-(i%8):i-(i%8)+8]) and any(limiter_map[i-(i%8):i-(i%8)+8]):
-                        new_effector_map.append(True)
-                    else:
-                        new_effector_map.append(False)
-                effector_map = new_effector_map
+                log_master("Effectormap size is " + str(count_selected(effector_map)))
+                log_master("Effector arihmetic size is " + str(self.kafl_state["progress_arithmetic_amount"]))
+                log_master("Effector intersting size is " + str(self.kafl_state["progress_interesting_amount"]))
+                effector_map = dilate_effector_map(effector_map, limiter_map)
             else:
                 log_master("No effector map!")
                 effector_map = limiter_map
@@ -643,23 +653,23 @@ class MasterProcess:
                 self.kafl_state["progress_interesting_amount"] = interesting_range(self.payload, skip_null=self.skip_zero, effector_map=effector_map)
 
 
-            mutate_seq_two_walking_bytes_array(payload_array,     self.__bitflip_handler, kafl_state=self.kafl_state, effector_map=effector_map)
-            mutate_seq_four_walking_bytes_array(payload_array,    self.__bitflip_handler, kafl_state=self.kafl_state, effector_map=effector_map)
+            mutate_seq_bitflip_batch(payload_array, 16,           self.__bitflip_batch_handler, kafl_state=self.kafl_state, effector_map=effector_map)
+            mutate_seq_bitflip_batch(payload_array, 32,           self.__bitflip_batch_handler, kafl_state=self.kafl_state, effector_map=effector_map)
             self.__buffered_handler(None, last_payload=True)
 
 
             log_master("Arithmetic...")
-            mutate_seq_8_bit_arithmetic_array(payload_array,      self.__arithmetic_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
-            mutate_seq_16_bit_arithmetic_array(payload_array,     self.__arithmetic_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
-            mutate_seq_32_bit_arithmetic_array(payload_array,     self.__arithmetic_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
+            mutate_seq_arithmetic_batch(payload_array, 1,         self.__arithmetic_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
+            mutate_seq_arithmetic_batch(payload_array, 2,         self.__arithmetic_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
+            mutate_seq_arithmetic_batch(payload_array, 4,         self.__arithmetic_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
             self.__buffered_handler(None, last_payload=True)
             self.kafl_state["progress_arithmetic"] = self.kafl_state["progress_arithmetic_amount"]
 
             log_master("Interesting...")
 
-            mutate_seq_8_bit_interesting_array(payload_array,     self.__interesting_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map)
-            mutate_seq_16_bit_interesting_array(payload_array,    self.__interesting_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
-            mutate_seq_32_bit_interesting_array(payload_array,    self.__interesting_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
+            mutate_seq_interesting_batch(payload_array, 1,        self.__interesting_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map)
+            mutate_seq_interesting_batch(payload_array, 2,        self.__interesting_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
+            mutate_seq_interesting_batch(payload_array, 4,        self.__interesting_batch_handler, skip_null=self.skip_zero, kafl_state=self.kafl_state, effector_map=effector_map, set_arith_max=self.arith_max)
             self.__buffered_handler(None, last_payload=True)
             self.kafl_state["progress_interesting"] = self.kafl_state["progress_interesting_amount"]
 
@@ -767,7 +777,7 @@ class MasterProcess:
         finished = False
         payload = None
 
-        self.__init_fuzzing_loop()
+        finished_state = self.__init_fuzzing_loop()
         self.__perform_bechmark()
 
         while True:
@@ -837,30 +847,19 @@ class MasterProcess:
 
     def save_data(self):
         """
-        Method to store an entire master state to JSON file...
+        Method to store the master state, the fuzzing state itself is part of the mapserver snapshot...
         """
-        dump = {}
-        for key, value in self.__dict__.iteritems():
-            if key == "kafl_state":
-                dump[key] = value.save_data()
-
-        with open(self.config.argument_values['work_dir'] + "/master.json", 'w') as outfile:
-            json.dump(dump, outfile, default=json_dumper)
-
         # Save kAFL Filter
         copyfile("/dev/shm/kafl_filter0", self.config.argument_values['work_dir'] + "/kafl_filter0")
 
     def load_data(self):
         """
-        Method to load an entire master state from JSON file...
+        Method to resume from the snapshot, returns True if the deterministic stages of the current payload are done...
         """
-        with open(FuzzerConfiguration().argument_values['work_dir'] + "/master.json", 'r') as infile:
-            dump = json.load(infile)
-            for key, value in dump.iteritems():
-                if key == "kafl_state":
-                    self.kafl_state.load_data(value)
-                else:
-                    setattr(self, key, value)
+        if os.path.exists(self.config.argument_values['work_dir'] + "/kafl_filter0"):
+            copyfile(self.config.argument_values['work_dir'] + "/kafl_filter0", "/dev/shm/kafl_filter0")
 
-        copyfile(self.config.argument_values['work_dir'] + "/kafl_filter0", "/dev/shm/kafl_filter0")
+        current = KaflTree.load_current(Snapshot().read())
+        self.payload = current.load_payload()
+        return current.node_state != KaflNodeState.untouched
 
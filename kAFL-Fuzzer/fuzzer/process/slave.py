@@ -20,13 +20,12 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 
 import os, signal, sys
 import time
-import mmh3
 import struct
 import subprocess
 from fuzzer.communicator import send_msg, recv_msg
 from fuzzer.protocol import *
 from fuzzer.technique.redqueen.hash_fix import HashFixer
-from fuzzer.state import RedqueenState
+from fuzzer.state import RedqueenState, GlobalState
 from common.config import FuzzerConfiguration
 from common.qemu import qemu
 from common.debug import log_slave, log_redq, configure_log_prefix
@@ -47,17 +46,67 @@ def slave_loader(comm, slave_id):
     log_slave("Killed!", slave_id)
 
 
+class LatencyHistogram:
+    """
+    Log-linear histogram of execution latencies in ns, four buckets per
+    power of two. The counts are halved whenever DECAY_LIMIT executions
+    have been recorded, so the percentiles follow the current stage.
+    """
+
+    SUB_BUCKETS = 4
+    DECAY_LIMIT = 1 << 16
+
+    def __init__(self):
+        self.buckets = [0] * ((65 * self.SUB_BUCKETS) + 1)
+        self.count = 0
+
+    def clear(self):
+        self.buckets = [0] * len(self.buckets)
+        self.count = 0
+
+    def record(self, ns):
+        exponent = ns.bit_length()
+        if exponent <= 3:
+            index = ns
+        else:
+            index = (exponent * self.SUB_BUCKETS) | ((ns >> (exponent - 3)) & 3)
+        self.buckets[index] += 1
+        self.count += 1
+        if self.count >= self.DECAY_LIMIT:
+            self.buckets = [value >> 1 for value in self.buckets]
+            self.count = sum(self.buckets)
+
+    def percentile(self, fraction):
+        """ upper bound of the bucket that holds the given fraction of all executions (0 if empty) """
+        target = fraction * self.count
+        total = 0
+        for index, value in enumerate(self.buckets):
+            total += value
+            if value and total >= target:
+                if index < 8:
+                    return index
+                exponent, sub = divmod(index, self.SUB_BUCKETS)
+                return (5 + sub) << (exponent - 3)
+        return 0
+
+
 class SlaveProcess:
 
+    """ executions before the latency histogram replaces the treshold of the sampling stage """
+    LATENCY_SAMPLES = 256
+    LATENCY_PERCENTILE = 0.99
+
     def __init__(self, comm, slave_id, auto_reload=False):
         self.config = FuzzerConfiguration()
         self.redqueen_state = RedqueenState() #globally shared redqueen state
+        self.state = GlobalState()
         self.comm = comm
         self.slave_id = slave_id
         self.counter = 0
-        self.q = qemu(self.slave_id, self.config)
+        self.q = qemu(self.slave_id, self.config, binary_filename=self.comm.binary_filename)
         self.false_positiv_map = set()
         self.stage_tick_treshold = 0
+        self.latencies = LatencyHistogram()
         self.timeout_tick_factor = self.config.config_values["TIMEOUT_TICK_FACTOR"]
         self.auto_reload = auto_reload
         self.soft_reload_counter = 0
@@ -77,8 +126,8 @@ class SlaveProcess:
         except:
             log_slave("restart failed %s"%traceback.format_exc(), self.slave_id)
             while True:
-                self.q.__del__()
-                self.q = qemu(self.slave_id, self.config)
+                self.q.shutdown()
+                self.q = qemu(self.slave_id, self.config, binary_filename=self.comm.binary_filename)
                 if self.q.start():
                     break
                 else:
@@ -90,6 +139,18 @@ class SlaveProcess:
             return False
         return True
 
+    def __update_slave_state(self):
+        self.state.set_slave(self.slave_id, "pt_trashed", self.q.internal_buffer_overflow_counter)
+        self.state.set_slave(self.slave_id, "pt_retries", self.q.pt_retry_counter)
+        self.state.set_slave(self.slave_id, "pt_quarantined", self.q.pt_quarantine_counter)
+        self.state.set_slave(self.slave_id, "tick_treshold", int(self.stage_tick_treshold))
+
+    def __update_tick_treshold(self):
+        """ timeout treshold of the current stage from the latency histogram """
+        if self.latencies.count >= self.LATENCY_SAMPLES:
+            self.stage_tick_treshold = max(self.latencies.percentile(self.LATENCY_PERCENTILE), 1)
+            self.q.set_tick_timeout_treshold(self.stage_tick_treshold * self.timeout_tick_factor)
+
     def __respond_job_req(self, response):
         results = []
         performance = 0.0
@@ -98,6 +159,8 @@ class SlaveProcess:
         jobs = response.data[0]
         methods = response.data[1]
 
+        job_ring = self.comm.get_job_ring(self.slave_id)
+
         self.q.get_bb_delta()
 
         self.comm.slave_locks_A[self.slave_id].acquire()
@@ -114,18 +177,21 @@ class SlaveProcess:
                 payload = ""
                 payload_size = 0
                 if self.comm.slave_termination.value:
+                    job_ring.consume(len(jobs))
                     self.comm.slave_locks_B[self.slave_id].release()
                     send_msg(KAFL_TAG_RESULT, results, self.comm.to_mapserver_queue, source=self.slave_id)
                     return 
+                if self.q.is_quarantined(job_ring, i):
+                    results.append(FuzzingResult(i, False, False, False, jobs[i], self.slave_id, 0.0, methods[i], None, reloaded=False, new_bits=False, qid=self.slave_id))
+                    continue
                 while True:
                     while True:
                         try:
-                            payload, payload_size = self.q.copy_master_payload(self.comm.get_master_payload_shm(self.slave_id), i,
-                                                       self.comm.get_master_payload_shm_size())
+                            payload_size = self.q.copy_job_payload(job_ring, i)
 
-                            start_time = time.time()
-                            bitmap = self.q.send_payload()
-                            performance = time.time() - start_time
+                            bitmap = self.q.send_payload(view=True)
+                            performance = self.q.exec_ns / 1e9
+                            self.latencies.record(self.q.exec_ns)
 
                             methods[i].bb_delta = self.q.get_bb_delta()
                             if methods[i].bb_delta != 0:
@@ -141,17 +207,25 @@ class SlaveProcess:
                     if not bitmap:
                         log_slave("SHM ERROR....", self.slave_id)
                         if not self.__restart_vm():
+                            job_ring.consume(len(jobs))
                             self.comm.slave_locks_B[self.slave_id].release()
                             send_msg(KAFL_TAG_RESULT, results, self.comm.to_mapserver_queue, source=self.slave_id)
                             return
                     else:
                         break
-                
-                new_bits = self.q.copy_bitmap(self.comm.get_bitmap_shm(self.slave_id), i, self.comm.get_bitmap_shm_size(), bitmap, payload, payload_size, effector_mode_hash=effector_mode_hash)
+
+                if self.q.trashed:
+                    log_slave("Quarantine payload that keeps trashing the PT buffer", self.slave_id)
+                    self.q.quarantine_payload(payload_size)
+                    results.append(FuzzingResult(i, False, False, False, jobs[i], self.slave_id, performance, methods[i], None, reloaded=False, new_bits=False, qid=self.slave_id))
+                    continue
+
+                bitmap_hash = self.q.get_bitmap_hash(bitmap)
+                new_bits = self.q.copy_bitmap(self.comm.get_bitmap_shm(self.slave_id), i, self.comm.get_bitmap_shm_size(), bitmap, payload, payload_size, effector_mode_hash=effector_mode_hash, bitmap_hash=bitmap_hash)
                 if new_bits:
                     self.q.copy_mapserver_payload(self.comm.get_mapserver_payload_shm(self.slave_id), i, self.comm.get_mapserver_payload_shm_size())
                 results.append(FuzzingResult(i, self.q.crashed, self.q.timeout, self.q.kasan, jobs[i],
-                                             self.slave_id, performance, methods[i], mmh3.hash64(bitmap), reloaded=(self.q.timeout or self.q.crashed or self.q.kasan), new_bits=new_bits, qid=self.slave_id))
+                                             self.slave_id, performance, methods[i], bitmap_hash, reloaded=(self.q.timeout or self.q.crashed or self.q.kasan), new_bits=new_bits, qid=self.slave_id))
                 
                 self.soft_reload_counter += 1
                 if self.soft_reload_counter >= 10000:
@@ -161,11 +235,16 @@ class SlaveProcess:
             else:
                 results.append(FuzzingResult(i, False, False, False, jobs[i], self.slave_id, 0.0, methods[i], None, reloaded=False, new_bits=False, qid=self.slave_id))
 
+        self.__update_tick_treshold()
+        self.__update_slave_state()
+
         if self.comm.slave_termination.value:
+            job_ring.consume(len(jobs))
             self.comm.slave_locks_B[self.slave_id].release()
             send_msg(KAFL_TAG_RESULT, results, self.comm.to_mapserver_queue, source=self.slave_id)
             return 
 
+        job_ring.consume(len(jobs))
         self.comm.slave_locks_B[self.slave_id].release()
         send_msg(KAFL_TAG_RESULT, results, self.comm.to_mapserver_queue, source=self.slave_id)
 
@@ -179,8 +258,7 @@ class SlaveProcess:
         sampling_rate = response.data[1]
 
         self.stage_tick_treshold = 0
-        sampling_counter = 0
-        sampling_ticks = 0
+        self.latencies.clear()
         error_counter = 0
 
         round_checker = 0
@@ -219,8 +297,7 @@ class SlaveProcess:
                             break
                     else:
                         self.q.submit_sampling_run()
-                        sampling_counter += 1
-                        sampling_ticks = self.q.end_ticks - self.q.start_ticks
+                        self.latencies.record(self.q.exec_ns)
 
                 except:
                     log_slave("Sampling wtf??!", self.slave_id)
@@ -250,16 +327,10 @@ class SlaveProcess:
 
         log_slave("Sampling findished!", self.slave_id)
         
-        if sampling_counter == 0:
-            sampling_counter = 1
-        self.stage_tick_treshold = sampling_ticks / sampling_counter
-        log_slave("sampling_ticks: " + str(sampling_ticks), self.slave_id)
-        log_slave("sampling_counter: " + str(sampling_counter), self.slave_id)
-        log_slave("STAGE_TICK_TRESHOLD: " + str(self.stage_tick_treshold), self.slave_id)
-
-        if self.stage_tick_treshold == 0.0:
-            self.stage_tick_treshold = 1.0
-        self.q.set_tick_timeout_treshold(3 * self.stage_tick_treshold * self.timeout_tick_factor)
+        self.stage_tick_treshold = max(self.latencies.percentile(self.LATENCY_PERCENTILE), 1)
+        log_slave("sampling runs: " + str(self.latencies.count), self.slave_id)
+        log_slave("STAGE_TICK_TRESHOLD: " + str(self.stage_tick_treshold) + "ns", self.slave_id)
+        self.q.set_tick_timeout_treshold(self.stage_tick_treshold * self.timeout_tick_factor)
 
         send_msg(KAFL_TAG_REQ_SAMPLING, bitmap, self.comm.to_master_from_slave_queue, source=self.slave_id)
 
@@ -278,13 +349,13 @@ class SlaveProcess:
         self.q.set_payload(response.data)
         while True:
             try:
-                bitmap = self.q.send_payload()
+                bitmap = self.q.send_payload(view=True)
                 break
             except:
                 log_slave("__respond_bitmap_hash_req failed...", self.slave_id)
                 log_slave("%s"%traceback.format_exc(), self.slave_id)
                 self.__restart_vm()
-        send_msg(KAFL_TAG_REQ_BITMAP_HASH, mmh3.hash64(bitmap), self.comm.to_master_from_slave_queue, source=self.slave_id)
+        send_msg(KAFL_TAG_REQ_BITMAP_HASH, self.q.get_bitmap_hash(bitmap), self.comm.to_master_from_slave_queue, source=self.slave_id)
 
 
     def __respond_benchmark_req(self, response):
@@ -292,7 +363,7 @@ class SlaveProcess:
         benchmark_rate = response.data[1]
         for i in range(benchmark_rate):
             self.q.set_payload(payload)
-            self.q.send_payload()
+            self.q.send_payload(view=True)
             if self.q.crashed or self.q.timeout or self.q.kasan:
                 self.__restart_vm()
         send_msg(KAFL_TAG_REQ_BENCHMARK, None, self.comm.to_master_from_slave_queue, source=self.slave_id)
@@ -340,12 +411,12 @@ class SlaveProcess:
 
         results = []
         i = 0
+        job_ring = self.comm.get_job_ring(self.slave_id)
         self.comm.slave_locks_A[self.slave_id].acquire()
 
         while True:
-                payload, payload_shm_size = self.q.copy_master_payload(self.comm.get_master_payload_shm(self.slave_id), i, self.comm.get_master_payload_shm_size())
-
-                payload_content_len_init = struct.unpack("I", payload[0:4])[0]
+                payload_content_len_init = self.q.copy_job_payload(job_ring, i)
+                payload = job_ring.read_slot(i)
 
                 payload_content_len = perform_trim(payload_content_len_init, self.q.send_payload, self.q.modify_payload_size, self.error_handler)
 
@@ -357,32 +428,37 @@ class SlaveProcess:
                     log_slave("Got payload to fix with size: %d and patches %s"%( payload_content_len, patches), self.slave_id )
 
                     if len(patches):
-                        log_redq("Slave "+str(self.slave_id)+" Orig  Payload: " + repr(payload[4:4+payload_content_len]))
+                        log_redq("Slave "+str(self.slave_id)+" Orig  Payload: " + repr(payload[:payload_content_len]))
                         hash = HashFixer(self.q, self.redqueen_state)
-                        new_payload = hash.try_fix_data(payload[4:4+payload_content_len])
+                        new_payload = hash.try_fix_data(payload[:payload_content_len])
 
                         if new_payload:
                             log_redq("Slave "+str(self.slave_id)+"Fixed Payload: " + repr("".join(map(chr,new_payload))))
-                            payload = payload[:4]+"".join(map(chr,new_payload))
+                            payload = "".join(map(chr,new_payload))
                             self.q.set_payload(new_payload)
 
-                start_time = time.time()
                 bitmap = self.q.send_payload(apply_patches=False)
-                performance = time.time() - start_time
+                if not bitmap:
+                    log_slave("SHM ERROR....", self.slave_id)
+                    if not self.__restart_vm():
+                        job_ring.consume(len(jobs))
+                        self.comm.slave_locks_B[self.slave_id].release()
+                        send_msg(KAFL_TAG_RESULT, results, self.comm.to_mapserver_queue, source=self.slave_id)
+                        return
+                    continue
+                performance = self.q.exec_ns / 1e9
                 log_slave("performance: " + str(1.0/performance) + " -> " + str(performance), self.slave_id)
                 break
-                    
-
-        if not bitmap:
-            log_slave("SHM ERROR....", self.slave_id)
 
+        bitmap_hash = self.q.get_bitmap_hash(bitmap)
         new_bits = self.q.copy_bitmap(self.comm.get_bitmap_shm(self.slave_id), i, self.comm.get_bitmap_shm_size(),
-                                      bitmap, payload, payload_shm_size, effector_mode_hash=None, apply_patches = False)
+                                      bitmap, payload, payload_content_len, effector_mode_hash=None, apply_patches = False, bitmap_hash=bitmap_hash)
         if new_bits:
             self.q.copy_mapserver_payload(self.comm.get_mapserver_payload_shm(self.slave_id), i, self.comm.get_mapserver_payload_shm_size())
         
-        results.append(FuzzingResult(i, self.q.crashed, self.q.timeout, self.q.kasan, jobs[i], self.slave_id, performance, methods[i], mmh3.hash64(bitmap), reloaded=(self.q.timeout or self.q.crashed or self.q.kasan), new_bits=new_bits, qid=self.slave_id))
+        results.append(FuzzingResult(i, self.q.crashed, self.q.timeout, self.q.kasan, jobs[i], self.slave_id, performance, methods[i], bitmap_hash, reloaded=(self.q.timeout or self.q.crashed or self.q.kasan), new_bits=new_bits, qid=self.slave_id))
 
+        job_ring.consume(len(jobs))
         self.comm.slave_locks_B[self.slave_id].release()
         send_msg(KAFL_TAG_RESULT, results, self.comm.to_mapserver_queue, source=self.slave_id)
 
@@ -391,7 +467,7 @@ class SlaveProcess:
 
         if response.tag == KAFL_TAG_JOB:
             self.__respond_job_req(response)
-            send_msg(KAFL_TAG_REQ, self.q.qemu_id, self.comm.to_master_queue, source=self.slave_id)
+            send_msg(KAFL_TAG_REQ, self.slave_id, self.comm.to_master_queue, source=self.slave_id)
 
         elif response.tag == KAFL_TAG_REQ_PING:
             send_msg(KAFL_TAG_REQ_PING, self.q.qemu_id, self.comm.to_master_queue, source=self.slave_id)
@@ -419,18 +495,31 @@ class SlaveProcess:
 
         elif response.tag == KAFL_TAG_REQ_VERIFY:
             self.__respond_verification(response)
-            send_msg(KAFL_TAG_REQ, self.q.qemu_id, self.comm.to_master_queue, source=self.slave_id)
+            send_msg(KAFL_TAG_REQ, self.slave_id, self.comm.to_master_queue, source=self.slave_id)
 
         else:
             log_slave("Received TAG: " + str(response.tag), self.slave_id)
 
+    def __boot_vm(self):
+        """ initial boot, all slaves boot at once (reload_semaphore only throttles restarts) """
+        delay = 0.5
+        while not self.q.start():
+            log_slave("Boot failed, retrying in %.1fs" % delay, self.slave_id)
+            if self.comm.slave_termination.value:
+                return False
+            self.q.shutdown()
+            time.sleep(delay)
+            delay = min(delay * 2, 8.0)
+            self.q = qemu(self.slave_id, self.config, binary_filename=self.comm.binary_filename)
+        return True
+
     def loop(self):
-        self.comm.reload_semaphore.acquire()
-        self.q.start()
-        self.comm.reload_semaphore.release()
-            
+        if not self.__boot_vm():
+            return
+
+        """ the master collects KAFL_TAG_START of every slave before it hands out work """
         send_msg(KAFL_TAG_START, self.q.qemu_id, self.comm.to_master_queue, source=self.slave_id)
-        send_msg(KAFL_TAG_REQ, self.q.qemu_id, self.comm.to_master_queue, source=self.slave_id)
+        send_msg(KAFL_TAG_REQ, self.slave_id, self.comm.to_master_queue, source=self.slave_id)
         while True:
             if self.comm.slave_termination.value:
                 return
@@ -18,6 +18,11 @@ You should have received a copy of the GNU Affero General Public License
 along with Redqueen.  If not, see <http://www.gnu.org/licenses/>. 
 """
 
+import cPickle
+import struct
+from common.debug import logger
+from fuzzer.fuzz_methods import fuzz_methode
+
 class FuzzingResult:
     def __init__(self, pos, crash, timeout, kasan, affected_bytes, slave_id, performance, methode, bitmap_hash, reloaded=False, new_bits=True, qid=0):
         self.pos = pos
@@ -60,3 +65,148 @@ KAFL_TAG_REQ_VERIFY_SYNC =  22
 
 KAFL_TAG_REQ_PING =         23
 KAFL_TAG_UPDATE_REDQUEEN =  24
+
+HOT_TAGS = (KAFL_TAG_REQ, KAFL_TAG_JOB, KAFL_TAG_RESULT)
+
+"""
+Binary record layouts for the hot tags. Everything that does not fit the
+schema (e.g. non-integer affected bytes) makes the sender fall back to pickle,
+the first fallback of every tag is logged.
+"""
+
+_methode = struct.Struct("<BqH")
+_affected = struct.Struct("<i")
+_count = struct.Struct("<I")
+_req = struct.Struct("<i")
+_result = struct.Struct("<IBiidqq")
+
+_RESULT_CRASH =     1 << 0
+_RESULT_TIMEOUT =   1 << 1
+_RESULT_KASAN =     1 << 2
+_RESULT_RELOADED =  1 << 3
+_RESULT_NEW_BITS =  1 << 4
+_RESULT_HASH =      1 << 5
+_RESULT_AFFECTED =  1 << 6
+
+
+def _pack_methode(methode):
+    if methode.redqueen_cmp is None and methode.input_byte is None:
+        extra = ""
+    else:
+        extra = cPickle.dumps((methode.redqueen_cmp, methode.input_byte), cPickle.HIGHEST_PROTOCOL)
+    return _methode.pack(methode.methode_type, methode.bb_delta, len(extra)) + extra
+
+
+def _unpack_methode(data, offset):
+    methode_type, bb_delta, extra_len = _methode.unpack_from(data, offset)
+    offset += _methode.size
+    methode = fuzz_methode(methode_type=methode_type, bb_delta=bb_delta)
+    if extra_len:
+        methode.redqueen_cmp, methode.input_byte = cPickle.loads(data[offset:offset + extra_len])
+        offset += extra_len
+    return methode, offset
+
+
+def _pack_affected(affected_bytes):
+    if affected_bytes is None:
+        return _count.pack(0)
+    return _count.pack(len(affected_bytes)) + struct.pack("<%di" % len(affected_bytes), *affected_bytes)
+
+
+def _unpack_affected(data, offset):
+    num = _count.unpack_from(data, offset)[0]
+    offset += _count.size
+    affected_bytes = list(struct.unpack_from("<%di" % num, data, offset))
+    return affected_bytes, offset + (num * _affected.size)
+
+
+def _pack_req(data):
+    return _req.pack(data)
+
+
+def _unpack_req(data):
+    return _req.unpack_from(data, 0)[0]
+
+
+def _pack_job(data):
+    affected, methods = data
+    assert len(affected) == len(methods)
+    records = [_count.pack(len(methods))]
+    for affected_bytes, methode in zip(affected, methods):
+        records.append(_count.pack(affected_bytes is not None))
+        records.append(_pack_affected(affected_bytes))
+        records.append(_pack_methode(methode))
+    return "".join(records)
+
+
+def _unpack_job(data):
+    num = _count.unpack_from(data, 0)[0]
+    offset = _count.size
+    affected = []
+    methods = []
+    for i in xrange(num):
+        present = _count.unpack_from(data, offset)[0]
+        affected_bytes, offset = _unpack_affected(data, offset + _count.size)
+        methode, offset = _unpack_methode(data, offset)
+        affected.append(affected_bytes if present else None)
+        methods.append(methode)
+    return [affected, methods]
+
+
+def _pack_result(results):
+    records = [_count.pack(len(results))]
+    for r in results:
+        flags = (_RESULT_CRASH if r.crash else 0) | (_RESULT_TIMEOUT if r.timeout else 0) | \
+                (_RESULT_KASAN if r.kasan else 0) | (_RESULT_RELOADED if r.reloaded else 0) | \
+                (_RESULT_NEW_BITS if r.new_bits else 0) | (_RESULT_HASH if r.bitmap_hash else 0) | \
+                (_RESULT_AFFECTED if r.affected_bytes is not None else 0)
+        hash_a, hash_b = r.bitmap_hash if r.bitmap_hash else (0, 0)
+        records.append(_result.pack(r.pos, flags, r.slave_id, r.qid, r.performance, hash_a, hash_b))
+        records.append(_pack_affected(r.affected_bytes))
+        records.append(_pack_methode(r.methode))
+    return "".join(records)
+
+
+def _unpack_result(data):
+    num = _count.unpack_from(data, 0)[0]
+    offset = _count.size
+    results = []
+    for i in xrange(num):
+        pos, flags, slave_id, qid, performance, hash_a, hash_b = _result.unpack_from(data, offset)
+        affected_bytes, offset = _unpack_affected(data, offset + _result.size)
+        methode, offset = _unpack_methode(data, offset)
+        results.append(FuzzingResult(pos, bool(flags & _RESULT_CRASH), bool(flags & _RESULT_TIMEOUT),
+                                     bool(flags & _RESULT_KASAN),
+                                     affected_bytes if flags & _RESULT_AFFECTED else None,
+                                     slave_id, performance, methode,
+                                     (hash_a, hash_b) if flags & _RESULT_HASH else None,
+                                     reloaded=bool(flags & _RESULT_RELOADED),
+                                     new_bits=bool(flags & _RESULT_NEW_BITS), qid=qid))
+    return results
+
+
+_packers = {
+    KAFL_TAG_REQ:       (_pack_req, _unpack_req),
+    KAFL_TAG_JOB:       (_pack_job, _unpack_job),
+    KAFL_TAG_RESULT:    (_pack_result, _unpack_result),
+}
+
+
+_fallbacks = set()
+
+
+def pack_data(tag, data):
+    """ returns the binary encoding of data or None if the tag/data has no schema """
+    if tag not in _packers:
+        return None
+    try:
+        return _packers[tag][0](data)
+    except (struct.error, TypeError, AttributeError, ValueError, AssertionError) as e:
+        if tag not in _fallbacks:
+            _fallbacks.add(tag)
+            logger("[PROTOCOL]\tTag %d does not fit its binary schema, falling back to pickle: %s" % (tag, repr(e)))
+        return None
+
+
+def unpack_data(tag, data):
+    return _packers[tag][1](data)
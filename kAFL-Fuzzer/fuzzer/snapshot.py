@@ -0,0 +1,95 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import struct
+import zlib
+
+from common.config import FuzzerConfiguration
+from common.writer import AsyncWriter
+
+
+class Snapshot:
+    """
+    Binary checkpoint of the fuzzer state (<work_dir>/snapshot.bin): a
+    versioned header followed by tagged sections of raw arrays, each with
+    a CRC32. The file is replaced atomically by the AsyncWriter, so a crash
+    leaves either the old or the new snapshot behind. Data that only grows
+    (node edges) is appended to a side file in the same writer queue and
+    referenced by offset, so every snapshot only writes what is new.
+    """
+
+    MAGIC = "KAFLSNAP"
+    VERSION = 2
+
+    """ magic, version, number of sections """
+    HEADER = struct.Struct("<8sII")
+    """ tag, crc32, length """
+    SECTION = struct.Struct("<4sIQ")
+
+    def __init__(self, work_dir=None):
+        if work_dir is None:
+            work_dir = FuzzerConfiguration().argument_values['work_dir']
+        self.path = work_dir + "/snapshot.bin"
+        self.edges_path = work_dir + "/snapshot.edges"
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def write(self, sections):
+        """ sections: list of (tag, data) """
+        chunks = [self.HEADER.pack(self.MAGIC, self.VERSION, len(sections))]
+        for tag, data in sections:
+            chunks.append(self.SECTION.pack(tag, zlib.crc32(data) & 0xFFFFFFFF, len(data)))
+            chunks.append(data)
+        AsyncWriter().write(self.path, "".join(chunks))
+
+    def append_edges(self, data):
+        AsyncWriter().append(self.edges_path, data)
+
+    def read(self):
+        """ {tag: data}, raises ValueError if the snapshot is damaged or of another version """
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if len(data) < self.HEADER.size:
+            raise ValueError("truncated snapshot")
+        magic, version, count = self.HEADER.unpack_from(data, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("unsupported snapshot (version %d expected)" % self.VERSION)
+
+        sections = {}
+        offset = self.HEADER.size
+        for _ in range(count):
+            if offset + self.SECTION.size > len(data):
+                raise ValueError("truncated snapshot")
+            tag, crc, length = self.SECTION.unpack_from(data, offset)
+            offset += self.SECTION.size
+            section = data[offset:offset + length]
+            if len(section) != length or zlib.crc32(section) & 0xFFFFFFFF != crc:
+                raise ValueError("damaged snapshot section " + tag)
+            sections[tag] = section
+            offset += length
+        return sections
+
+    def read_edges(self):
+        if not os.path.exists(self.edges_path):
+            return ""
+        with open(self.edges_path, 'rb') as f:
+            return f.read()
@@ -22,7 +22,10 @@ import time
 import base64
 from collections import deque
 from multiprocessing import Process, Manager, Lock
+import mmap
+import struct
 from common.util import Singleton
+from common.config import FuzzerConfiguration
 from common.debug import log_redq
 import os 
 
@@ -105,129 +108,194 @@ class RedqueenState:
             os.fsync(f.fileno())
 
 class GlobalState:
+    """
+    Fuzzer statistics shared by all processes through a fixed-layout mmap'd
+    segment. Every field has exactly one writing process and lives in that
+    writer's slot (cache-line aligned), so updates are plain memory stores
+    instead of round trips to a multiprocessing.Manager. Strings hold at most
+    STRING_SIZE bytes and are guarded by a per-field sequence counter so
+    readers never observe torn values.
+    """
     __metaclass__ = Singleton
 
-    def __init__(self, performance_rb_limit=5, max_performance_rb_limit=100):
-        manager = Manager()
-        self.values = manager.dict()
-        self.performance_rb_list = manager.list()
-        self.max_performance_rb_list = manager.list()
-
+    SHM_FILE = "/dev/shm/kafl_global_state"
+    SLOT_ALIGNMENT = 64
+    STRING_SIZE = 256
+
+    """ (writer, [(key, type)]) -- q: integer, d: float, ?: boolean, s: string """
+    LAYOUT = [
+        ("master", [
+            ("progress_redqueen", "q"), ("progress_bitflip", "q"), ("progress_arithmetic", "q"),
+            ("progress_interesting", "q"), ("progress_havoc", "q"), ("progress_specific", "q"),
+            ("progress_requeen_amount", "q"), ("progress_bitflip_amount", "q"),
+            ("progress_arithmetic_amount", "q"), ("progress_interesting_amount", "q"),
+            ("progress_havoc_amount", "q"), ("progress_specific_amount", "q"),
+            ("total", "q"), ("payload_size", "q"), ("slaves_ready", "q"),
+            ("performance_rb_position", "q"), ("max_performance_rb_position", "q"),
+            ("performance_rb_count", "q"), ("max_performance_rb_count", "q"),
+            ("inittime", "d"), ("runtime", "d"), ("time_redqueen", "d"),
+            ("loading", "?"), ("reload", "?"),
+            ("technique", "s"), ("payload", "s"), ("interface_str", "s"), ("target_str", "s"),
+        ]),
+        ("mapserver", [
+            ("level", "q"), ("max_level", "q"),
+            ("path_pending", "q"), ("path_unfinished", "q"), ("fav_pending", "q"), ("fav_unfinished", "q"),
+            ("crash", "q"), ("crash_unique", "q"), ("kasan", "q"), ("kasan_unique", "q"),
+            ("timeout", "q"), ("timeout_unique", "q"),
+            ("cycles", "q"), ("hashes", "q"), ("favorites", "q"), ("pending", "q"),
+            ("preliminary", "q"), ("imports", "q"),
+            ("ratio_coverage", "d"), ("ratio_bits", "d"), ("last_hash_time", "d"),
+        ]),
+        ("ui", [
+            ("performance", "q"),
+        ]),
+    ]
+
+    """ fields of every slave, each slave writes its own slot """
+    SLAVE_LAYOUT = [
+        ("pt_trashed", "q"), ("pt_retries", "q"), ("pt_quarantined", "q"), ("tick_treshold", "q"),
+    ]
+
+    def __init__(self, performance_rb_limit=5, max_performance_rb_limit=100, slaves=None):
         self.performance_rb_limit = performance_rb_limit
         self.max_performance_rb_limit = max_performance_rb_limit
-
-
-        """ tree.py values """
-        self.values['level'] = 1
-        self.values['max_level'] = 1
-
-        self.values['ratio_coverage'] = 0.0
-        self.values['ratio_bits'] = 0.0
-
-        self.values['path_pending'] = 0
-        self.values['path_unfinished'] = 0
-        self.values['fav_pending'] = 0
-        self.values['fav_unfinished'] = 0
-
-        self.values['crash'] = 0
-        self.values['crash_unique'] = 0
-        self.values['kasan'] = 0
-        self.values['kasan_unique'] = 0
-        self.values['timeout'] = 0
-        self.values['timeout_unique'] = 0
-
-
-
-        """ master.py values """
-        self.values['progress_redqueen'] = 0
-        self.values['progress_bitflip'] = 0
-        self.values['progress_arithmetic'] = 0
-        self.values['progress_interesting'] = 0
-        self.values['progress_havoc'] = 0
-        self.values['progress_specific'] = 0
-
-        self.values['progress_requeen_amount'] = 0
-        self.values['progress_bitflip_amount'] = 0
-        self.values['progress_arithmetic_amount'] = 0
-        self.values['progress_interesting_amount'] = 0
-        self.values['progress_havoc_amount'] = 0
-        self.values['progress_specific_amount'] = 0
-
-        self.values['interface_str'] = ""
-        self.values['target_str'] = ""
-        self.values['technique'] = ""
-        self.values['total'] = 0
-
-        self.values['cycles'] = 0
-        self.values['hashes'] = 0
-        self.values['favorites'] = 0
-        self.values['pending'] = 0
-        self.values['payload_size'] = 0
+        if slaves is None:
+            slaves = (FuzzerConfiguration().argument_values or {}).get('p', 1)
+        self.slaves = slaves
+
+        self.fields = {}
+        self.regions = {}
+        offset = 0
+        for writer, fields in self.LAYOUT:
+            offset = self.__align(offset)
+            start = offset
+            for key, kind in fields:
+                if kind == "s":
+                    self.fields[key] = (kind, offset, None)
+                    offset += 8 + self.STRING_SIZE
+                else:
+                    packer = struct.Struct("<" + kind)
+                    self.fields[key] = (kind, offset, packer)
+                    offset += packer.size
+            self.regions[writer] = (start, offset)
+            if writer == "master":
+                offset = self.__align(offset)
+                self.performance_rb_offset = offset
+                offset += 8 * self.performance_rb_limit
+                self.max_performance_rb_offset = offset
+                offset += 8 * self.max_performance_rb_limit
+
+        self.slave_fields = {}
+        slave_size = 0
+        for key, kind in self.SLAVE_LAYOUT:
+            packer = struct.Struct("<" + kind)
+            self.slave_fields[key] = (slave_size, packer)
+            slave_size += packer.size
+        self.slave_offset = self.__align(offset)
+        self.slave_size = self.__align(slave_size)
+        offset = self.slave_offset + self.slaves * self.slave_size
+        self.size = self.__align(offset)
+
+        fd = os.open(self.SHM_FILE, os.O_RDWR | os.O_SYNC | os.O_CREAT)
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.size)
+        self.shm = mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        os.close(fd)
+
+        self.rb = struct.Struct("<%dq" % self.performance_rb_limit)
+        self.max_rb = struct.Struct("<%dq" % self.max_performance_rb_limit)
+        self.string_header = struct.Struct("<II")
+
+        self['level'] = 1
+        self['max_level'] = 1
 
         init_time = time.time()
-        self.values['inittime'] = init_time
-        self.values['runtime'] = init_time
-        self.values['last_hash_time'] = init_time
-
-        self.values['performance_rb_position'] = 0
-        self.values['max_performance_rb_position'] = 0
-
-        self.values['preliminary'] = 0
-        self.values['imports'] = 0
-
-
-        self.values["time_redqueen"] = 0
-        """ misc """
-        self.values["payload"] = ""
-        self.values["loading"] = True
-        self.values["reload"] = False
-        self.values["slaves_ready"] = 0
+        self['inittime'] = init_time
+        self['runtime'] = init_time
+        self['last_hash_time'] = init_time
+
+        self["loading"] = True
+
+    def __align(self, offset):
+        return (offset + self.SLOT_ALIGNMENT - 1) & ~(self.SLOT_ALIGNMENT - 1)
+
+    def __get_string(self, offset):
+        while True:
+            seq, length = self.string_header.unpack_from(self.shm, offset)
+            if seq & 1:
+                continue
+            value = self.shm[offset + 8:offset + 8 + length]
+            if self.string_header.unpack_from(self.shm, offset)[0] == seq:
+                return value
+
+    def __set_string(self, offset, value):
+        value = str(value)
+        assert len(value) <= self.STRING_SIZE, "string field exceeds %d bytes" % self.STRING_SIZE
+        seq = self.string_header.unpack_from(self.shm, offset)[0]
+        self.string_header.pack_into(self.shm, offset, seq + 1, 0)
+        self.shm[offset + 8:offset + 8 + len(value)] = value
+        self.string_header.pack_into(self.shm, offset, seq + 2, len(value))
+
+    def __ring_append(self, value, offset, limit, position_key, count_key):
+        position = self[position_key]
+        if position == limit:
+            position = 0
+        struct.pack_into("<q", self.shm, offset + 8 * position, value)
+        self[position_key] = position + 1
+        if self[count_key] < limit:
+            self[count_key] += 1
+
+    def __ring_average(self, packer, offset, count_key):
+        count = self[count_key]
+        if count == 0:
+            return 0
+        return sum(packer.unpack_from(self.shm, offset)[:count]) / count
 
     def update_performance(self, value):
         """ performance ring buffer """
-        if len(self.performance_rb_list) < self.performance_rb_limit:
-            self.performance_rb_list.append(value)
-        else:
-            if self.values['performance_rb_position'] == self.performance_rb_limit:
-                self.values['performance_rb_position'] = 0
-            self.performance_rb_list[self.values['performance_rb_position']] = value
-        self.values['performance_rb_position'] += 1
+        self.__ring_append(value, self.performance_rb_offset, self.performance_rb_limit,
+                           'performance_rb_position', 'performance_rb_count')
 
         """ max performance ring buffer """
-        if len(self.max_performance_rb_list) < self.max_performance_rb_limit:
-            self.max_performance_rb_list.append(value)
-        else:
-            if self.values['max_performance_rb_position'] == self.max_performance_rb_limit:
-                self.values['max_performance_rb_position'] = 0
-            self.max_performance_rb_list[self.values['max_performance_rb_position']] = value
-        self.values['max_performance_rb_position'] += 1
+        self.__ring_append(value, self.max_performance_rb_offset, self.max_performance_rb_limit,
+                           'max_performance_rb_position', 'max_performance_rb_count')
 
     def get_performance(self):
-        try:
-            if len(self.performance_rb_list) == 0:
-                return 0
-            else:
-                return (sum(self.performance_rb_list)/len(self.performance_rb_list))
-        except:
-            return 0
+        return self.__ring_average(self.rb, self.performance_rb_offset, 'performance_rb_count')
 
     def get_max_performance(self):
-        try:
-            if len(self.max_performance_rb_list) == 0:
-                return 0
-            else:
-                return (sum(self.max_performance_rb_list)/len(self.max_performance_rb_list))
-        except:
-            return 0
+        return self.__ring_average(self.max_rb, self.max_performance_rb_offset, 'max_performance_rb_count')
 
     def __getitem__(self, key):
-        return self.values[key]
+        kind, offset, packer = self.fields[key]
+        if kind == "s":
+            return self.__get_string(offset)
+        return packer.unpack_from(self.shm, offset)[0]
+
+    def __setitem__(self, key, item):
+        kind, offset, packer = self.fields[key]
+        if kind == "s":
+            self.__set_string(offset, item)
+        else:
+            packer.pack_into(self.shm, offset, item)
+
+    def get_slave(self, slave_id, key):
+        offset, packer = self.slave_fields[key]
+        return packer.unpack_from(self.shm, self.slave_offset + slave_id * self.slave_size + offset)[0]
+
+    def set_slave(self, slave_id, key, value):
+        offset, packer = self.slave_fields[key]
+        packer.pack_into(self.shm, self.slave_offset + slave_id * self.slave_size + offset, value)
 
-    def __setitem__(self, key, item): 
-        self.values[key] = item
+    def sum_slaves(self, key):
+        return sum(self.get_slave(slave_id, key) for slave_id in range(self.slaves))
 
-    def save_data(self):
-        pass
+    def save_data(self, writer):
+        """ raw copy of the fields owned by writer """
+        start, end = self.regions[writer]
+        return self.shm[start:end]
 
-    def load_data(self, data):
-        pass
+    def load_data(self, writer, data):
+        start, end = self.regions[writer]
+        if len(data) == end - start:
+            self.shm[start:end] = data
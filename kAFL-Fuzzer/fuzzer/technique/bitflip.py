@@ -20,37 +20,26 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 
 __author__ = 'sergej'
 from common.debug import log_master
+from ctypes import c_uint32, c_uint64, byref
+from fuzzer.technique.helper import to_byte_map, count_selected, selected_runs, count_windows, get_nativ
 
 def bitflip_range(data, skip_null=False, effector_map=None):
     if len(data) == 0:
         return 0
 
     if effector_map:
-        effector_map = effector_map[:len(data)]
-        data_len = sum(x is True for x in effector_map)
-        data_tmp = ""
-        for i in range(len(data)):
-            if effector_map[i]:
-                data_tmp += data[i]
+        effector_map = to_byte_map(effector_map, len(data))
+        data_len = count_selected(effector_map)
     else:
         data_len = len(data)
-        data_tmp = data
     num = data_len*8
     num += data_len*7
     num += data_len*5
     num += data_len
     if effector_map:
-        byte_count = 0
-        for i in range(len(data)):
-            if effector_map[i]:
-                byte_count += 1
-                if byte_count >= 2:
-                    num += 1
-                if byte_count >= 4:
-                    num += 1
-
-            else:
-                byte_count = 0
+        runs = selected_runs(effector_map)
+        num += count_windows(runs, 2)
+        num += count_windows(runs, 4)
     else:
         if data_len > 1:
             num += data_len - 1
@@ -60,130 +49,54 @@ def bitflip_range(data, skip_null=False, effector_map=None):
 
 def bitflip8_range(data, skip_null=False, effector_map=None):
     if effector_map:
-        effector_map = effector_map[:len(data)]
-        data_len = sum(x is True for x in effector_map)
-        data_tmp = ""
-        for i in range(len(data)):
-            if effector_map[i]:
-                data_tmp += data[i]
+        data_len = count_selected(to_byte_map(effector_map, len(data)))
     else:
         data_len = len(data)
-        data_tmp = data
     num = data_len*8
     return num
 
-def mutate_seq_walking_bits_array(data, func, skip_null=False, kafl_state=None, effector_map=None):
-    if kafl_state:
-        if skip_null:
-            kafl_state["technique"] = "BIT-FLIP 1 S0"
-        else:
-            kafl_state["technique"] = "BIT-FLIP 1"
-
-    for i in xrange(len(data)*8):
+class BitflipBatch:
+    """
+    Generates the mutations of one bit/byte flip stage (stage = number of
+    flipped bits) natively and in batches, straight into the free slots of
+    a JobBatch.
+    """
+
+    def __init__(self, data, stage, skip_null=False, effector_map=None):
+        self.data = data.tostring()
+        self.stage = stage
+        self.skip_null = skip_null
         if effector_map:
-            if not effector_map[i/8]:
-                continue
-        if data[i/8] == 0x00 and skip_null:
-            func(None, no_data=True)
-            continue
-        data[i/8] ^= (0x80 >> (i % 8))
-        func(data.tostring(), affected_bytes=[0])
-        data[i/8] ^= (0x80 >> (i % 8))
-
-def mutate_seq_two_walking_bits_array(data, func, skip_null=False, kafl_state=None, effector_map=None):
-    if kafl_state:
-        if skip_null:
-            kafl_state["technique"] = "BIT-FLIP 2 S0"
+            self.effector_map = str(to_byte_map(effector_map, len(self.data)))
         else:
-            kafl_state["technique"] = "BIT-FLIP 2"
-
-    for i in range((len(data)*8)-1):
-        if effector_map:
-            if not (effector_map[i/8] or effector_map[(i+1)/8]):
-                continue
-        if data[i/8] == 0x00 and data[(i+1)/8] == 0x00 and skip_null:
-            func(None, no_data=True)
-            continue
-        data[i/8] ^= (0x80 >> (i % 8))
-        data[(i+1)/8] ^= (0x80 >> ((i+1) % 8))
-        func(data.tostring(), affected_bytes=[0])
-        data[i/8] ^= (0x80 >> (i % 8))
-        data[(i+1)/8] ^= (0x80 >> ((i+1) % 8))
-
-def mutate_seq_four_walking_bits_array(data, func, skip_null=False, kafl_state=None, effector_map=None):
+            self.effector_map = None
+        self.cursor = c_uint64(0)
+        self.positions = None
+        self.affected_none = [0]
+
+    def fill(self, job_batch):
+        """ writes as many mutations as job_batch can take, returns their number (0 = stage done) """
+        if self.positions is None or len(self.positions) < job_batch.capacity:
+            self.positions = (c_uint32 * job_batch.capacity)()
+        num = int(get_nativ().bitflip_batch(job_batch.write_address(), job_batch.slot_size, job_batch.free(),
+                                            self.data, len(self.data), self.stage, byref(self.cursor),
+                                            self.effector_map, self.skip_null, self.positions))
+        job_batch.commit(num)
+        return num
+
+    def affected_bytes(self, num):
+        if self.stage == 8:
+            return [[i] for i in self.positions[:num]]
+        return [self.affected_none] * num
+
+
+def mutate_seq_bitflip_batch(data, stage, func, skip_null=False, kafl_state=None, effector_map=None):
+    if stage > 8:
+        skip_null = False
     if kafl_state:
         if skip_null:
-            kafl_state["technique"] = "BIT-FLIP 4 S0"
+            kafl_state["technique"] = "BIT-FLIP " + str(stage) + " S0"
         else:
-            kafl_state["technique"] = "BIT-FLIP 4"
-
-    for i in range( (len(data)*8-3) ):
-        if effector_map:
-            if not (effector_map[i/8] or effector_map[(i+3)/8]):
-                continue
-        if data[i/8] == 0x00 and data[(i+3)/8] == 0x00 and skip_null:
-            func(None, no_data=True)
-            continue
-
-        data[i/8] ^= (0x80 >> (i % 8))
-        data[(i+1)/8] ^= (0x80 >> ((i+1) % 8))
-        data[(i+2)/8] ^= (0x80 >> ((i+2) % 8))
-        data[(i+3)/8] ^= (0x80 >> ((i+3) % 8))
-        #func(data.tostring(), affected_bytes=[i/8,(i+3)/8])
-        func(data.tostring(), affected_bytes=[0])
-        data[i/8] ^= (0x80 >> (i % 8))
-        data[(i+1)/8] ^= (0x80 >> ((i+1) % 8))
-        data[(i+2)/8] ^= (0x80 >> ((i+2) % 8))
-        data[(i+3)/8] ^= (0x80 >> ((i+3) % 8))
-
-def mutate_seq_walking_byte_array(data, func, skip_null=False, kafl_state=None, effector_map=None):
-    if kafl_state:
-        if skip_null:
-            kafl_state["technique"] = "BIT-FLIP 8 S0"
-        else:
-            kafl_state["technique"] = "BIT-FLIP 8"
-
-    for i in range((len(data))):
-        if effector_map:
-            if not effector_map[i]:
-                continue
-        if data[i] == 0x00 and skip_null:
-            func(None, no_data=True)
-            continue
-        data[i] ^= 0xFF
-        func(data.tostring(), affected_bytes=[i])
-        data[i] ^= 0xFF
-
-def mutate_seq_two_walking_bytes_array(data, func, kafl_state=None, effector_map=None):
-    if kafl_state:
-        kafl_state["technique"] = "BIT-FLIP 16"
-
-    if len(data) > 1:
-        for i in range(1, ((len(data)))):
-            if effector_map:
-                if not (effector_map[i] or effector_map[i-1]):
-                    continue
-            data[i] ^= 0xFF
-            data[i-1] ^= 0xFF
-            func( data.tostring(), affected_bytes=[0] )
-            data[i] ^= 0xFF
-            data[i-1] ^= 0xFF
-
-def mutate_seq_four_walking_bytes_array(data, func, kafl_state=None, effector_map=None):
-    if kafl_state:
-        kafl_state["technique"] = "BIT-FLIP 32"
+            kafl_state["technique"] = "BIT-FLIP " + str(stage)
 
-    if len(data) > 3:
-        for i in range(3, (len(data))):
-            if effector_map:
-                if not (effector_map[i] or effector_map[i-1] or effector_map[i-2] or effector_map[i-3]):
-                    continue
-            data[i-0] ^= 0xFF
-            data[i-1] ^= 0xFF
-            data[i-2] ^= 0xFF
-            data[i-3] ^= 0xFF
-            func(data.tostring(), affected_bytes=[0])
-            data[i-0] ^= 0xFF
-            data[i-1] ^= 0xFF
-            data[i-2] ^= 0xFF
-            data[i-3] ^= 0xFF
+    func(BitflipBatch(data, stage, skip_null=skip_null, effector_map=effector_map))
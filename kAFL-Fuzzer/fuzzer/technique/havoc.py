@@ -18,13 +18,14 @@ You should have received a copy of the GNU Affero General Public License
 along with Redqueen.  If not, see <http://www.gnu.org/licenses/>. 
 """
 __author__ = 'sergej'
-import glob
 
 from array import array
 from fuzzer.technique.helper import *
 from fuzzer.technique.havoc_handler import *
 from common.config import FuzzerConfiguration
 from common.debug import logger
+from fuzzer.corpus import CorpusStore
+from fuzzer.tree import KaflNodeType
 
 def load_dict(file_name):
     f = open(file_name)
@@ -43,8 +44,7 @@ if FuzzerConfiguration().argument_values["I"]:
     append_handler(havoc_dict)
     append_handler(havoc_dict)
 
-location_findings = FuzzerConfiguration().argument_values['work_dir'] + "/findings/"
-location_corpus = FuzzerConfiguration().argument_values['work_dir'] + "/corpus/"
+SPLICE_NODE_TYPES = (KaflNodeType.regular, KaflNodeType.crash, KaflNodeType.kasan, KaflNodeType.timeout)
 
 def havoc_range(perf_score):
 
@@ -58,33 +58,32 @@ def havoc_range(perf_score):
 
 def mutate_seq_havoc_array(data, func, max_iterations, stacked=True, resize=False, files_to_splice=None):
 
-    reseed()
-    if resize:
-        copy = array('B', data.tostring() + data.tostring())
-    else:
-        copy = array('B', data.tostring())
+    run = reseed()
+    logger("Havoc run %d (seed: %x, stream: %d)" % (run, havoc_random.base_seed, havoc_random.stream))
 
-    cnt = 0
-    for i in range(max_iterations):
+    payload = data.tostring()
+    buf = HavocBuffer()
+    for i in xrange(max_iterations):
 
-        copy = array('B', data.tostring())
+        buf.load(payload)
 
         value = RAND(AFL_HAVOC_STACK_POW2)
 
-        for j in range(1 << (1 + value)):
+        for j in xrange(1 << (1 + value)):
             handler = havoc_handler[RAND(len(havoc_handler))]
-            copy = handler(copy)
-            if len(copy) >= 64<<10:
-                copy = copy[:(64<<10)]
-        func(copy.tostring())
-    pass
+            handler(buf)
+            buf.truncate(64<<10)
+        func(buf)
+
+
+def splice_candidates():
+    """ corpus and finding payloads (everything but preliminary inputs) """
+    store = CorpusStore()
+    keys = store.keys(SPLICE_NODE_TYPES)
+    shuffle(keys)
+    for key in keys:
+        yield store.get(*key)
 
 
 def mutate_seq_splice_array(data, func, max_iterations, kafl_state, stacked=True, resize=False):
-    files = []
-    files+=glob.glob(location_findings + "crash/*")
-    files+=glob.glob(location_findings + "kasan/*")
-    files+=glob.glob(location_findings + "timeout/*")
-    files+=glob.glob(location_corpus + "*")
-    random.shuffle(files)
-    mutate_seq_havoc_array( havoc_splicing(data, files) , func, max_iterations, stacked=stacked, resize=resize)
+    mutate_seq_havoc_array( havoc_splicing(data, splice_candidates()) , func, max_iterations, stacked=stacked, resize=resize)
@@ -21,30 +21,84 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 __author__ = 'sergej'
 
 from array import array
+from ctypes import addressof, c_uint8, memmove
 
 from fuzzer.technique.helper import *
-from common.util import read_binary_file, find_diffs
+from common.util import find_diffs
 from common.debug import logger,log_redq, log_master
 
-def insert_word(data, charset, start, term):
-    if len(data) >= 2:
-        offset = RAND(len(data))
-        if RAND(2) > 1:
-            repllen = 0 #plain insert
+HAVOC_BUFFER_SIZE = 128 << 10
+
+
+class HavocBuffer:
+    """
+    Preallocated input which all havoc operators edit in place. Only the
+    first size bytes of data are valid; the bytearray itself never changes
+    its length, so inserts and deletes are memmoves inside of it.
+    """
+
+    def __init__(self, capacity=HAVOC_BUFFER_SIZE):
+        self.capacity = capacity
+        self.data = bytearray(capacity)
+        self.address = addressof(c_uint8.from_buffer(self.data))
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def load(self, payload):
+        payload = payload[:self.capacity]
+        self.data[:len(payload)] = payload
+        self.size = len(payload)
+
+    def truncate(self, size):
+        if self.size > size:
+            self.size = size
+
+    def tostring(self):
+        return str(self.data[:self.size])
+
+    def delete(self, pos, length):
+        memmove(self.address + pos, self.address + pos + length, self.size - pos - length)
+        self.size -= length
+
+    def insert(self, pos, chunk):
+        length = min(len(chunk), self.capacity - self.size)
+        memmove(self.address + pos + length, self.address + pos, self.size - pos)
+        self.data[pos:pos + length] = chunk[:length]
+        self.size += length
+
+    def replace(self, pos, length, chunk):
+        """ replaces data[pos:pos+length] by chunk """
+        if len(chunk) < length:
+            self.data[pos:pos + len(chunk)] = chunk
+            self.delete(pos + len(chunk), length - len(chunk))
         else:
-            replen = RAND(len(data)-offset)
+            self.data[pos:pos + length] = chunk[:length]
+            self.insert(pos + length, chunk[length:])
+
+    def overwrite(self, pos, chunk):
+        """ writes chunk at pos, the buffer grows if chunk reaches beyond its end """
+        end = min(pos + len(chunk), self.capacity)
+        self.data[pos:end] = chunk[:end - pos]
+        if end > self.size:
+            self.size = end
 
-        word_length = min(len(data)-offset, RAND(10)+1)
 
-        head = data[:offset].tostring()
-        tail = data[offset+replen:].tostring()
+def insert_word(buf, charset, start, term):
+    if buf.size >= 2:
+        offset = RAND(buf.size)
+        if RAND(2) > 1:
+            replen = 0 #plain insert
+        else:
+            replen = RAND(buf.size-offset)
+
+        word_length = min(buf.size-offset, RAND(10)+1)
 
         body ="".join( [charset[RAND(len(charset))] for _ in xrange(word_length-1) ] )
-        inputstr = head+term+body+term+tail
-        return array("B", inputstr)
-    return data
+        buf.replace(offset, replen, term+body+term)
 
-def havoc_insert_line(data):
+def havoc_insert_line(buf):
     alpha = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxy"
     num = "0123456789.,x"
     special = "!\"$%&/()=?`'#+*+-_,.;:\\{[]}<>"
@@ -52,133 +106,121 @@ def havoc_insert_line(data):
     terminator = ["\n"," ","\0",'""',"'", "", " ADF\n"]
     start_term = terminator[RAND(len(terminator))]
     end_term = terminator[RAND(len(terminator))]
-    return insert_word(data, charsets[RAND(len(charsets))], start_term, end_term)
+    insert_word(buf, charsets[RAND(len(charsets))], start_term, end_term)
 
-def havoc_perform_bit_flip(data):
-    if len(data) >= 1:
-        bit = RAND(len(data) << 3)
-        data[bit/8] ^= 0x80 >> (bit % 8)
-    return data
+def havoc_perform_bit_flip(buf):
+    if buf.size >= 1:
+        bit = RAND(buf.size << 3)
+        buf.data[bit/8] ^= 0x80 >> (bit % 8)
 
 
-def havoc_perform_insert_interesting_value_8(data):
-    if len(data) >= 1:
-        offset = RAND(len(data))
+def havoc_perform_insert_interesting_value_8(buf):
+    if buf.size >= 1:
+        offset = RAND(buf.size)
         value_index = RAND(len(interesting_8_Bit))
-        data[offset] = in_range_8(interesting_8_Bit[value_index])
-    return data
+        buf.data[offset] = in_range_8(interesting_8_Bit[value_index])
 
 
-def havoc_perform_insert_interesting_value_16(data):
-    if len(data) >= 2:
+def havoc_perform_insert_interesting_value_16(buf):
+    if buf.size >= 2:
         little = RAND(2)
-        pos = RAND(len(data)-1)
+        pos = RAND(buf.size-1)
         value_index = RAND(len(interesting_16_Bit))
         interesting_value = in_range_16(interesting_16_Bit[value_index])
         if little == 0:
             interesting_value = swap_16(interesting_value)
-        store_16(data, pos, interesting_value)
-    return data
+        store_16(buf.data, pos, interesting_value)
 
 
-def havoc_perform_insert_interesting_value_32(data):
-    if len(data) >= 4:
+def havoc_perform_insert_interesting_value_32(buf):
+    if buf.size >= 4:
 
         little = RAND(2)
-        pos = RAND(len(data)-3)
+        pos = RAND(buf.size-3)
         interesting_value = in_range_32(interesting_32_Bit[RAND(len(interesting_32_Bit))])
         if little == 0:
             interesting_value = swap_32(interesting_value)
-        store_32(data, pos, interesting_value)
-    return data
+        store_32(buf.data, pos, interesting_value)
 
 
-def havoc_perform_byte_subtraction_8(data):
-    if len(data) >= 1:
+def havoc_perform_byte_subtraction_8(buf):
+    if buf.size >= 1:
         delta = RAND(AFL_ARITH_MAX)
-        pos = RAND(len(data))
-        value = load_8(data, pos)
+        pos = RAND(buf.size)
+        value = load_8(buf.data, pos)
         value -= 1 + delta
-        store_8(data, pos, value)
-    return data
+        store_8(buf.data, pos, value)
 
 
-def havoc_perform_byte_addition_8(data):
-    if len(data) >= 1:
+def havoc_perform_byte_addition_8(buf):
+    if buf.size >= 1:
         delta = RAND(AFL_ARITH_MAX)
-        pos = RAND(len(data))
-        value = load_8(data, pos)
+        pos = RAND(buf.size)
+        value = load_8(buf.data, pos)
         value += 1 + delta
-        store_8(data, pos, value)
-    return data
+        store_8(buf.data, pos, value)
 
 
-def havoc_perform_byte_subtraction_16(data):
-    if len(data) >= 2:
+def havoc_perform_byte_subtraction_16(buf):
+    if buf.size >= 2:
         little = RAND(2)
-        pos = RAND(len(data)-1)
-        value = load_16(data, pos)
+        pos = RAND(buf.size-1)
+        value = load_16(buf.data, pos)
         if little == 0:
             value = swap_16(swap_16(value) - (1 + RAND(AFL_ARITH_MAX)))
         else:
             value -= 1 + RAND(AFL_ARITH_MAX)
-        store_16(data, pos, value)
-    return data
+        store_16(buf.data, pos, value)
 
 
-def havoc_perform_byte_addition_16(data):
-    if len(data) >= 2:
+def havoc_perform_byte_addition_16(buf):
+    if buf.size >= 2:
         little = RAND(2)
-        pos = RAND(len(data)-1)
-        value = load_16(data, pos)
+        pos = RAND(buf.size-1)
+        value = load_16(buf.data, pos)
         if little == 0:
             value = swap_16(swap_16(value) + (1 + RAND(AFL_ARITH_MAX)))
         else:
             value += 1 + RAND(AFL_ARITH_MAX)
-        store_16(data, pos, value)
-    return data
+        store_16(buf.data, pos, value)
 
 
-def havoc_perform_byte_subtraction_32(data):
-    if len(data) >= 4:
+def havoc_perform_byte_subtraction_32(buf):
+    if buf.size >= 4:
         little = RAND(2)
-        pos = RAND(len(data)-3)
-        value = load_32(data, pos)
+        pos = RAND(buf.size-3)
+        value = load_32(buf.data, pos)
         if little == 0:
             value = swap_32(swap_32(value) - (1 + RAND(AFL_ARITH_MAX)))
         else:
             value -= 1 + RAND(AFL_ARITH_MAX)
-        store_32(data, pos, value)
-    return data
+        store_32(buf.data, pos, value)
 
-def havoc_perform_byte_addition_32(data):
-    if len(data) >= 4:
+def havoc_perform_byte_addition_32(buf):
+    if buf.size >= 4:
         little = RAND(2)
-        pos = RAND(len(data)-3)
-        value = load_32(data, pos)
+        pos = RAND(buf.size-3)
+        value = load_32(buf.data, pos)
         if little == 0:
             value = swap_32(swap_32(value) + (1 + RAND(AFL_ARITH_MAX)))
         else:
             value += 1 + RAND(AFL_ARITH_MAX)
-        store_32(data, pos, value)
-    return data
+        store_32(buf.data, pos, value)
 
-def havoc_perform_set_random_byte_value(data):
-    if len(data) >= 1:
+def havoc_perform_set_random_byte_value(buf):
+    if buf.size >= 1:
         delta = 1 + RAND(0xff)
-        data[RAND(len(data))] ^= delta
-    return data
+        buf.data[RAND(buf.size)] ^= delta
 
-def havoc_perform_delete_random_byte(data):
-    if len(data) >= 2:
-        del_length = AFL_choose_block_len(len(data) - 1)
-        del_from = RAND(len(data) - del_length + 1)
-        data = data[:del_from]+data[del_from+del_length:]
-    return data
+def havoc_perform_delete_random_byte(buf):
+    if buf.size >= 2:
+        del_length = AFL_choose_block_len(buf.size - 1)
+        del_from = RAND(buf.size - del_length + 1)
+        buf.delete(del_from, del_length)
 
-def havoc_perform_clone_random_byte(data):
-    temp_len = len(data)
-    if len(data) > 2:
+def havoc_perform_clone_random_byte(buf):
+    temp_len = buf.size
+    if buf.size > 2:
         if (temp_len + HAVOC_BLK_LARGE) < KAFL_MAX_FILE:
             actually_clone = RAND(4);
             if actually_clone != 0:
@@ -190,40 +232,32 @@ def havoc_perform_clone_random_byte(data):
 
             clone_to   = RAND(temp_len);
 
-            head = data[:clone_to].tostring()
-
             if actually_clone != 0:
-                body = data[clone_from: clone_from+clone_len].tostring()
+                body = buf.data[clone_from: clone_from+clone_len]
             else:
                 if RAND(2) != 0:
                     val = chr(RAND(256))
                 else:
-                    val = chr(data[ RAND(temp_len) ])
-                body = ''.join(val for _ in range(clone_len))
+                    val = chr(buf.data[ RAND(temp_len) ])
+                body = val * clone_len
 
-            tail = data[clone_to:].tostring()
-            data = array('B', head + body + tail)
-    return data
+            buf.insert(clone_to, body)
 
 
-def havoc_perform_byte_seq_override(data):
-    if len(data) >= 2:
-        copy_length = AFL_choose_block_len(len(data) - 1)
-        copy_from = RAND(len(data) - copy_length + 1)
-        copy_to = RAND(len(data) - copy_length + 1)
+def havoc_perform_byte_seq_override(buf):
+    if buf.size >= 2:
+        copy_length = AFL_choose_block_len(buf.size - 1)
+        copy_from = RAND(buf.size - copy_length + 1)
+        copy_to = RAND(buf.size - copy_length + 1)
         if RAND(4) != 0:
             if copy_from != copy_to:
-                chunk = data[copy_from: copy_from + copy_length]
-                for i in range(len(chunk)):
-                    data[i+copy_to] = chunk[i]
+                buf.data[copy_to:copy_to + copy_length] = buf.data[copy_from: copy_from + copy_length]
         else:
             if RAND(2) == 1:
                 value = RAND(256)
             else:
-                value = data[RAND(len(data))]
-            for i in range(copy_length):
-                data[i+copy_to] = value
-    return data
+                value = buf.data[RAND(buf.size)]
+            buf.data[copy_to:copy_to + copy_length] = chr(value) * copy_length
 
 
 def havoc_perform_byte_seq_extra1(data):
@@ -233,11 +267,10 @@ def havoc_perform_byte_seq_extra1(data):
 def havoc_perform_byte_seq_extra2(data):
     pass
 
-def havoc_splicing(data, files=None):
+def havoc_splicing(data, payloads=()):
 
     if len(data) >= 2:
-        for file in files:
-            file_data = read_binary_file(file)
+        for file_data in payloads:
             if len(file_data) < 2:
                 continue
 
@@ -296,7 +329,7 @@ def apply_dict_to_data(data, entry, entry_pos):
         newdata = array('B',data.tostring()[:entry_pos] + entry + data.tostring()[entry_pos+len(entry):])
         return newdata
 
-def havoc_dict(data):
+def havoc_dict(buf):
     global redqueen_dict
     global dict_import
 
@@ -308,15 +341,14 @@ def havoc_dict(data):
         addr = redqueen_addr_list[RAND(len(redqueen_addr_list))]
         dict_values = list(redqueen_dict[addr])
         dict_entry = dict_values[RAND(len(dict_values))]
-        entry_pos = RAND(max([0,len(data)-len(dict_entry)]))
-        return apply_dict_to_data(data,dict_entry,entry_pos)
+        entry_pos = RAND(max([0,buf.size-len(dict_entry)]))
+        buf.overwrite(entry_pos, dict_entry)
 
-    if has_dict:
+    elif has_dict:
         dict_entry = dict_import[RAND(len(dict_import))]
-        dict_entry = dict_entry[:len(data)]
-        entry_pos = RAND(max([0,len(data)-len(dict_entry)]))
-        return apply_dict_to_data(data,dict_entry,entry_pos)
-    return data
+        dict_entry = dict_entry[:buf.size]
+        entry_pos = RAND(max([0,buf.size-len(dict_entry)]))
+        buf.overwrite(entry_pos, dict_entry)
 
 havoc_handler = [havoc_perform_bit_flip,
                  havoc_perform_insert_interesting_value_8,
@@ -21,12 +21,13 @@ __author__ = 'sergej'
 
 import random
 import os
+import itertools
 from ctypes import *
 import ctypes
 import inspect
 import struct
 from common.config import FuzzerConfiguration
-from common.debug import log_master
+from common.debug import log_master, logger
 
 KAFL_MAX_FILE = 1 << 15
 
@@ -45,7 +46,83 @@ interesting_8_Bit = [-128, -1, 0, 1, 16, 32, 64, 100, 127]
 interesting_16_Bit = interesting_8_Bit+[-32768, -129, 128, 255, 256, 512, 1000, 1024, 4096, 32767]
 interesting_32_Bit = interesting_16_Bit+[ -2147483648, -100663046, -32769, 32768, 65535, 65536, 100663045, 2147483647]
 
-random.seed(os.urandom(4))
+try:
+    import fastrand
+except ImportError:
+    fastrand = None
+
+
+class HavocRandom:
+    """
+    Random numbers for the havoc, splicing and dictionary stages. Raw 32 bit
+    values are drawn in bulk (PCG32 of the fastrand module if it is
+    installed, random.Random otherwise) and mapped to [0, n) by Lemire's
+    multiply-shift method. Every havoc run is seeded from (seed, stream,
+    run), so a logged run can be replayed with the same seed.
+    """
+    BUFFER = 4096
+    WORDS = struct.Struct("=%dI" % BUFFER)
+
+    def __init__(self, seed=None, stream=0):
+        self.random = None
+        self.words = ()
+        self.position = 0
+        self.seed(seed, stream=stream)
+
+    def seed(self, seed=None, stream=0):
+        if seed is None:
+            seed = struct.unpack("<Q", os.urandom(8))[0]
+        self.base_seed = seed & 0xFFFFFFFFFFFFFFFF
+        self.stream = stream
+        self.run = 0
+        self.__seed_generator(self.base_seed)
+
+    def next_run(self):
+        self.run += 1
+        self.__seed_generator((self.base_seed + (self.run * 0x9E3779B97F4A7C15)) & 0xFFFFFFFFFFFFFFFF)
+        return self.run
+
+    def __seed_generator(self, state):
+        if fastrand:
+            fastrand.pcg32_srandom(state, self.stream)
+        else:
+            self.random = random.Random((state << 32) | self.stream)
+        self.words = ()
+        self.position = self.BUFFER
+
+    def __refill(self):
+        if fastrand:
+            self.words = self.WORDS.unpack(fastrand.pcg32_fill(self.BUFFER))
+        else:
+            words = self.random.getrandbits(32 * self.BUFFER)
+            self.words = self.WORDS.unpack(('%0*x' % (8 * self.BUFFER, words)).decode("hex"))
+        self.position = 0
+
+    def word(self):
+        if self.position == self.BUFFER:
+            self.__refill()
+        value = self.words[self.position]
+        self.position += 1
+        return value
+
+    def bounded(self, value):
+        """ uniform integer in [0, value) for 0 < value <= 2**32 """
+        if self.position == self.BUFFER:
+            self.__refill()
+        product = self.words[self.position] * value
+        self.position += 1
+        if (product & 0xFFFFFFFF) < value:
+            threshold = (0x100000000 - value) % value
+            while (product & 0xFFFFFFFF) < threshold:
+                product = self.word() * value
+        return product >> 32
+
+
+havoc_random = HavocRandom()
+
+def seed_random(seed=None, stream=0):
+    havoc_random.seed(seed, stream=stream)
+    logger("RNG seed: %x, stream: %d, backend: %s" % (havoc_random.base_seed, stream, "pcg32" if fastrand else "random"))
 
 def AFL_choose_block_len(limit):
     global HAVOC_BLK_SMALL
@@ -93,12 +170,21 @@ def MIN(value_a, value_b):
         return value_a
 
 def reseed():
-    random.seed(os.urandom(4))
+    """ starts the next havoc run, its random sequence is determined by (seed, stream, run) """
+    return havoc_random.next_run()
 
 def RAND(value):
     if value == 0:
         return value
-    return random.randint(0, value-1)
+    if value < 0:
+        raise ValueError("empty range for RAND(%d)" % value)
+    return havoc_random.bounded(value)
+
+def shuffle(items):
+    """ in-place Fisher-Yates shuffle drawing from the havoc RNG """
+    for i in xrange(len(items) - 1, 0, -1):
+        j = RAND(i + 1)
+        items[i], items[j] = items[j], items[i]
 
 def load_8(value, pos):
     return value[pos]
@@ -130,13 +216,13 @@ def store_32(data, pos, value):
 
 
 def in_range_8(value):
-    return ctypes.c_uint8(value).value
+    return value & 0xff
 
 def in_range_16(value):
-    return ctypes.c_uint16(value).value
+    return value & 0xffff
 
 def in_range_32(value):
-    return ctypes.c_uint32(value).value
+    return value & 0xffffffff
 
 
 def swap_16(value):
@@ -165,18 +251,163 @@ def to_string_32(value):
     res1 = struct.pack("<I", value)
     return res1
 
+
+EFFECTOR_BLOCK = 8
+
+def to_byte_map(effector_map, length=None):
+    """ effector/limiter map (list of booleans or bytearray) as bytearray of 0/1 flags """
+    if isinstance(effector_map, bytearray):
+        byte_map = effector_map
+    else:
+        byte_map = bytearray(map(bool, effector_map))
+    if length is not None:
+        byte_map = byte_map[:length]
+    return byte_map
+
+def count_selected(byte_map):
+    return byte_map.count('\x01')
+
+def selected_bytes(data, byte_map):
+    return "".join(itertools.compress(data, byte_map))
+
+def selected_runs(byte_map):
+    """ lengths of all runs of consecutive selected bytes """
+    return [len(run) for run in str(byte_map).split('\x00') if run]
+
+def count_windows(runs, width):
+    """ number of width-byte windows that lie completely inside one of the runs """
+    return sum(run - width + 1 for run in runs if run >= width)
+
+def dilate_effector_map(effector_map, limiter_map):
+    """
+    Selects whole EFFECTOR_BLOCK-byte blocks which contain at least one byte
+    of the effector map and one byte of the limiter map. Blocks are compared
+    as 64-bit words instead of walking the maps byte by byte.
+    """
+    length = len(limiter_map)
+    padded = length + (-length % EFFECTOR_BLOCK)
+    effector_map = to_byte_map(effector_map, padded)
+    effector_map = str(effector_map) + ('\x00' * (padded - len(effector_map)))
+    limiter_map = str(to_byte_map(limiter_map)) + ('\x00' * (padded - length))
+
+    words = "<%dQ" % (padded / EFFECTOR_BLOCK)
+    block_set = '\x01' * EFFECTOR_BLOCK
+    block_clear = '\x00' * EFFECTOR_BLOCK
+    blocks = itertools.izip(struct.unpack(words, effector_map), struct.unpack(words, limiter_map))
+    return bytearray("".join(block_set if e and l else block_clear for e, l in blocks))[:length]
+
+class DetCandidate(Structure):
+    """ one candidate of the arithmetic / interesting value stages (see native/bitmap.c) """
+    _fields_ = [("offset", c_uint32), ("width", c_uint8), ("big_endian", c_uint8),
+                ("padding", c_uint16), ("value", c_uint32)]
+
+
+class CandidateBatch:
+    """
+    Writes the mutations of one arithmetic or interesting value stage into
+    a JobBatch. generator is the native candidate function of the stage,
+    candidates are computed in chunks of CHUNK records and then written
+    into the free slots of the batch.
+    """
+    CHUNK = 4096
+
+    def __init__(self, generator, data, width, skip_null=False, effector_map=None, set_arith_max=None):
+        self.generator = generator
+        self.data = data.tostring()
+        self.width = width
+        self.skip_null = skip_null
+        if effector_map:
+            self.effector_map = str(to_byte_map(effector_map, len(self.data)))
+        else:
+            self.effector_map = None
+        if not set_arith_max:
+            set_arith_max = AFL_ARITH_MAX
+        self.arith_max = set_arith_max
+        self.cursor = c_uint64(0)
+        self.candidates = (DetCandidate * self.CHUNK)()
+        self.count = 0
+        self.position = 0
+
+    def __refill(self):
+        self.position = 0
+        self.count = int(self.generator(self.data, len(self.data), self.width, self.effector_map, self.skip_null,
+                                        self.arith_max, byref(self.cursor), self.candidates, self.CHUNK))
+        return self.count
+
+    def fill(self, job_batch):
+        """ writes as many mutations as job_batch can take, returns their number (0 = stage done) """
+        if self.position == self.count and not self.__refill():
+            return 0
+        num = int(get_nativ().candidate_batch(job_batch.write_address(), job_batch.slot_size, job_batch.free(),
+                                              self.data, len(self.data),
+                                              addressof(self.candidates) + (self.position * sizeof(DetCandidate)),
+                                              self.count - self.position))
+        job_batch.commit(num)
+        self.position += num
+        return num
+
+    def total(self):
+        """ number of mutations of the whole stage after deduplication, consumes the generator """
+        num = 0
+        while self.__refill():
+            num += self.count
+        self.position = self.count
+        return num
+
+    def affected_bytes(self, num):
+        return None
+
+
 bitmap_native_so = None
 
 def load_nativ():
     global bitmap_native_so
     bitmap_native_so = CDLL(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/../native/bitmap.so')
+    bitmap_native_so.bitflip_batch.argtypes = [c_void_p, c_uint32, c_uint32, c_char_p, c_uint32, c_uint8,
+                                               POINTER(c_uint64), c_char_p, c_bool, POINTER(c_uint32)]
+    bitmap_native_so.bitflip_batch.restype = c_uint32
+    for generator in (bitmap_native_so.arith_candidates, bitmap_native_so.interesting_candidates):
+        generator.argtypes = [c_char_p, c_uint32, c_uint8, c_char_p, c_bool, c_uint8,
+                              POINTER(c_uint64), POINTER(DetCandidate), c_uint32]
+        generator.restype = c_uint32
+    bitmap_native_so.candidate_batch.argtypes = [c_void_p, c_uint32, c_uint32, c_char_p, c_uint32, c_void_p, c_uint32]
+    bitmap_native_so.candidate_batch.restype = c_uint32
+    bitmap_native_so.bitmap_edges.argtypes = [c_char_p, c_uint32, c_void_p]
+    bitmap_native_so.bitmap_edges.restype = c_uint32
+    bitmap_native_so.bitmap_merge.argtypes = [c_void_p, c_void_p, c_uint64, c_void_p, c_void_p]
+    bitmap_native_so.bitmap_merge.restype = c_uint64
+    bitmap_native_so.bitmap_merge_batch.argtypes = [c_void_p, c_void_p, c_uint32, c_uint64, c_void_p, c_void_p]
+    bitmap_native_so.bitmap_merge_batch.restype = None
+    bitmap_native_so.bitmap_totals.argtypes = [c_void_p, c_uint64, c_void_p]
+    bitmap_native_so.bitmap_totals.restype = None
+    bitmap_native_so.is_finding_unique.argtypes = [c_void_p, c_void_p, c_uint64]
+    bitmap_native_so.is_finding_unique.restype = c_bool
+    bitmap_native_so.murmur3_x64_128.argtypes = [c_void_p, c_uint64, c_uint32, c_void_p]
+    bitmap_native_so.murmur3_x64_128.restype = None
+    bitmap_native_so.monotonic_ns.argtypes = []
+    bitmap_native_so.monotonic_ns.restype = c_uint64
+    bitmap_native_so.could_be_bitflip.restype = c_uint8
+    bitmap_native_so.could_be_arith.restype = c_uint8
+    bitmap_native_so.could_be_interest.restype = c_uint8
+
+def get_nativ():
+    global bitmap_native_so
+    if bitmap_native_so is None:
+        load_nativ()
+    return bitmap_native_so
+
+
+def hash64(data, size):
+    """ mmh3.hash64 of size bytes of data (a string or an address) without copying them """
+    digest = (c_uint64 * 2)()
+    get_nativ().murmur3_x64_128(data, size, 0, digest)
+    return struct.unpack_from("=qq", digest)
 
 
 def is_not_bitflip(value):
     global bitmap_native_so
     if bitmap_native_so is None:
         load_nativ()
-    bitmap_native_so.could_be_bitflip.restype = c_uint8
     result =  bitmap_native_so.could_be_bitflip(c_uint32(value))
 
     if result == 0:
@@ -190,7 +421,6 @@ def is_not_arithmetic(value, new_value, num_bytes, set_arith_max=AFL_ARITH_MAX):
     global bitmap_native_so
     if bitmap_native_so is None:
         load_nativ()
-    bitmap_native_so.could_be_arith.restype = c_uint8
     result =  bitmap_native_so.could_be_arith(c_uint32(value), c_uint32(new_value), c_uint8(num_bytes), c_uint8(set_arith_max))
 
     if result == 0:
@@ -203,7 +433,6 @@ def is_not_interesting(value, new_value, num_bytes, le):
     global bitmap_native_so
     if bitmap_native_so is None:
         load_nativ()
-    bitmap_native_so.could_be_interest.restype = c_uint8
     result =  bitmap_native_so.could_be_interest(c_uint32(value), c_uint32(new_value), c_uint8(num_bytes), c_uint8(le))
 
     if result == 0:
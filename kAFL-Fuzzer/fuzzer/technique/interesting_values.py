@@ -25,11 +25,9 @@ __author__ = 'sergej'
 def interesting_range(data, skip_null=False, effector_map=None):
 
     if effector_map:
-        data_len = sum(x is True for x in effector_map)
-        data_tmp = ""
-        for i in range(len(data)):
-            if effector_map[i]:
-                data_tmp += data[i]
+        effector_map = to_byte_map(effector_map, len(data))
+        data_len = count_selected(effector_map)
+        data_tmp = selected_bytes(data, effector_map)
     else:
         data_len = len(data)
         data_tmp = data
@@ -50,92 +48,11 @@ def interesting_range(data, skip_null=False, effector_map=None):
     return num
 
 
-def mutate_seq_8_bit_interesting_array(data, func, skip_null=False, kafl_state=None, effector_map=None):
+def mutate_seq_interesting_batch(data, width, func, skip_null=False, kafl_state=None, effector_map=None, set_arith_max=None):
     if kafl_state:
-        kafl_state["technique"] = "INTERST 8"
+        kafl_state["technique"] = "INTERST " + str(width*8)
 
-    for i in range(0, len(data)):
-        if effector_map:
-            if not effector_map[i]:
-                continue
-        byte = data[i]
-        for j in range(len(interesting_8_Bit)):
-            if skip_null and byte == 0:
-                continue
-            interesting_value = in_range_8(interesting_8_Bit[j])
-            if is_not_bitflip(byte ^ interesting_value) and is_not_arithmetic(byte, interesting_value, 1):
-                func(data[:i].tostring() + to_string_8(interesting_value) + data[(i+1):].tostring())
-            else:
-                func(None, no_data=True)
-        data[i] = byte
-
-def mutate_seq_16_bit_interesting_array(data, func, skip_null=False, kafl_state=None, effector_map=None, set_arith_max=None):
-    if kafl_state:
-        kafl_state["technique"] = "INTERST 16"
-
-    for i in range(len(data) - 1):
-        if effector_map:
-            if not (effector_map[i] or effector_map[i+1]):
-                continue
-
-        byte1 = data[i + 1]
-        byte2 = data[i]
-        value = (byte1 << 8) + byte2
-    
-        if skip_null and value == 0:
-            continue
-
-        for j in range(len(interesting_16_Bit)):
-            interesting_value = in_range_16(interesting_16_Bit[j])
-            swapped_value = swap_16(interesting_value)
-
-            if is_not_bitflip(value ^ interesting_value) and \
-            is_not_arithmetic(value, interesting_value, 2, set_arith_max=set_arith_max) and \
-            is_not_interesting(value, interesting_value, 2, 0):
-                func(data[:i].tostring() + to_string_16(interesting_value) + data[(i + 2):].tostring())
-            else:
-                func(None, no_data=True)
-
-            if interesting_value != swapped_value and \
-               is_not_bitflip(value ^ swapped_value) and \
-               is_not_arithmetic(value, swapped_value, 2, set_arith_max=set_arith_max) and \
-               is_not_interesting(value, swapped_value, 2, 1):
-                func(data[:i].tostring() + to_string_16(swapped_value) + data[(i+2):].tostring())
-            else:
-                func(None, no_data=True)
-
-def mutate_seq_32_bit_interesting_array(data, func, skip_null=False, kafl_state=None, effector_map=None, set_arith_max=None):
-    if kafl_state:
-        kafl_state["technique"] = "INTERST 32"
-
-    for i in range(len(data) - 3):
-        if effector_map:
-            if not (effector_map[i] or effector_map[i + 1] or effector_map[i + 2] or effector_map[i + 3]):
-                continue
-
-        byte1 = data[i + 3]
-        byte2 = data[i + 2]
-        byte3 = data[i + 1]
-        byte4 = data[i + 0]
-        value = (byte1 << 24) + (byte2 << 16) + (byte3 << 8) + byte4
-
-        if skip_null and value == 0:
-            continue
-
-        for j in range(len(interesting_32_Bit)):
-            interesting_value = in_range_32(interesting_32_Bit[j])
-            swapped_value = swap_32(interesting_value)
-            if is_not_bitflip(value ^ interesting_value) and \
-               is_not_arithmetic(value, interesting_value, 4, set_arith_max=set_arith_max) and \
-               is_not_interesting(value, interesting_value, 4, 0):
-                func(data[:i].tostring() + to_string_32(interesting_value) + data[(i+4):].tostring())
-            else:
-                func(None, no_data=True)
-
-            if interesting_value != swapped_value  and\
-               is_not_bitflip(value ^ swapped_value) and\
-               is_not_arithmetic(value, swapped_value, 4, set_arith_max=set_arith_max) and\
-               is_not_interesting(value, swapped_value, 4, 1):
-                func(data[:i].tostring() + to_string_32(swapped_value) + data[(i+4):].tostring())
-            else:
-                func(None, no_data=True)
+    if width == 1:
+        """ the single byte stage always filters with AFL_ARITH_MAX """
+        set_arith_max = AFL_ARITH_MAX
+    func(CandidateBatch(get_nativ().interesting_candidates, data, width, skip_null=skip_null, effector_map=effector_map, set_arith_max=set_arith_max))
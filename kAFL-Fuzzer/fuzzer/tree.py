@@ -19,7 +19,6 @@ along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import json
-import random
 import time
 import os
 import mmap
@@ -27,19 +26,26 @@ import lz4
 import traceback
 import sys
 import mmh3
+import heapq
+import struct
+from array import array
+from collections import deque
 
 from common.config import FuzzerConfiguration
 from common.debug import log_tree
-from common.util import read_binary_file, atomic_write, json_dumper
-from fuzzer.technique.helper import RAND
+from common.util import read_binary_file
+from common.writer import AsyncWriter
+from fuzzer.corpus import CorpusStore
+from fuzzer.snapshot import Snapshot
+from fuzzer.technique.helper import RAND, get_nativ
 from common.qemu import QemuLookupSet
+from common.shared_set import PayloadIndex, payload_digest
 
 from fuzzer.fuzz_methods import fuzz_yield
 
 from fuzzer.state import GlobalState
 
 from ctypes import *
-import inspect
 
 class KaflNodeType:
     regular, favorite, crash, kasan, timeout, preliminary = range(6)
@@ -54,6 +60,24 @@ class KaflNodeState:
     def __init__(self):
         pass
 
+NO_OWNER = -1
+
+edge_buffer = None
+
+def scan_edges(bitmap):
+    """ sorted indices of all edges (bitmap bytes != 0xff) hit by a run """
+    global edge_buffer
+    if edge_buffer is None or len(edge_buffer) < len(bitmap):
+        edge_buffer = (c_uint32 * len(bitmap))()
+    num = get_nativ().bitmap_edges(bitmap, len(bitmap), edge_buffer)
+    edges = array('I')
+    edges.fromstring(string_at(edge_buffer, num * sizeof(c_uint32)))
+    return edges
+
+""" snapshot sections of the tree """
+TREE_RECORD = struct.Struct("<iiiiiiiiiiIIII")
+NODE_RECORD = struct.Struct("<iBBBxIiIiddiIIIqQqq16s")
+
 KaflNodeID = 1
 KaflCrashID = 1
 KaflKASanID = 1
@@ -76,6 +100,8 @@ class KaflNode:
         self.performance = performance
 
         self.fav_bits = 0
+        self.owned_edges = 0
+        self.ref = None
 
         if node_state:
             self.node_state = node_state
@@ -111,8 +137,10 @@ class KaflNode:
                 pass
 
         self.payload_hash = mmh3.hash(payload)
+        self.payload_digest = payload_digest(payload)
 
-        self.bits = {}
+        self.edges = array('I')
+        self.bit_count = 0
         if write_data:
             self.__save_payload(payload)
             self.__write_eval_results()
@@ -137,7 +165,9 @@ class KaflNode:
     def remove(self):
         global KaflNodeID, KaflCrashID, KaflKASanID, KaflTimeoutID, KaflPreliminaryID
 
-        os.remove(self.__get_filename())
+        CorpusStore().remove(self.__get_store_type(), self.node_id)
+        if self.__is_exported():
+            AsyncWriter().remove(self.__get_filename())
         if self.node_type == KaflNodeType.regular or self.node_type == KaflNodeType.favorite:
             KaflNodeID -= 1
         elif self.node_type == KaflNodeType.crash:
@@ -150,12 +180,8 @@ class KaflNode:
             KaflPreliminaryID -= 1
 
     def __process_bitmap(self, bitmap):
-        j = 0
-        for bit in bitmap:
-            if bit != '\xff':
-                self.bits[j] = ord(bit)
-            j += 1
-        self.bit_count = len(self.bits)
+        self.edges = scan_edges(bitmap)
+        self.bit_count = len(self.edges)
 
     def __get_filename(self):
         filename = ""
@@ -172,18 +198,33 @@ class KaflNode:
             filename = FuzzerConfiguration().argument_values['work_dir'] + "/preliminary/preliminary_%05d"%self.node_id
         return filename
 
+    def __get_store_type(self):
+        """ regular and favorite nodes share their ids (and the corpus folder) """
+        if self.node_type == KaflNodeType.favorite:
+            return KaflNodeType.regular
+        return self.node_type
+
+    def __is_exported(self):
+        """ preliminary payloads are always exported, the verification reads them from disk """
+        return FuzzerConfiguration().config_values['CORPUS_EXPORT'] or self.node_type == KaflNodeType.preliminary
+
     def __write_eval_results(self):
-        with open(FuzzerConfiguration().argument_values['work_dir']+"/evaluation/findings.csv",'ab') as f:
-            f.write("%s\n"%json.dumps([time.time()-GlobalState().values["inittime"], self.__get_filename()] ))
+        AsyncWriter().append(FuzzerConfiguration().argument_values['work_dir']+"/evaluation/findings.csv",
+                             "%s\n"%json.dumps([time.time()-GlobalState()["inittime"], self.__get_filename()] ))
 
     def __save_payload(self, payload):
-        atomic_write(self.__get_filename(), payload)
+        CorpusStore().append(self.__get_store_type(), self.node_id, self.payload_hash, payload)
+        if self.__is_exported():
+            AsyncWriter().write(self.__get_filename(), payload)
 
     def __save_payload_sequence(self, sequence):
-        atomic_write(self.__get_filename() + ".seq", lz4.block.compress(json.dumps(sequence)))
+        AsyncWriter().write(self.__get_filename() + ".seq", lz4.block.compress(json.dumps(sequence)))
 
     def load_payload(self):
-        return read_binary_file(self.__get_filename())
+        payload = CorpusStore().get(self.__get_store_type(), self.node_id)
+        if payload is None:
+            return read_binary_file(self.__get_filename())
+        return str(payload)
 
     def __str__(self):
         prefix = ""
@@ -199,18 +240,36 @@ class KaflNode:
             prefix = "Preliminary: "
         return prefix + str(self.node_id) + "\n[Level: " + str(self.level) + "]\n" + " t/s\n" + self.identifier
 
+    def pack_record(self, parent, edge_offset):
+        return NODE_RECORD.pack(self.level, self.node_state, self.node_type, self.current, self.node_id, parent,
+                                self.payload_len, self.payload_hash, self.performance, self.fav_factor, self.fav_bits,
+                                self.bit_count, self.new_byte_count, self.new_bit_count, self.bb_delta, edge_offset,
+                                self.payload_digest[0], self.payload_digest[1], self.identifier)
+
     @classmethod
-    def load_json(cls, json_data):
-        log_tree("Restoring: " + str(json_data['node_id']))
-        obj =  cls(json_data['level'], None, None,
-                   node_state=int(json_data['node_state']), node_type=int(json_data['node_type']),
-                   current=json_data['current'], write_data=False)
-        obj.node_id = int(json_data['node_id'])
-        obj.bits = json_data['bits']
-        obj.identifier = json_data['identifier']
-        obj.payload_len = json_data['payload_len']
-        obj.payload_hash = json_data['payload_hash']
-        return obj
+    def load_record(cls, data, offset, edges=None):
+        """ returns the node and its parent reference, without edges if there is no edge data """
+        (level, node_state, node_type, current, node_id, parent, payload_len, payload_hash, performance, fav_factor,
+         fav_bits, bit_count, new_byte_count, new_bit_count, bb_delta, edge_offset,
+         digest_high, digest_low, identifier) = NODE_RECORD.unpack_from(data, offset)
+        obj = cls(level, "", None, None, node_state=node_state, node_type=node_type, current=bool(current), write_data=False)
+        obj.node_id = node_id
+        obj.payload_len = payload_len
+        obj.payload_hash = payload_hash
+        obj.payload_digest = (digest_high, digest_low)
+        obj.performance = performance
+        obj.fav_factor = fav_factor
+        obj.fav_bits = fav_bits
+        obj.new_byte_count = new_byte_count
+        obj.new_bit_count = new_bit_count
+        obj.bb_delta = bb_delta
+        obj.identifier = identifier.rstrip("\x00")
+        obj.bit_count = bit_count
+        if edges is not None:
+            obj.edges.fromstring(edges[4 * edge_offset:4 * (edge_offset + bit_count)])
+            if len(obj.edges) != bit_count:
+                raise ValueError("snapshot.edges is truncated")
+        return obj, parent
 
     @classmethod
     def reset_node_id(cls):
@@ -337,6 +396,111 @@ class KaflGraph:
     def remove_node(self, node):
         self.dot.remove_node(self.dot.get_node(str(node)))
 
+class RefBuffer:
+    """
+    Queue of node references with O(1) membership tests and removals.
+    Removed entries stay in the deque until they reach one of its ends;
+    a reference that is appended again only counts at its newest position.
+    """
+
+    def __init__(self, refs=()):
+        self.queue = deque()
+        self.live = {}
+        self.token = 0
+        for ref in refs:
+            self.append(ref)
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, ref):
+        return ref in self.live
+
+    def __iter__(self):
+        for ref, token in self.queue:
+            if self.live.get(ref) == token:
+                yield ref
+
+    def __add(self, ref):
+        self.token += 1
+        self.live[ref] = self.token
+        return (ref, self.token)
+
+    def append(self, ref):
+        self.queue.append(self.__add(ref))
+
+    def remove(self, ref):
+        self.live.pop(ref, None)
+        if len(self.queue) > 2 * len(self.live) + 64:
+            self.queue = deque(entry for entry in self.queue if self.live.get(entry[0]) == entry[1])
+
+    def pop(self):
+        while True:
+            ref, token = self.queue.pop()
+            if self.live.get(ref) == token:
+                del self.live[ref]
+                return ref
+
+
+class RefHeap:
+    """
+    Priority queue of node references, smallest priority first. Equal
+    priorities are served newest first. Removed or re-prioritized
+    references leave their old heap entries behind; those are skipped
+    when they surface and dropped on compaction.
+    """
+
+    def __init__(self, priority, refs=()):
+        self.priority = priority
+        self.live = {}
+        self.order = {}
+        self.counter = 0
+        self.heap = [self.__add(ref) for ref in refs]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, ref):
+        return ref in self.live
+
+    def __iter__(self):
+        return iter(self.live.keys())
+
+    def __add(self, ref):
+        if ref not in self.order:
+            self.counter += 1
+            self.order[ref] = -self.counter
+        entry = (self.priority(ref), self.order[ref], ref)
+        self.live[ref] = entry
+        return entry
+
+    def push(self, ref):
+        heapq.heappush(self.heap, self.__add(ref))
+
+    def update(self, ref):
+        """ re-evaluate the priority of a queued reference """
+        entry = self.live.get(ref)
+        if entry is not None and entry[0] != self.priority(ref):
+            self.push(ref)
+
+    def remove(self, ref):
+        if self.live.pop(ref, None) is not None:
+            del self.order[ref]
+            if len(self.heap) > 2 * len(self.live) + 64:
+                self.heap = list(self.live.values())
+                heapq.heapify(self.heap)
+
+    def pop(self):
+        while True:
+            entry = heapq.heappop(self.heap)
+            ref = entry[2]
+            if self.live.get(ref) is entry:
+                del self.live[ref]
+                del self.order[ref]
+                return ref
+
+
 class KaflTree:
 
     MASTER_NODE_ID = -1
@@ -354,26 +518,31 @@ class KaflTree:
         self.all_nodes = []
         self.references = {}
         self.current = self.MASTER_NODE_ID
-        self.random_shuffled = False
-
-        self.favorite_buf = []
-        self.favorite_unfinished_buf = []
-        self.regular_buf = []
-        self.regular_unfinished_buf = []
-        self.finished_buf = []
 
         self.bitmap_size = FuzzerConfiguration().config_values['BITMAP_SHM_SIZE']
-        self.depth_search_first = FuzzerConfiguration().config_values["DEPTH-FIRST-SEARCH"]
+        self.sort_default = True
+        self.ignore_bit_counts = False
+
+        self.favorite_buf = RefHeap(self.__get_priority)
+        self.favorite_unfinished_buf = RefBuffer()
+        self.regular_buf = RefBuffer()
+        self.regular_unfinished_buf = RefBuffer()
+        self.finished_favorite_buf = []
+        self.finished_regular_buf = []
+        """ queued favorites whose score changed since the last resort_favs() """
+        self.stale_scores = set()
 
         self.buckets = [0x0, 0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80]
 
-        self.fav_bitmap = []
+        """ owner (node reference) of every edge, NO_OWNER if there is none """
+        self.fav_bitmap = array('i', [NO_OWNER]) * self.bitmap_size
         self.fav_bitmap_updated = False
 
         if FuzzerConfiguration().config_values['MAX_MIN_BUCKETS']:
-            self.max_bucket_values = []
-            self.backup_max_bucket_values = []
-            self.max_bucket_ref = []
+            """ -1 / NO_OWNER: no max bucket value seen yet """
+            self.max_bucket_values = array('i', [-1]) * self.bitmap_size
+            self.backup_max_bucket_values = array('i', [-1]) * self.bitmap_size
+            self.max_bucket_ref = array('i', [NO_OWNER]) * self.bitmap_size
             self.next_max_bucket = []
             self.old_pending_node = None
             self.max_min_bucketing_enabled = True
@@ -384,6 +553,10 @@ class KaflTree:
         self.preliminary_mode = False
         self.preliminary_mode_queue = []
 
+        """ nodes whose edges are in snapshot.edges and their offsets (in edges) """
+        self.edge_offsets = array('L')
+        self.edge_offset = 0
+
         self.bitmap_fd = os.open(FuzzerConfiguration().argument_values['work_dir'] + "/bitmaps/bitmap", os.O_RDWR | os.O_SYNC | os.O_CREAT)
         self.crash_bitmap_fd = os.open(FuzzerConfiguration().argument_values['work_dir'] + "/bitmaps/crash_bitmap", os.O_RDWR | os.O_SYNC | os.O_CREAT)
         self.kasan_bitmap_fd = os.open(FuzzerConfiguration().argument_values['work_dir'] + "/bitmaps/kasan_bitmap", os.O_RDWR | os.O_SYNC | os.O_CREAT)
@@ -412,25 +585,23 @@ class KaflTree:
         self.backup_timeout_bitmap = mmap.mmap(self.backup_timeout_bitmap_fd, self.bitmap_size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
 
         if flush:
-            for i in range(self.bitmap_size):
-                self.bitmap[i] = '\x00'
-                self.crash_bitmap[i] = '\x00'
-                self.kasan_bitmap[i] = '\x00'
-                self.timeout_bitmap[i] = '\x00'
-        for i in range(self.bitmap_size):
-            self.fav_bitmap.append(None)
-
-        if self.max_min_bucketing_enabled:
-            for i in range(self.bitmap_size):
-                self.max_bucket_values.append(None)
-                self.backup_max_bucket_values.append(None)
-                self.max_bucket_ref.append(None)
+            empty_bitmap = '\x00' * self.bitmap_size
+            self.bitmap[:] = empty_bitmap
+            self.crash_bitmap[:] = empty_bitmap
+            self.kasan_bitmap[:] = empty_bitmap
+            self.timeout_bitmap[:] = empty_bitmap
 
         self.c_bitmap = (c_uint8 * self.bitmap_size).from_buffer(self.bitmap)
         self.c_crash_bitmap = (c_uint8 * self.bitmap_size).from_buffer(self.crash_bitmap)
         self.c_kasan_bitmap = (c_uint8 * self.bitmap_size).from_buffer(self.kasan_bitmap)
         self.c_timeout_bitmap = (c_uint8 * self.bitmap_size).from_buffer(self.timeout_bitmap)
 
+        """ [0]: covered bytes, [1]: bucket weight (see get_bitmap_values) of self.bitmap """
+        self.coverage_totals = (c_uint64 * 2)()
+        self.new_edges = (c_uint32 * self.bitmap_size)()
+        self.new_edge_count = 0
+        self.__update_coverage_totals()
+
         self.graph = KaflGraph([], enabled=enable_graphviz)
         self.favorites = 0
         self.favorites_in_progress = 0
@@ -442,9 +613,8 @@ class KaflTree:
 
         self.score_changed = False
 
-        self.payload_hashes = {}
-
-        self.bitmap_native_so = CDLL(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/native/bitmap.so')
+        """ digests that did not fit into the shared PayloadIndex """
+        self.payload_digests = set()
 
         for payload, bitmap in seed:
             node = KaflNode(self.level, payload, bitmap, None, node_type=KaflNodeType.favorite)
@@ -456,9 +626,6 @@ class KaflTree:
         self.__restore_state()
         self.__restore_graph()
 
-        self.sort_default = True
-        self.ignore_bit_counts = False
-
     def __restore_graph(self):
         log_tree("__restore_graph()")
         if self.current != self.MASTER_NODE_ID:
@@ -495,8 +662,7 @@ class KaflTree:
 
         if self.max_min_bucketing_enabled:
             self.next_max_bucket = []
-            for i in range(len(self.max_bucket_values)):
-                self.backup_max_bucket_values[i] = self.max_bucket_values[i]
+            self.backup_max_bucket_values = array('i', self.max_bucket_values)
 
         for e in self.preliminary_mode_queue:
             e.remove()
@@ -532,9 +698,9 @@ class KaflTree:
 
         if self.max_min_bucketing_enabled:
             self.next_max_bucket = []
-            for i in range(len(self.max_bucket_values)):
-                self.max_bucket_values[i] = self.backup_max_bucket_values[i]
+            self.max_bucket_values = array('i', self.backup_max_bucket_values)
 
+        self.__update_coverage_totals()
 
         log_tree("flushing preliminary queue...")
         for node in self.preliminary_mode_queue:
@@ -551,7 +717,7 @@ class KaflTree:
         return len(self.preliminary_mode_queue)
 
     def __get_ref(self, node):
-        return self.all_nodes.index(node)
+        return node.ref
 
     def __get_from_ref(self, ref):
         return self.all_nodes[ref]
@@ -563,28 +729,28 @@ class KaflTree:
     def __append_to_level(self, new_node):
         if self.current not in self.references.keys():
             self.references[self.current] = []
+        new_node.ref = len(self.all_nodes)
         self.all_nodes.append(new_node)
-        self.references[self.current].append(self.all_nodes.index(new_node))
+        self.references[self.current].append(new_node.ref)
         if new_node.level > self.max_level:
             self.max_level = new_node.level
 
         if new_node.node_type == KaflNodeType.favorite:
-            self.favorite_buf.append(self.__get_ref(new_node))
+            self.favorite_buf.push(self.__get_ref(new_node))
         elif new_node.node_type == KaflNodeType.regular and new_node.node_state < KaflNodeState.finished:
             self.regular_buf.append(self.__get_ref(new_node))
         elif new_node.node_state >= KaflNodeState.finished:
-            self.finished_buf.append(self.__get_ref(new_node))
+            self.__append_finished(new_node)
 
-        self.payload_hashes[new_node.payload_hash] = self.__get_ref(new_node)
+        self.__add_payload_digest(new_node.payload_digest)
 
         if self.max_min_bucketing_enabled:
             for i in list(set(self.next_max_bucket)):
                 log_tree("===> New max bucket " + str(i) + " = " + str(self.max_bucket_values[i]) + "\tID: "+ str(new_node.node_id))
-                old_node = None
-                if self.max_bucket_ref[i]:
+                if self.max_bucket_ref[i] != NO_OWNER:
                     log_tree("Replacing ...")
-                    self.old_pending_node = self.max_bucket_ref[i]
-                self.max_bucket_ref[i] = new_node 
+                    self.old_pending_node = self.__get_from_ref(self.max_bucket_ref[i])
+                self.max_bucket_ref[i] = self.__get_ref(new_node)
 
             self.next_max_bucket = []
 
@@ -613,9 +779,15 @@ class KaflTree:
                     self.favorites_in_progress -= 1
 
             node.node_state = KaflNodeState.finished
-            self.finished_buf.append(self.__get_ref(node))
+            self.__append_finished(node)
             self.graph.update(node)
 
+    def __append_finished(self, node):
+        if node.node_type == KaflNodeType.favorite:
+            self.finished_favorite_buf.append(self.__get_ref(node))
+        else:
+            self.finished_regular_buf.append(self.__get_ref(node))
+
     def __set_unfinished(self, node):
         if node:
             node.node_state = KaflNodeState.in_progress
@@ -629,54 +801,56 @@ class KaflTree:
                 self.regular_unfinished_buf.append(self.__get_ref(node))
             self.graph.update(node)
 
-    def __restore_state(self):
-        self.favorite_buf = []
+    def __rebuild_buffers(self):
+        favorites = []
+        self.favorite_unfinished_buf = RefBuffer()
+        self.regular_buf = RefBuffer()
+        self.regular_unfinished_buf = RefBuffer()
+        self.finished_favorite_buf = []
+        self.finished_regular_buf = []
+        self.stale_scores = set()
         for node in self.all_nodes:
             if node.node_type == KaflNodeType.favorite and node.node_state == KaflNodeState.untouched:
-                self.favorite_buf.append(self.__get_ref(node))
-
-        self.favorite_unfinished_buf = []
-        for node in self.all_nodes:
-            if node.node_type == KaflNodeType.favorite and node.node_state == KaflNodeState.in_progress:
-                self.favorite_unfinished_buf.append(self.__get_ref(node))
-
-        self.regular_buf = []
-        for node in self.all_nodes:
-            if node.node_type == KaflNodeType.regular and node.node_state == KaflNodeState.untouched:
-                self.regular_buf.append(self.__get_ref(node))
-
-        self.regular_unfinished_buf = []
-        for node in self.all_nodes:
-            if node.node_type == KaflNodeType.regular and node.node_state == KaflNodeState.in_progress:
-                self.regular_unfinished_buf.append(self.__get_ref(node))
-
-        self.finished_buf = []
-        for node in self.all_nodes:
+                favorites.append(node.ref)
+            elif node.node_type == KaflNodeType.favorite and node.node_state == KaflNodeState.in_progress:
+                self.favorite_unfinished_buf.append(node.ref)
+            elif node.node_type == KaflNodeType.regular and node.node_state == KaflNodeState.untouched:
+                self.regular_buf.append(node.ref)
+            elif node.node_type == KaflNodeType.regular and node.node_state == KaflNodeState.in_progress:
+                self.regular_unfinished_buf.append(node.ref)
             if node.node_type < KaflNodeType.crash and node.node_state == KaflNodeState.finished:
-                self.finished_buf.append(self.__get_ref(node))
+                self.__append_finished(node)
+        self.favorite_buf = RefHeap(self.__get_priority, refs=favorites)
+
+    def __restore_state(self):
+        self.__rebuild_buffers()
         self.cycles += 1
-        self.random_shuffled = False
 
-    def __prepare_finished(self):
-        if not self.random_shuffled:
-            favorite = filter(lambda x: self.__get_from_ref(x).node_type == KaflNodeType.favorite, self.finished_buf)
-            regular = filter(lambda x: self.__get_from_ref(x).node_type != KaflNodeType.favorite, self.finished_buf)
-            random.shuffle(favorite)
-            random.shuffle(regular)
-            self.finished_buf = favorite + regular
-            self.random_shuffled = True
+    def __pop_random(self, buf):
+        i = RAND(len(buf))
+        buf[i], buf[-1] = buf[-1], buf[i]
+        return buf.pop()
+
+    def __pop_finished(self):
+        """ random finished node, regular nodes before favorites """
+        while self.finished_regular_buf or self.finished_favorite_buf:
+            if self.finished_regular_buf:
+                ref = self.__pop_random(self.finished_regular_buf)
+                if self.__get_from_ref(ref).node_type == KaflNodeType.favorite:
+                    self.finished_favorite_buf.append(ref)
+                    continue
+            else:
+                ref = self.__pop_random(self.finished_favorite_buf)
+            return ref
+        return None
 
     def __get_favorites(self):
         if not (self.favorite_buf or self.favorite_unfinished_buf):
             return None
-        self.random_shuffled = False
         if self.favorite_buf:
-            if self.depth_search_first:
-                next_node = self.__get_from_ref(self.favorite_buf.pop(len(self.favorite_buf)-1))
-            else:
-                next_node = self.__get_from_ref(self.favorite_buf.pop())
+            next_node = self.__get_from_ref(self.favorite_buf.pop())
         else:
-            next_node = self.__get_from_ref(self.favorite_unfinished_buf.pop(-1))
+            next_node = self.__get_from_ref(self.favorite_unfinished_buf.pop())
             self.__set_finished(next_node)
         self.__change_current(next_node)
         return next_node
@@ -684,26 +858,19 @@ class KaflTree:
     def __get_regular(self):
         if not (self.regular_buf or self.regular_unfinished_buf):
             return None
-        self.random_shuffled = False
         if self.regular_buf:
-            if self.depth_search_first:
-                next_node = self.__get_from_ref(self.regular_buf.pop(len(self.regular_buf)-1))
-            else:
-                next_node = self.__get_from_ref(self.regular_buf.pop())
+            next_node = self.__get_from_ref(self.regular_buf.pop())
         else:
-            next_node = self.__get_from_ref(self.regular_unfinished_buf.pop(-1))
+            next_node = self.__get_from_ref(self.regular_unfinished_buf.pop())
             self.__set_finished(next_node)
         self.__change_current(next_node)
         return next_node
 
     def __get_finished(self):
-        if not self.finished_buf:
+        ref = self.__pop_finished()
+        if ref is None:
             return None
-        self.__prepare_finished()
-        if self.depth_search_first:
-            next_node = self.__get_from_ref(self.finished_buf.pop(len(self.finished_buf)-1))
-        else:
-            next_node = self.__get_from_ref(self.finished_buf.pop())
+        next_node = self.__get_from_ref(ref)
         self.__change_current(next_node)
         return next_node
 
@@ -724,29 +891,35 @@ class KaflTree:
                     self.__set_unfinished(self.__get_from_ref(self.current))
         
 
-        next_node = self.__get_favorites()
-        if not next_node:
-            if RAND(20) == 0:
-                next_node = self.__get_regular()
-            else:
-                next_node = self.__get_finished()
-        if not next_node:
+        while True:
+            next_node = self.__get_favorites()
+            if not next_node:
+                if RAND(20) == 0:
+                    next_node = self.__get_regular()
+                else:
+                    next_node = self.__get_finished()
+            if next_node:
+                break
             self.__restore_state()
-            return self.get_next(performance)
+            if not (self.favorite_buf or self.favorite_unfinished_buf or self.regular_buf or
+                    self.regular_unfinished_buf or self.finished_favorite_buf or self.finished_regular_buf):
+                raise Exception("No schedulable node left in the tree...")
         self.draw()
 
         log_tree("log_tree: " + str(self.__get_score(self.__get_ref(next_node))) + " " + str(next_node.fav_bits) + " " + str(next_node.new_bit_count) + " " + str(next_node.level) + " " + str(next_node.performance))
         return next_node
 
     def __is_favorite(self, node):
-        for i in node.bits:
-            if not self.fav_bitmap[i]:
-                self.fav_bitmap[i] = self.__get_ref(node)
+        ref = self.__get_ref(node)
+        for i in node.edges:
+            if self.fav_bitmap[i] == NO_OWNER:
+                self.fav_bitmap[i] = ref
+                node.owned_edges += 1
                 self.fav_bitmap_updated = True
 
 
     def __check_if_max_bucket(self, value, field):
-        if (self.max_bucket_values[field] == None) or value > self.max_bucket_values[field]:
+        if value > self.max_bucket_values[field]:
             log_tree("=====>>> " + str(value) + " vs " + str(self.max_bucket_values[field]) + "\t" + str(field))
             self.max_bucket_values[field] = value
 
@@ -759,14 +932,35 @@ class KaflTree:
             return True
         return False
 
+    def __update_coverage_totals(self):
+        get_nativ().bitmap_totals(self.c_bitmap, self.bitmap_size, self.coverage_totals)
+
     def __are_new_bits_present(self, new_bitmap):
-        self.bitmap_native_so.are_new_bits_present.restype = c_uint64
-        result =  self.bitmap_native_so.are_new_bits_present(self.c_bitmap, (c_uint8 * self.bitmap_size).from_buffer_copy(new_bitmap), c_uint64(self.bitmap_size))
+        """ new_bitmap may be a string or the address of a bitmap, it is not modified """
+        result = get_nativ().bitmap_merge(self.c_bitmap, new_bitmap, self.bitmap_size, self.new_edges, self.coverage_totals)
+        self.new_edge_count = int(result & 0xFFFFFFFF)
         # byte_count, bit_count
         return (result >> 32), (result & 0xFFFFFFFF)
+
+    def merge_coverage(self, bitmaps):
+        """
+        Merges the run bitmaps in order with a single native call and returns
+        their (byte_count, bit_count). Pass these as coverage to append().
+        """
+        if not bitmaps:
+            return []
+        results = (c_uint64 * len(bitmaps))()
+        get_nativ().bitmap_merge_batch(self.c_bitmap, (c_char_p * len(bitmaps))(*bitmaps), len(bitmaps),
+                                       self.bitmap_size, results, self.coverage_totals)
+        self.new_edge_count = 0
+        return [((result >> 32), (result & 0xFFFFFFFF)) for result in results]
+
+    def get_new_edges(self):
+        """ bitmap indices that gained a bucket in the last coverage merge """
+        return self.new_edges[:self.new_edge_count]
+
     def __is_finding_unique(self, bitmap, finding_bitmap, timeout=False):
-        self.bitmap_native_so.is_finding_unique.restype = c_bool
-        return self.bitmap_native_so.is_finding_unique(finding_bitmap, (c_uint8 * self.bitmap_size).from_buffer_copy(bitmap), c_uint64(self.bitmap_size))
+        return get_nativ().is_finding_unique(finding_bitmap, bitmap, self.bitmap_size)
 
     def __check_if_favorite(self, node):
 
@@ -774,16 +968,18 @@ class KaflTree:
         if node.node_type > KaflNodeType.favorite:
             return
 
-        for i in node.bits:
-            if (self.fav_bitmap[i]):
+        ref = self.__get_ref(node)
+        for i in node.edges:
+            owner = self.fav_bitmap[i]
+            if owner != NO_OWNER:
 
-                if(self.max_min_bucketing_enabled and node != self.max_bucket_ref[i]) or not self.max_min_bucketing_enabled:
-                    prev = self.__get_from_ref(self.fav_bitmap[i])
-                    if prev == node:
+                if(self.max_min_bucketing_enabled and ref != self.max_bucket_ref[i]) or not self.max_min_bucketing_enabled:
+                    if owner == ref:
                         continue
+                    prev = self.__get_from_ref(owner)
 
                     if not self.ignore_bit_counts:
-                        if not (node.bits >= prev.bits and node.fav_factor < prev.fav_factor): 
+                        if not (node.bit_count >= prev.bit_count and node.fav_factor < prev.fav_factor): 
                             continue
                     else:
                         if node.fav_factor > prev.fav_factor: 
@@ -791,9 +987,14 @@ class KaflTree:
 
                     prevs.append(prev)
                     prev.fav_bits -= 1
+                    self.stale_scores.add(owner)
 
             node.fav_bits += 1
-            self.fav_bitmap[i] = self.__get_ref(node)
+            if owner != ref:
+                if owner != NO_OWNER:
+                    self.__get_from_ref(owner).owned_edges -= 1
+                node.owned_edges += 1
+                self.fav_bitmap[i] = ref
             self.score_changed = True
             
         if self.score_changed:
@@ -802,12 +1003,8 @@ class KaflTree:
                 
             self.favorites += 1
 
-            self.regular_buf.remove(self.__get_ref(node))
-
-            if node.performance == 0 or (1/node.performance) <= 1000.0:
-                self.favorite_buf.insert(0,self.__get_ref(node))
-            else:
-                self.favorite_buf.append(self.__get_ref(node))
+            self.regular_buf.remove(ref)
+            self.favorite_buf.push(ref)
 
             node.node_type = KaflNodeType.favorite
             self.graph.update(node)  
@@ -827,8 +1024,17 @@ class KaflTree:
             return (perf, -node.level, node.fav_bits, 1/node.performance)
 
 
+    def __get_priority(self, id):
+        """ heap priority: the best __get_score() comes first """
+        score = self.__get_score(id)
+        if not isinstance(score, tuple):
+            return (1,)
+        return (0,) + tuple(-value for value in score)
+
     def resort_favs(self):
-        self.favorite_buf = sorted(self.favorite_buf, key=self.__get_score)
+        for ref in self.stale_scores:
+            self.favorite_buf.update(ref)
+        self.stale_scores = set()
 
 
     def toggle_preliminary_mode(self, state):
@@ -843,7 +1049,7 @@ class KaflTree:
             if prev.level == 0:
                 continue
             reference = self.__get_ref(prev)
-            if reference not in self.fav_bitmap:
+            if prev.owned_edges == 0:
                 self.favorites -= 1
                 if prev.node_state == KaflNodeState.in_progress:
                     self.favorites_in_progress -= 1
@@ -878,12 +1084,16 @@ class KaflTree:
 
         return self.__is_finding_unique(bitmap, self.c_timeout_bitmap, timeout=True)
 
+    def __add_payload_digest(self, digest):
+        if PayloadIndex().add(digest) is None:
+            self.payload_digests.add(digest)
+
     def __check_if_duplicate(self, payload):
-        if mmh3.hash(payload) in self.payload_hashes:
-            return True
-        return False
+        digest = payload_digest(payload)
+        return digest in PayloadIndex() or digest in self.payload_digests
 
-    def append(self, payload, bitmap, methode, node_state=None, node_type=None, performance=0.0):
+    def append(self, payload, bitmap, methode, node_state=None, node_type=None, performance=0.0, coverage=None):
+        """ coverage: result of merge_coverage() if the bitmap was already merged """
         accepted = False
 
         new_byte_count = 0
@@ -899,7 +1109,7 @@ class KaflTree:
                 elif node_type == KaflNodeType.timeout:
                     accepted = self.__is_unique_timeout(bitmap)
             else:
-                new_byte_count, new_bit_count = self.__are_new_bits_present(bitmap)
+                new_byte_count, new_bit_count = coverage or self.__are_new_bits_present(bitmap)
                 if new_bit_count != 0 and not self.__check_if_duplicate(payload):
                     accepted = True
 
@@ -924,7 +1134,7 @@ class KaflTree:
                     return False
 
         if not accepted:
-            new_byte_count, new_bit_count = self.__are_new_bits_present(bitmap)
+            new_byte_count, new_bit_count = coverage or self.__are_new_bits_present(bitmap)
             found = (new_bit_count != 0)
             if self.__check_if_duplicate(payload):
                 return False
@@ -956,14 +1166,8 @@ class KaflTree:
             return False
 
     def get_bitmap_values(self):
-        count_bytes = 0
-        bits_per_byte = 0
-        for e in self.bitmap:
-            if e != '\x00':
-                count_bytes += 1
-                for b in (self.buckets):
-                    if ord(e) >= b+1:
-                        bits_per_byte += 1
+        count_bytes = self.coverage_totals[0]
+        bits_per_byte = self.coverage_totals[1]
 
         ratio_coverage = 100.0 * (float(count_bytes) / float(self.bitmap_size))
         if count_bytes != 0:
@@ -983,44 +1187,94 @@ class KaflTree:
             return 0
 
     def save_data(self):
-        return
-        ignore = [  "bitmap_fd", 
-                    "crash_bitmap_fd", 
-                    "kasan_bitmap_fd",
-                    "timeout_bitmap_fd", 
-                    "bitmap", 
-                    "crash_bitmap", 
-                    "kasan_bitmap", 
-                    "timeout_bitmap",
-                    "backup_bitmap_fd", 
-                    "backup_crash_bitmap_fd", 
-                    "backup_kasan_bitmap_fd",
-                    "backup_timeout_bitmap_fd", 
-                    "backup_bitmap", 
-                    "backup_crash_bitmap", 
-                    "backup_kasan_bitmap", 
-                    "backup_timeout_bitmap"]
-        dump = {}
-        for key, value in self.__dict__.iteritems():
-            if key != 'graph' and key not in ignore:
-                dump[key] = value
-
-        with open(FuzzerConfiguration().argument_values['work_dir'] + "/tree.json", 'w') as outfile:
-            json.dump(dump, outfile, default=json_dumper)
+        """ snapshot sections of the tree (see fuzzer/snapshot.py), only call this outside preliminary mode """
+        global KaflNodeID, KaflCrashID, KaflKASanID, KaflTimeoutID
+
+        snapshot = Snapshot()
+        for node in self.all_nodes[len(self.edge_offsets):]:
+            self.edge_offsets.append(self.edge_offset)
+            snapshot.append_edges(node.edges.tostring())
+            self.edge_offset += len(node.edges)
+
+        parents = [self.MASTER_NODE_ID] * len(self.all_nodes)
+        for parent, children in self.references.items():
+            for child in children:
+                parents[child] = parent
+        nodes = "".join([node.pack_record(parents[node.ref], self.edge_offsets[node.ref]) for node in self.all_nodes])
+
+        sections = [("TREE", TREE_RECORD.pack(self.level, self.max_level, self.cycles, self.current,
+                                              self.favorites, self.favorites_in_progress, self.favorites_finished,
+                                              self.paths, self.paths_in_progress, self.paths_finished,
+                                              KaflNodeID, KaflCrashID, KaflKASanID, KaflTimeoutID)),
+                    ("NODE", nodes),
+                    ("FAVS", self.fav_bitmap.tostring()),
+                    ("YILD", struct.pack("<%dQ" % len(self.fuzz_yield.methods), *[self.fuzz_yield.methods[i] for i in sorted(self.fuzz_yield.methods)])),
+                    ("BMAP", self.bitmap[:]),
+                    ("CMAP", self.crash_bitmap[:]),
+                    ("KMAP", self.kasan_bitmap[:]),
+                    ("TMAP", self.timeout_bitmap[:])]
+        if self.max_min_bucketing_enabled:
+            sections.append(("MAXB", self.max_bucket_values.tostring()))
+            sections.append(("MAXR", self.max_bucket_ref.tostring()))
+        return sections
 
     @classmethod
-    def load_data(cls, enable_graphviz=False):
-        log_tree("Restore from json file...")
+    def load_data(cls, sections, enable_graphviz=False):
+        global KaflNodeID, KaflCrashID, KaflKASanID, KaflTimeoutID
+        log_tree("Restore from snapshot...")
         obj = cls([], enable_graphviz=enable_graphviz, flush=False)
-        KaflNode.reset_node_id()
-        with open(FuzzerConfiguration().argument_values['work_dir'] + "/tree.json", 'r') as infile:
-            dump = json.load(infile)
-            for key, value in dump.iteritems():
-                if key == 'all_nodes':
-                    obj.all_nodes = []
-                    for var in value:
-                        obj.all_nodes.append(KaflNode.load_json(var))
-                else:
-                    setattr(obj, key, value)
+
+        snapshot = Snapshot()
+        edges = snapshot.read_edges()
+        obj.edge_offset = len(edges) / 4
+
+        (obj.level, obj.max_level, obj.cycles, obj.current,
+         obj.favorites, obj.favorites_in_progress, obj.favorites_finished,
+         obj.paths, obj.paths_in_progress, obj.paths_finished,
+         node_id, crash_id, kasan_id, timeout_id) = TREE_RECORD.unpack(sections["TREE"])
+
+        obj.all_nodes = []
+        obj.references = {}
+        obj.payload_digests = set()
+        nodes = sections["NODE"]
+        for offset in xrange(0, len(nodes), NODE_RECORD.size):
+            node, parent = KaflNode.load_record(nodes, offset, edges)
+            node.ref = len(obj.all_nodes)
+            obj.all_nodes.append(node)
+            obj.references.setdefault(parent, []).append(node.ref)
+            obj.edge_offsets.append(NODE_RECORD.unpack_from(nodes, offset)[15])
+            obj.__add_payload_digest(node.payload_digest)
+        KaflNodeID, KaflCrashID, KaflKASanID, KaflTimeoutID = node_id, crash_id, kasan_id, timeout_id
+
+        obj.fav_bitmap = array('i')
+        obj.fav_bitmap.fromstring(sections["FAVS"])
+        for owner in obj.fav_bitmap:
+            if owner != NO_OWNER:
+                obj.all_nodes[owner].owned_edges += 1
+
+        for i, count in enumerate(struct.unpack("<%dQ" % (len(sections["YILD"]) / 8), sections["YILD"])):
+            obj.fuzz_yield.methods[i] = count
+
+        obj.bitmap[:] = sections["BMAP"]
+        obj.crash_bitmap[:] = sections["CMAP"]
+        obj.kasan_bitmap[:] = sections["KMAP"]
+        obj.timeout_bitmap[:] = sections["TMAP"]
+        obj.__update_coverage_totals()
+
+        if obj.max_min_bucketing_enabled and "MAXB" in sections:
+            obj.max_bucket_values = array('i')
+            obj.max_bucket_values.fromstring(sections["MAXB"])
+            obj.max_bucket_ref = array('i')
+            obj.max_bucket_ref.fromstring(sections["MAXR"])
+
+        obj.__rebuild_buffers()
         obj.__restore_graph()
         return obj
+
+    @classmethod
+    def load_current(cls, sections):
+        """ the node the master was working on when the snapshot was taken """
+        current = TREE_RECORD.unpack(sections["TREE"])[3]
+        if current == cls.MASTER_NODE_ID:
+            current = 0
+        return KaflNode.load_record(sections["NODE"], current * NODE_RECORD.size)[0]
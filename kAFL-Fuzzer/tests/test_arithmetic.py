@@ -0,0 +1,182 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import random
+import sys
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzer.communicator import JobBatch, JobRing
+from fuzzer.technique.arithmetic import arithmetic_range, mutate_seq_arithmetic_batch
+from fuzzer.technique.helper import *
+from fuzzer.technique.interesting_values import mutate_seq_interesting_batch
+
+""" the former pure Python stages, kept as reference for the native generators """
+
+
+def selected(effector_map, i, width):
+    return not effector_map or any(effector_map[i:i + width])
+
+
+def reference_arithmetic(data, width, skip_null, effector_map, arith_max):
+    for i in range(len(data) - width + 1):
+        if not selected(effector_map, i, width):
+            continue
+        head, tail = data[:i].tostring(), data[i + width:].tostring()
+        if width == 1:
+            value = data[i]
+            if skip_null and value == 0:
+                continue
+            for j in range(1, arith_max + 1):
+                for new_value in (in_range_8(value + j), in_range_8(value - j)):
+                    if is_not_bitflip(value ^ new_value):
+                        yield i, head + to_string_8(new_value) + tail
+        elif width == 2:
+            value = in_range_16(array('H', data[i:i + 2].tostring())[0])
+            if skip_null and value == 0:
+                continue
+            for j in range(1, arith_max + 1):
+                if is_not_bitflip(value ^ in_range_16(value + j)) and (value & 0xff) + j > 0xff:
+                    yield i, head + to_string_16(in_range_16(value + j)) + tail
+                if is_not_bitflip(value ^ in_range_16(value - j)) and (value & 0xff) < j:
+                    yield i, head + to_string_16(in_range_16(value - j)) + tail
+                if is_not_bitflip(value ^ swap_16(swap_16(value) + j)) and (value >> 8) + j > 0xff:
+                    yield i, head + to_string_16(swap_16(in_range_16(swap_16(value) + j))) + tail
+                if is_not_bitflip(value ^ swap_16(swap_16(value) - j)) and (value >> 8) < j:
+                    yield i, head + to_string_16(swap_16(in_range_16(swap_16(value) - j))) + tail
+        else:
+            value = in_range_32(array('I', data[i:i + 4].tostring())[0])
+            if skip_null and value == 0:
+                continue
+            for j in range(1, arith_max + 1):
+                if is_not_bitflip(value ^ in_range_32(value + j)) and in_range_32((value & 0xffff) + j) > 0xffff:
+                    yield i, head + to_string_32(in_range_32(value + j)) + tail
+                if is_not_bitflip(value ^ in_range_32(value - j)) and (value & 0xffff) < j:
+                    yield i, head + to_string_32(in_range_32(value - j)) + tail
+                if is_not_bitflip(value ^ swap_32(swap_32(value) + j)) and \
+                        in_range_32((swap_32(value) & 0xffff) + j) > 0xffff:
+                    yield i, head + to_string_32(swap_32(in_range_32(swap_32(value) + j))) + tail
+                if is_not_bitflip(value ^ swap_32(swap_32(value) - j)) and (swap_32(value) & 0xffff) < j:
+                    yield i, head + to_string_32(swap_32(in_range_32(swap_32(value) - j))) + tail
+
+
+def reference_interesting(data, width, skip_null, effector_map, arith_max):
+    values = {1: interesting_8_Bit, 2: interesting_16_Bit, 4: interesting_32_Bit}[width]
+    for i in range(len(data) - width + 1):
+        if not selected(effector_map, i, width):
+            continue
+        head, tail = data[:i].tostring(), data[i + width:].tostring()
+        if width == 1:
+            value = data[i]
+            if skip_null and value == 0:
+                continue
+            for interesting in values:
+                new_value = in_range_8(interesting)
+                if is_not_bitflip(value ^ new_value) and is_not_arithmetic(value, new_value, 1):
+                    yield i, head + to_string_8(new_value) + tail
+            continue
+        in_range, swap, to_string = {2: (in_range_16, swap_16, to_string_16),
+                                     4: (in_range_32, swap_32, to_string_32)}[width]
+        value = in_range(array('H' if width == 2 else 'I', data[i:i + width].tostring())[0])
+        if skip_null and value == 0:
+            continue
+        for interesting in values:
+            new_value = in_range(interesting)
+            swapped = swap(new_value)
+            if is_not_bitflip(value ^ new_value) and \
+                    is_not_arithmetic(value, new_value, width, set_arith_max=arith_max) and \
+                    is_not_interesting(value, new_value, width, 0):
+                yield i, head + to_string(new_value) + tail
+            if new_value != swapped and is_not_bitflip(value ^ swapped) and \
+                    is_not_arithmetic(value, swapped, width, set_arith_max=arith_max) and \
+                    is_not_interesting(value, swapped, width, 1):
+                yield i, head + to_string(swapped) + tail
+
+
+def unique(mutations):
+    """ the Python stages repeated a mutation whenever two operations at one offset hit the same value """
+    seen = set()
+    payloads = []
+    for mutation in mutations:
+        if mutation not in seen:
+            seen.add(mutation)
+            payloads.append(mutation[1])
+    return payloads
+
+
+class NativeCandidateStages(unittest.TestCase):
+    """ the native arithmetic and interesting value stages must emit the mutations of the Python stages """
+
+    SLOT_SIZE = 64
+
+    def drain(self, stage, data, width, **kwargs):
+        payloads = []
+
+        def handler(candidate_batch):
+            job_batch = JobBatch(random.randint(1, 9), self.SLOT_SIZE)
+            while candidate_batch.fill(job_batch):
+                for slot in range(len(job_batch)):
+                    offset = slot * self.SLOT_SIZE
+                    length = JobRing.SLOT_LENGTH.unpack_from(job_batch.buffer, offset)[0]
+                    offset += JobRing.SLOT_LENGTH.size
+                    payloads.append(str(job_batch.buffer[offset:offset + length]))
+                job_batch.clear()
+
+        stage(array('B', data), width, handler, **kwargs)
+        return payloads
+
+    def cases(self):
+        random.seed(3)
+        for _ in range(120):
+            length = random.randint(0, 24)
+            data = array('B', [random.choice([0, 0xff, random.randint(0, 255)]) for _ in range(length)])
+            effector_map = None
+            if random.random() < 0.5:
+                effector_map = [random.random() < 0.5 for _ in range(length)]
+            yield data, random.random() < 0.5, effector_map, random.choice([AFL_ARITH_MAX, 10])
+
+    def test_arithmetic(self):
+        for data, skip_null, effector_map, arith_max in self.cases():
+            total = 0
+            for width in (1, 2, 4):
+                native = self.drain(mutate_seq_arithmetic_batch, data, width, skip_null=skip_null,
+                                    effector_map=effector_map, set_arith_max=arith_max)
+                reference = unique(reference_arithmetic(data, width, skip_null, effector_map, arith_max))
+                self.assertEqual(native, reference, "width %d" % width)
+                total += len(native)
+            self.assertEqual(arithmetic_range(data.tostring(), skip_null=skip_null, effector_map=effector_map,
+                                              set_arith_max=arith_max), total)
+
+    def test_interesting(self):
+        for data, skip_null, effector_map, arith_max in self.cases():
+            for width in (1, 2, 4):
+                native = self.drain(mutate_seq_interesting_batch, data, width, skip_null=skip_null,
+                                    effector_map=effector_map, set_arith_max=arith_max)
+                """ the single byte stage always filters with AFL_ARITH_MAX """
+                reference_max = AFL_ARITH_MAX if width == 1 else arith_max
+                reference = unique(reference_interesting(data, width, skip_null, effector_map, reference_max))
+                self.assertEqual(native, reference, "width %d" % width)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import random
+import sys
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzer.communicator import JobBatch, JobRing
+from fuzzer.technique.bitflip import mutate_seq_bitflip_batch
+
+
+def reference_bitflip(data, stage, skip_null, effector_map):
+    """ the former pure Python stages as (payload, affected_bytes), kept as reference for the native generator """
+    data = array('B', data)
+    if stage <= 4:
+        for i in range(len(data) * 8 - stage + 1):
+            first, last = i / 8, (i + stage - 1) / 8
+            if effector_map and not (effector_map[first] or effector_map[last]):
+                continue
+            if skip_null and data[first] == 0 and data[last] == 0:
+                continue
+            mutation = array('B', data)
+            for bit in range(i, i + stage):
+                mutation[bit / 8] ^= 0x80 >> (bit % 8)
+            yield mutation.tostring(), [0]
+    else:
+        width = stage / 8
+        for i in range(len(data) - width + 1):
+            if effector_map and not any(effector_map[i:i + width]):
+                continue
+            if skip_null and stage == 8 and data[i] == 0:
+                continue
+            mutation = array('B', data)
+            for j in range(i, i + width):
+                mutation[j] ^= 0xff
+            yield mutation.tostring(), [i] if stage == 8 else [0]
+
+
+class NativeBitflipStages(unittest.TestCase):
+    """ the native bit/byte flip stages must emit the mutations of the Python stages """
+
+    SLOT_SIZE = 64
+
+    def drain(self, data, stage, **kwargs):
+        mutations = []
+
+        def handler(bitflip_batch):
+            job_batch = JobBatch(random.randint(1, 7), self.SLOT_SIZE)
+            while True:
+                num = bitflip_batch.fill(job_batch)
+                if num == 0:
+                    break
+                for slot, affected_bytes in zip(range(len(job_batch)), bitflip_batch.affected_bytes(num)):
+                    offset = slot * self.SLOT_SIZE
+                    length = JobRing.SLOT_LENGTH.unpack_from(job_batch.buffer, offset)[0]
+                    offset += JobRing.SLOT_LENGTH.size
+                    mutations.append((str(job_batch.buffer[offset:offset + length]), affected_bytes))
+                job_batch.clear()
+
+        mutate_seq_bitflip_batch(array('B', data), stage, handler, **kwargs)
+        return mutations
+
+    def test_stages(self):
+        random.seed(2)
+        for _ in range(150):
+            length = random.randint(0, 40)
+            data = array('B', [random.choice([0, random.randint(0, 255)]) for _ in range(length)])
+            effector_map = None
+            if random.random() < 0.5:
+                effector_map = [random.random() < 0.5 for _ in range(length)]
+            skip_null = random.random() < 0.5
+            for stage in (1, 2, 4, 8, 16, 32):
+                native = self.drain(data, stage, skip_null=skip_null, effector_map=effector_map)
+                reference = list(reference_bitflip(data, stage, skip_null and stage <= 8, effector_map))
+                self.assertEqual(native, reference, "stage %d" % stage)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzer.corpus import CorpusStore
+
+
+class SmallCorpusStore(CorpusStore):
+    """ tiny segments and index steps, so a few payloads already roll over and remap both """
+    SEGMENT_SIZE = 64
+    INDEX_GROWTH = 4
+
+
+def open_store(directory):
+    """ a private instance instead of the per-process singleton, one per simulated process """
+    return type.__call__(SmallCorpusStore, directory)
+
+
+class CorpusStoreBehavior(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="kafl_corpus_")
+        self.store = open_store(self.directory + "/store")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def payload(self, node_id):
+        return ("payload %d " % node_id) * (node_id % 5)
+
+    def fill(self, count):
+        for node_id in range(count):
+            self.store.append(node_id % 3, node_id, 1000 + node_id, self.payload(node_id))
+
+    def test_append_get_remove(self):
+        self.fill(40)
+        self.assertTrue(os.path.exists(self.directory + "/store/segment_0005"))
+        for node_id in range(40):
+            self.assertEqual(str(self.store.get(node_id % 3, node_id)), self.payload(node_id))
+            self.assertEqual(str(self.store.get_by_hash(1000 + node_id)), self.payload(node_id))
+        self.assertIsNone(self.store.get(1, 0))
+        self.assertIsNone(self.store.get_by_hash(1))
+
+        self.store.append(0, 3, 2000, "replaced")
+        self.assertEqual(str(self.store.get(0, 3)), "replaced")
+        self.store.remove(0, 3)
+        self.assertIsNone(self.store.get(0, 3))
+        self.assertIsNone(self.store.get_by_hash(2000))
+        self.assertEqual(sorted(self.store.keys([1])), [(1, node_id) for node_id in range(1, 40, 3)])
+
+    def test_reader_picks_up_appends(self):
+        reader = open_store(self.directory + "/store")
+        self.assertEqual(reader.keys(), [])
+        self.fill(40)
+        self.store.remove(0, 0)
+        for node_id in range(1, 40):
+            self.assertEqual(str(reader.get(node_id % 3, node_id)), self.payload(node_id))
+        self.assertIsNone(reader.get(0, 0))
+        self.assertEqual(sorted(reader.keys()), sorted(self.store.keys()))
+
+    def test_reopen(self):
+        self.fill(20)
+        self.store.sync()
+        store = open_store(self.directory + "/store")
+        self.assertEqual(sorted(store.keys()), sorted(self.store.keys()))
+        store.append(2, 99, 99, "after reopen")
+        self.assertEqual(str(store.get(2, 99)), "after reopen")
+        self.assertEqual(str(store.get(1, 19)), self.payload(19))
+
+    def test_rejects_foreign_index(self):
+        os.makedirs(self.directory + "/other")
+        with open(self.directory + "/other/index", "wb") as f:
+            f.write("not an index" * 4)
+        self.assertRaises(ValueError, open_store, self.directory + "/other")
+
+    def test_export(self):
+        self.fill(9)
+        self.store.export([2], self.directory + "/payload_%05d")
+        for node_id in (2, 5, 8):
+            with open(self.directory + "/payload_%05d" % node_id, "rb") as f:
+                self.assertEqual(f.read(), self.payload(node_id))
+        self.assertFalse(os.path.exists(self.directory + "/payload_00001"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzer.technique.havoc_handler import HavocBuffer, havoc_handler, set_dict
+from fuzzer.technique.helper import seed_random
+
+
+class HavocBufferBehavior(unittest.TestCase):
+    """ the in-place edits of HavocBuffer must match plain string slicing, clipped to the capacity """
+
+    CAPACITY = 48
+
+    def chunk(self):
+        return os.urandom(random.randint(0, 20))
+
+    def test_load_truncates(self):
+        buf = HavocBuffer(self.CAPACITY)
+        payload = os.urandom(2 * self.CAPACITY)
+        buf.load(payload)
+        self.assertEqual(buf.tostring(), payload[:self.CAPACITY])
+        buf.load("short")
+        self.assertEqual(buf.tostring(), "short")
+
+    def test_edits_match_slicing(self):
+        random.seed(5)
+        buf = HavocBuffer(self.CAPACITY)
+        for _ in range(200):
+            model = os.urandom(random.randint(0, self.CAPACITY))
+            buf.load(model)
+            for _ in range(20):
+                operation = random.randint(0, 4)
+                pos = random.randint(0, len(model))
+                length = random.randint(0, len(model) - pos)
+                chunk = self.chunk()
+                if operation == 0:
+                    buf.delete(pos, length)
+                    model = model[:pos] + model[pos + length:]
+                elif operation == 1:
+                    buf.insert(pos, chunk)
+                    model = model[:pos] + chunk[:self.CAPACITY - len(model)] + model[pos:]
+                elif operation == 2:
+                    buf.replace(pos, length, chunk)
+                    model = model[:pos] + chunk[:length + self.CAPACITY - len(model)] + model[pos + length:]
+                elif operation == 3:
+                    buf.overwrite(pos, chunk)
+                    model = (model[:pos] + chunk + model[pos + len(chunk):])[:self.CAPACITY]
+                else:
+                    buf.truncate(length)
+                    model = model[:length]
+                self.assertEqual(buf.tostring(), model, "operation %d" % operation)
+                self.assertEqual(len(buf), len(model))
+
+    def test_operators_stay_in_bounds(self):
+        set_dict(["dictionary entry", "x"])
+        seed_random(11)
+        buf = HavocBuffer(self.CAPACITY)
+        for _ in range(300):
+            buf.load(os.urandom(random.randint(0, self.CAPACITY)))
+            for handler in havoc_handler:
+                handler(buf)
+                self.assertTrue(0 <= len(buf) <= self.CAPACITY, handler.__name__)
+                self.assertEqual(len(buf.tostring()), len(buf))
+        set_dict([])
+
+    def test_operators_are_reproducible(self):
+        payload = os.urandom(self.CAPACITY / 2)
+        results = []
+        for _ in range(2):
+            seed_random(3)
+            buf = HavocBuffer(self.CAPACITY)
+            buf.load(payload)
+            for handler in havoc_handler * 4:
+                handler(buf)
+            results.append(buf.tostring())
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
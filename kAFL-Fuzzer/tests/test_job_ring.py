@@ -0,0 +1,99 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ctypes
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzer.communicator import JobRing
+
+
+class JobRingBehavior(unittest.TestCase):
+    """ FIFO order, wrap-around, truncation and the overflow/underflow guards of JobRing """
+
+    CAPACITY = 4
+    SLOT_SIZE = 16
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(prefix="kafl_job_ring_", dir="/dev/shm")
+        os.close(fd)
+        JobRing.create(self.filename, self.CAPACITY, self.SLOT_SIZE)
+        self.ring = JobRing(self.filename, self.CAPACITY, self.SLOT_SIZE)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_fifo_with_wrap_around(self):
+        pushed = 0
+        consumed = 0
+        for _ in range(5):
+            while self.ring.pending() < self.CAPACITY:
+                self.ring.push("job%d" % pushed)
+                pushed += 1
+            self.assertEqual(self.ring.pending(), self.CAPACITY)
+            for num in range(3):
+                self.assertEqual(self.ring.read_slot(num), "job%d" % (consumed + num))
+            self.ring.consume(3)
+            consumed += 3
+            self.assertEqual(self.ring.pending(), pushed - consumed)
+
+    def test_truncates_to_slot(self):
+        self.ring.push("A" * (2 * self.SLOT_SIZE))
+        self.ring.push("")
+        self.assertEqual(self.ring.read_slot(0), "A" * (self.SLOT_SIZE - JobRing.SLOT_LENGTH.size))
+        self.assertEqual(self.ring.read_slot(1), "")
+
+    def test_copy_slot_uses_payload_layout(self):
+        self.ring.push("skip")
+        self.ring.push("payload")
+        target = ctypes.create_string_buffer(self.SLOT_SIZE)
+        self.assertEqual(self.ring.copy_slot(1, ctypes.addressof(target)), len("payload"))
+        self.assertEqual(target.raw[:JobRing.SLOT_LENGTH.size + len("payload")],
+                         JobRing.SLOT_LENGTH.pack(len("payload")) + "payload")
+
+    def test_guards(self):
+        for i in range(self.CAPACITY):
+            self.ring.push("x")
+        self.assertRaises(AssertionError, self.ring.push, "x")
+        self.assertRaises(AssertionError, self.ring.read_slot, self.CAPACITY)
+        self.assertRaises(AssertionError, self.ring.consume, self.CAPACITY + 1)
+        self.ring.consume(self.CAPACITY)
+        self.assertRaises(AssertionError, self.ring.read_slot, 0)
+
+    def test_shared_between_processes(self):
+        """ a second mapping (as in the slave) sees the pushed slots and the consumer's head """
+        consumer = JobRing(self.filename, self.CAPACITY, self.SLOT_SIZE)
+        self.ring.push("first")
+        self.ring.push("second")
+        pid = os.fork()
+        if pid == 0:
+            ok = consumer.pending() == 2 and consumer.read_slot(1) == "second"
+            consumer.consume(2)
+            os._exit(0 if ok else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.ring.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
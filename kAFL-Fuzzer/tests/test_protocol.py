@@ -0,0 +1,78 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzer.fuzz_methods import fuzz_methode, METHODE_BITFLIP_8, METHODE_HAVOC
+from fuzzer.protocol import FuzzingResult, HOT_TAGS, KAFL_TAG_REQ, KAFL_TAG_JOB, KAFL_TAG_RESULT, KAFL_TAG_START, \
+    pack_data, unpack_data
+
+
+class HotTagRoundTrip(unittest.TestCase):
+    """ every hot tag must take the binary path and decode to the same data """
+
+    def assertMethodeEqual(self, a, b):
+        self.assertEqual((a.methode_type, a.bb_delta, a.redqueen_cmp, a.input_byte),
+                         (b.methode_type, b.bb_delta, b.redqueen_cmp, b.input_byte))
+
+    def round_trip(self, tag, data):
+        body = pack_data(tag, data)
+        self.assertIsNotNone(body, "tag %d fell back to pickle" % tag)
+        return unpack_data(tag, body)
+
+    def test_all_hot_tags_covered(self):
+        self.assertEqual(set(HOT_TAGS), {KAFL_TAG_REQ, KAFL_TAG_JOB, KAFL_TAG_RESULT})
+
+    def test_req(self):
+        for slave_id in (0, 3, 127):
+            self.assertEqual(self.round_trip(KAFL_TAG_REQ, slave_id), slave_id)
+
+    def test_job(self):
+        methods = [fuzz_methode(METHODE_BITFLIP_8),
+                   fuzz_methode(METHODE_HAVOC, bb_delta=1 << 40),
+                   fuzz_methode(METHODE_HAVOC, redqueen_cmp=("cmp", 4), input_byte=7, bb_delta=-2)]
+        affected = [[0, 1, 2], None, []]
+        result_affected, result_methods = self.round_trip(KAFL_TAG_JOB, [affected, methods])
+        self.assertEqual(result_affected, affected)
+        for a, b in zip(methods, result_methods):
+            self.assertMethodeEqual(a, b)
+
+    def test_result(self):
+        results = [FuzzingResult(0, True, False, False, [4, 5], 1, 0.25, fuzz_methode(METHODE_BITFLIP_8),
+                                 (123, -456), reloaded=True, new_bits=False, qid=1),
+                   FuzzingResult(7, False, True, True, None, 2, 1e-6, fuzz_methode(METHODE_HAVOC, bb_delta=1 << 33),
+                                 None, qid=2)]
+        for a, b in zip(results, self.round_trip(KAFL_TAG_RESULT, results)):
+            for attribute in ('pos', 'crash', 'timeout', 'kasan', 'affected_bytes', 'slave_id', 'performance',
+                              'bitmap_hash', 'reloaded', 'new_bits', 'qid'):
+                self.assertEqual(getattr(a, attribute), getattr(b, attribute), attribute)
+            self.assertMethodeEqual(a.methode, b.methode)
+
+    def test_fallback(self):
+        self.assertIsNone(pack_data(KAFL_TAG_JOB, [[["a"]], [fuzz_methode()]]))
+        self.assertIsNone(pack_data(KAFL_TAG_START, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
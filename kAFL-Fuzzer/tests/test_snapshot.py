@@ -0,0 +1,117 @@
+"""
+This file is part of the Redqueen fuzzer.
+
+Sergej Schumilo, 2019 <sergej@schumilo.de>
+Cornelius Aschermann, 2019 <cornelius.aschermann@rub.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Redqueen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+""" run from anywhere: kafl.ini and the packages live in the fuzzer root """
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+class Arguments(dict):
+    def __missing__(self, key):
+        return None
+
+
+class SnapshotRoundTrip(unittest.TestCase):
+    """ save_data() -> Snapshot -> load_data() must restore the whole tree """
+
+    NODE_ATTRIBUTES = ['level', 'node_state', 'node_type', 'node_id', 'payload_len', 'payload_hash', 'payload_digest',
+                       'performance', 'fav_factor', 'fav_bits', 'bit_count', 'identifier', 'owned_edges', 'ref']
+    TREE_ATTRIBUTES = ['level', 'max_level', 'cycles', 'current', 'favorites', 'favorites_in_progress',
+                       'favorites_finished', 'paths', 'paths_in_progress', 'paths_finished']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp(prefix="kafl_snapshot_")
+
+        from common.config import FuzzerConfiguration
+        from common.util import prepare_working_dir
+        FuzzerConfiguration(emulated_arguments=Arguments(work_dir=cls.work_dir, p=1, seed=1))
+        prepare_working_dir(cls.work_dir, purge=True)
+
+        from common.shared_set import PayloadIndex
+        from fuzzer.state import GlobalState
+        GlobalState()
+        PayloadIndex()
+
+    @classmethod
+    def tearDownClass(cls):
+        from common.writer import AsyncWriter
+        AsyncWriter().flush()
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def random_bitmap(self, size):
+        bitmap = bytearray('\xff' * size)
+        for _ in range(random.randint(1, 40)):
+            bitmap[random.randint(0, 300)] = random.randint(0, 254)
+        return str(bitmap)
+
+    def test_round_trip(self):
+        from common.config import FuzzerConfiguration
+        from common.writer import AsyncWriter
+        from fuzzer.fuzz_methods import fuzz_methode
+        from fuzzer.snapshot import Snapshot
+        from fuzzer.tree import KaflTree, KaflNodeType
+
+        random.seed(7)
+        size = FuzzerConfiguration().config_values['BITMAP_SHM_SIZE']
+        tree = KaflTree([("seed%d" % i, self.random_bitmap(size)) for i in range(3)])
+        for i in range(60):
+            node_type = random.choice([None, None, None, KaflNodeType.crash, KaflNodeType.timeout])
+            payload = "payload%d" % i + os.urandom(random.randint(0, 8))
+            tree.append(payload, self.random_bitmap(size), fuzz_methode(), node_type=node_type,
+                        performance=random.random())
+            if i % 7 == 0:
+                tree.get_next(0.5, finished=bool(i % 2))
+
+        AsyncWriter().flush()
+        Snapshot().write(tree.save_data())
+        AsyncWriter().flush()
+
+        sections = Snapshot().read()
+        restored = KaflTree.load_data(sections)
+
+        self.assertEqual(len(tree.all_nodes), len(restored.all_nodes))
+        for node, restored_node in zip(tree.all_nodes, restored.all_nodes):
+            for attribute in self.NODE_ATTRIBUTES:
+                self.assertEqual(getattr(node, attribute), getattr(restored_node, attribute), attribute)
+            self.assertEqual(list(node.edges), list(restored_node.edges))
+            self.assertEqual(node.load_payload(), restored_node.load_payload())
+        for attribute in self.TREE_ATTRIBUTES:
+            self.assertEqual(getattr(tree, attribute), getattr(restored, attribute), attribute)
+
+        self.assertEqual(tree.references, restored.references)
+        self.assertEqual(tree.fav_bitmap, restored.fav_bitmap)
+        self.assertEqual(tree.bitmap[:], restored.bitmap[:])
+        self.assertEqual(list(tree.coverage_totals), list(restored.coverage_totals))
+
+        current = KaflTree.load_current(sections)
+        self.assertEqual(tree.all_nodes[tree.current].node_id, current.node_id)
+
+
+if __name__ == '__main__':
+    unittest.main()